@@ -0,0 +1,67 @@
+"""Measures the decode time of ES scroll pages per serializer
+
+Decodes a page of `page_size` hits with the elasticsearch client's
+default serializer and each installed serializer of
+`bqsqoop.extractor.elasticsearch.serializer`, for the full scroll
+response and the one filtered with `ESHelper`'s filter_path, which only
+keeps the hits' `_source`, `_scroll_id` and `hits.total`.
+
+usage:
+    python benchmarks/es_decode.py [page_size] [repeat]
+"""
+import sys
+import json
+import time
+
+from elasticsearch.serializer import JSONSerializer
+from bqsqoop.extractor.elasticsearch import serializer
+
+
+def _source(i):
+    return {"id": i, "name": "name-%d" % i, "price": i * 0.5,
+            "active": i % 2 == 0, "tags": ["tag-a", "tag-b"],
+            "created_at": "2018-09-10T00:00:%02d" % (i % 60),
+            "address": {"city": "city-%d" % (i % 100), "zip": 10000 + i},
+            "description": "Lorem ipsum dolor sit amet " * 4}
+
+
+def _page(page_size, filtered):
+    hits = []
+    for i in range(page_size):
+        hit = {"_source": _source(i)}
+        if not filtered:
+            hit.update({"_index": "some_es_index", "_type": "_doc",
+                        "_id": "doc-%d" % i, "_score": 1.0})
+        hits.append(hit)
+    page = {"_scroll_id": "DXF1ZXJ5QW5kRmV0Y2gBAAAAAAAAAD4WYm9laVYtZndUQlNsdDcwakFMNjU1QQ==",  # noqa
+            "hits": {"total": page_size * 100, "hits": hits}}
+    if not filtered:
+        page.update({"took": 12, "timed_out": False,
+                     "_shards": {"total": 5, "successful": 5, "failed": 0}})
+        page["hits"]["max_score"] = 1.0
+    return json.dumps(page)
+
+
+def _time(loads, data, repeat):
+    _start = time.time()
+    for _ in range(repeat):
+        loads(data)
+    return (time.time() - _start) / repeat
+
+
+if __name__ == "__main__":
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    serializers = [("client", JSONSerializer())] + [
+        (name, serializer.get_serializer(name))
+        for name in serializer.SERIALIZERS
+        if name != 'auto' and serializer.is_available(name)]
+    print("{0:>10} {1:>10} {2:>10} {3:>10}".format(
+        "response", "KB", "serializer", "ms/page"))
+    for filtered in [False, True]:
+        data = _page(page_size, filtered)
+        for name, _serializer in serializers:
+            loads = _serializer.loads
+            print("{0:>10} {1:>10.0f} {2:>10} {3:>10.2f}".format(
+                "filtered" if filtered else "full", len(data) / 1024.0,
+                name, _time(loads, data, repeat) * 1000))
@@ -0,0 +1,81 @@
+"""Compares ES hits to Arrow conversions on 10k document pages
+
+A pandas frame from `DataFrame.from_dict` conformed with
+`arrow_util.table_from_pandas` against the direct
+`arrow_util.records_to_table`, on sparse `_source` dicts with a mix of
+long, double, keyword, boolean and date fields for a range of widths.
+
+usage:
+    python benchmarks/es_hits_to_arrow.py [repeat]
+"""
+import sys
+import time
+import pandas as pd
+
+from bqsqoop.utils import arrow_util
+from bqsqoop.utils.parquet_util import ParquetUtil
+
+
+PAGE_SIZE = 10000
+WIDTHS = [5, 20, 50]
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+_TYPES = ['long', 'double', 'keyword', 'boolean', 'date']
+
+
+def _fields(width):
+    return {"field%d" % i: _TYPES[i % len(_TYPES)] for i in range(width)}
+
+
+def _value(es_type, i):
+    if es_type == 'long':
+        return i
+    if es_type == 'double':
+        return i * 0.5
+    if es_type == 'boolean':
+        return i % 2 == 0
+    if es_type == 'date':
+        return "2018-09-10T00:00:%02d" % (i % 60)
+    return "value-%d" % i
+
+
+def _page(fields):
+    # Every 10th document misses a field, like sparse ES documents do
+    return [{name: _value(es_type, i)
+             for j, (name, es_type) in enumerate(fields.items())
+             if (i + j) % 10}
+            for i in range(PAGE_SIZE)]
+
+
+def _pandas(records, schema):
+    return arrow_util.table_from_pandas(
+        pd.DataFrame.from_dict(records), schema,
+        datetime_format=DATETIME_FORMAT)
+
+
+def _records(records, schema):
+    return arrow_util.records_to_table(
+        records, schema, datetime_format=DATETIME_FORMAT)
+
+
+def _time(fn, records, schema, repeat):
+    # The first page plans the conversions for the schema
+    fn(records, schema)
+    _start = time.time()
+    for _ in range(repeat):
+        fn(records, schema)
+    return (time.time() - _start) / repeat
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print("{0:>8} {1:>12} {2:>12} {3:>8}".format(
+        "fields", "pandas ms", "records ms", "speedup"))
+    for width in WIDTHS:
+        fields = _fields(width)
+        schema = ParquetUtil(None).build_pyarrow_schema(fields)
+        records = _page(fields)
+        pandas_time = _time(_pandas, records, schema, repeat)
+        records_time = _time(_records, records, schema, repeat)
+        print("{0:>8} {1:>12.1f} {2:>12.1f} {3:>7.1f}x".format(
+            width, pandas_time * 1000, records_time * 1000,
+            pandas_time / records_time))
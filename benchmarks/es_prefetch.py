@@ -0,0 +1,52 @@
+"""Measures ES page prefetching against serial scrolling
+
+Writes simulated scroll pages of 5k documents to parquet with
+`ESHelper.write_pages_to_parquet`, with each page taking `latency_ms`
+to arrive like a remote cluster's scroll call would, for prefetch
+depths 0 (serial) to 3.
+
+usage:
+    python benchmarks/es_prefetch.py [latency_ms] [pages]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from bqsqoop.extractor.elasticsearch.helper import ESHelper
+
+
+PAGE_SIZE = 5000
+FIELDS = {'id': 'long', 'name': 'keyword', 'price': 'double',
+          'created_at': 'date'}
+
+
+def _pages(no_of_pages, latency):
+    for page in range(no_of_pages):
+        time.sleep(latency)
+        yield {'_scroll_id': 'sid', 'hits': {
+            'total': no_of_pages * PAGE_SIZE,
+            'hits': [{'_source': {
+                'id': i, 'name': 'name-%d' % i, 'price': i * 0.5,
+                'created_at': '2018-09-10T00:00:%02d' % (i % 60)}}
+                for i in range(page * PAGE_SIZE, (page + 1) * PAGE_SIZE)]}}
+
+
+def _time(depth, no_of_pages, latency, output_folder):
+    _start = time.time()
+    ESHelper.write_pages_to_parquet(
+        ESHelper.prefetch_pages(_pages(no_of_pages, latency), depth),
+        0, FIELDS, os.path.join(output_folder, 'prefetch_%d.parq' % depth),
+        progress_bar=False)
+    return time.time() - _start
+
+
+if __name__ == "__main__":
+    latency = (int(sys.argv[1]) if len(sys.argv) > 1 else 100) / 1000.0
+    no_of_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print("{0:>8} {1:>10} {2:>10}".format("depth", "secs", "docs/s"))
+    with tempfile.TemporaryDirectory() as output_folder:
+        for depth in range(4):
+            secs = _time(depth, no_of_pages, latency, output_folder)
+            print("{0:>8} {1:>10.2f} {2:>10.0f}".format(
+                depth, secs, no_of_pages * PAGE_SIZE / secs))
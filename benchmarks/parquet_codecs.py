@@ -0,0 +1,84 @@
+"""Compares parquet compression codecs and levels
+
+Writes a table like an extract's, ids, low and high cardinality
+strings, doubles and timestamps, with `ParquetUtil` for each codec and
+level, and reports the file size, write time and read time.
+
+usage:
+    python benchmarks/parquet_codecs.py [rows] [repeat]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from bqsqoop.utils.parquet_util import ParquetUtil
+
+
+# Levels are codec specific, None is the codec's default
+MATRIX = [
+    ('none', [None]),
+    ('snappy', [None]),
+    ('lz4', [None]),
+    ('gzip', [1, 6, 9]),
+    ('brotli', [1, 5, 9]),
+    ('zstd', [1, 3, 9, 19]),
+]
+ROW_GROUP_BYTES = 64 * 1024 * 1024
+
+
+def _table(rows):
+    _rng = np.random.default_rng(0)
+    _countries = np.array(["country-%d" % i for i in range(50)])
+    return pa.table({
+        'id': pa.array(np.arange(rows, dtype=np.int64)),
+        'country': pa.array(_countries[_rng.integers(0, 50, rows)]),
+        'email': pa.array(["user%d@example.com" % i
+                           for i in _rng.integers(0, rows, rows)]),
+        'price': pa.array(np.round(_rng.random(rows) * 1000, 2)),
+        'created_at': pa.array(
+            np.datetime64('2018-09-10') +
+            np.sort(_rng.integers(0, 10 ** 9, rows)).astype(
+                'timedelta64[ms]')),
+    })
+
+
+def _write(table, path, writer_options):
+    _pu = ParquetUtil(path, row_group_bytes=ROW_GROUP_BYTES,
+                      writer_options=writer_options)
+    _pu.append_table_to_parquet(table)
+    _pu.close()
+
+
+def _time(fn, repeat):
+    _start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - _start) / repeat
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    table = _table(rows)
+    print("{0:>8} {1:>6} {2:>10} {3:>10} {4:>10}".format(
+        "codec", "level", "size MB", "write ms", "read ms"))
+    with tempfile.TemporaryDirectory() as output_folder:
+        for codec, levels in MATRIX:
+            if codec != 'none' and not pa.Codec.is_available(codec):
+                continue
+            for level in levels:
+                writer_options = {'compression': codec}
+                if level is not None:
+                    writer_options['compression_level'] = level
+                path = os.path.join(output_folder, "%s_%s.parq" % (
+                    codec, level))
+                write_time = _time(
+                    lambda: _write(table, path, writer_options), repeat)
+                read_time = _time(lambda: pq.read_table(path), repeat)
+                print("{0:>8} {1:>6} {2:>10.1f} {3:>10.0f} {4:>10.0f}".format(
+                    codec, str(level or '-'), os.path.getsize(path) / 1e6,
+                    write_time * 1000, read_time * 1000))
@@ -0,0 +1,67 @@
+"""Compares the pandas and Arrow schema conformance of a batch
+
+`ParquetUtil.fix_dataframe_for_schema` followed by `Table.from_pandas`
+against `arrow_util.table_from_pandas`, on frames shaped like the
+batches the extractors write (ints, floats, strings, timestamps as
+ISO strings and booleans) for a range of batch sizes.
+
+usage:
+    python benchmarks/schema_conformance.py [repeat]
+"""
+import sys
+import time
+import pandas as pd
+import pyarrow as pa
+
+from bqsqoop.utils import arrow_util
+from bqsqoop.utils.parquet_util import ParquetUtil
+
+
+BATCH_SIZES = [1000, 10000, 100000]
+SCHEMA = pa.schema([
+    pa.field("id", pa.int64()),
+    pa.field("price", pa.float64()),
+    pa.field("name", pa.string()),
+    pa.field("created_at", pa.timestamp('ns')),
+    pa.field("active", pa.bool_()),
+])
+
+
+def _batch(batch_size):
+    return pd.DataFrame({
+        "id": range(batch_size),
+        "price": [i * 0.5 for i in range(batch_size)],
+        "name": ["name-%d" % i for i in range(batch_size)],
+        "created_at": ["2018-09-10T00:00:%02d" % (i % 60)
+                       for i in range(batch_size)],
+        "active": [i % 2 == 0 for i in range(batch_size)],
+    })
+
+
+def _pandas(df):
+    df = ParquetUtil.fix_dataframe_for_schema(df, SCHEMA)
+    return pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+
+
+def _arrow(df):
+    return arrow_util.table_from_pandas(df, SCHEMA)
+
+
+def _time(fn, df, repeat):
+    _start = time.time()
+    for _ in range(repeat):
+        fn(df)
+    return (time.time() - _start) / repeat
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("{0:>10} {1:>12} {2:>12} {3:>8}".format(
+        "batch", "pandas ms", "arrow ms", "speedup"))
+    for batch_size in BATCH_SIZES:
+        df = _batch(batch_size)
+        pandas_time = _time(_pandas, df, repeat)
+        arrow_time = _time(_arrow, df, repeat)
+        print("{0:>10} {1:>12.2f} {2:>12.2f} {3:>7.1f}x".format(
+            batch_size, pandas_time * 1000, arrow_time * 1000,
+            pandas_time / arrow_time))
@@ -0,0 +1,60 @@
+"""Compares rows/sec of the row and columnar SQL batch writers
+
+Feeds synthetic fetchmany batches (ints, strings, floats, timezone aware
+timestamps and json columns) through both write paths of
+`bqsqoop.extractor.sql.helper` into a temporary parquet file.
+
+usage:
+    python benchmarks/sql_columnar.py [no_of_rows] [fetch_size]
+"""
+import os
+import sys
+import time
+import pytz
+import tempfile
+
+from datetime import datetime, timedelta
+from bqsqoop.utils import parquet_util
+from bqsqoop.extractor.sql import helper
+
+
+COLUMNS = ["id", "name", "price", "created_at", "attributes"]
+TABLE_SCHEMA = {
+    "id": int, "name": str, "price": float,
+    "created_at": datetime, "attributes": str,
+}
+
+
+def _rows(no_of_rows):
+    _tz = pytz.timezone("America/Los_Angeles")
+    _start = _tz.localize(datetime(2018, 1, 1))
+    return [
+        (i, "name-%d" % i, i * 0.5, _start + timedelta(seconds=i),
+         {"key": i, "tags": ["a", "b"]})
+        for i in range(no_of_rows)
+    ]
+
+
+def _run(write_fn, rows, fetch_size):
+    with tempfile.TemporaryDirectory() as output_folder:
+        _pu = parquet_util.ParquetUtil(os.path.join(output_folder, "b.parq"))
+        _schema = _pu.build_pyarrow_schema(TABLE_SCHEMA)
+        _start = time.time()
+        for i in range(0, len(rows), fetch_size):
+            _result = write_fn(
+                rows[i:i + fetch_size], COLUMNS, _pu, _schema)
+            if write_fn is helper._write_rows_columnar:
+                _schema = _result
+        _pu.close()
+        return time.time() - _start
+
+
+if __name__ == "__main__":
+    no_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fetch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    rows = _rows(no_of_rows)
+    for name, fn in [("row", helper._write_rows),
+                     ("columnar", helper._write_rows_columnar)]:
+        taken = _run(fn, rows, fetch_size)
+        print("{0:>10}: {1:>10.0f} rows/sec ({2:.2f} secs)".format(
+            name, no_of_rows / taken, taken))
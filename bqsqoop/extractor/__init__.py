@@ -24,7 +24,8 @@ def get_extractor_for(config):
     _extractor_src, _extractor_config = next(iter(_extractor_config.items()))
     _extractor = _extractors.get(_extractor_src)
     if(_extractor):
-        return _extractor(_extractor_config)
+        return _extractor(
+            _extractor_config, parquet_config=config.get("parquet"))
     else:
         raise Exception(
             "Unknown extractor given {}".format(
@@ -1,18 +1,23 @@
-import logging
+import copy
 import uuid
+import pandas as pd
 
-from bqsqoop.utils import async_worker
+from datetime import datetime, timedelta
+from bqsqoop.utils import math_util
 from bqsqoop.extractor import Extractor
-from bqsqoop.utils.errors import MissingConfigError
-from bqsqoop.extractor.elasticsearch import helper
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
+from bqsqoop.extractor.elasticsearch import helper, search_after, serializer
+
+
+_EPOCH = datetime(1970, 1, 1)
 
 
 class ElasticSearchExtractor(Extractor):
     """Extractor data from Elasticsearch index
     """
 
-    def __init__(self, _config):
-        super().__init__(_config)
+    def __init__(self, _config, parquet_config=None):
+        super().__init__(_config, parquet_config=parquet_config)
         self._no_of_workers = self._config.get('no_of_workers', 1)
         self._timeout = self._config.get('timeout', '60s')
         self._scroll_size = self._config.get('scroll_size', 1000)
@@ -20,6 +25,22 @@ class ElasticSearchExtractor(Extractor):
         self._output_folder = self._config.get(
             'output_folder', "./" + str(uuid.uuid4())[:8])
         self._type_cast = self._config.get('type_cast', {})
+        self._splits_per_worker = self._config.get('splits_per_worker', 1)
+        self._engine = self._config.get('engine', 'scroll')
+        self._sort_field = self._config.get('sort_field')
+        self._point_in_time = self._config.get('point_in_time', False)
+        self._prefetch_pages = self._config.get('prefetch_pages', 1)
+        self._serializer = self._config.get('serializer', 'auto')
+        self._client_options = {
+            _option: self._config[_option]
+            for _option in helper.CLIENT_OPTIONS if _option in self._config}
+        self._time_field = self._config.get('time_field')
+        self._start_time = self._config.get('start_time')
+        self._end_time = self._config.get('end_time')
+        self._daily_index = self._config.get('daily_index')
+        self._no_of_time_splits = self._config.get(
+            'no_of_time_splits',
+            self._no_of_workers * self._splits_per_worker)
 
     def validate_config(self):
         """Validates required configs for Elasticsearch extraction
@@ -29,41 +50,188 @@ class ElasticSearchExtractor(Extractor):
             raise MissingConfigError('url', _es_root_name)
         if 'index' not in self._config:
             raise MissingConfigError('index', _es_root_name)
+        if self._engine not in ('scroll', 'search_after'):
+            raise InvalidConfigError(
+                'engine', _es_root_name,
+                'should be one of scroll or search_after')
+        if self._engine == 'search_after' and not self._point_in_time:
+            if not self._sort_field:
+                raise MissingConfigError('sort_field', _es_root_name)
+            if self._no_of_slices() > 1 and not self._time_field:
+                raise InvalidConfigError(
+                    'no_of_workers', _es_root_name,
+                    'sliced search_after needs point_in_time')
+        if self._prefetch_pages not in (0, 1, 2, 3):
+            raise InvalidConfigError(
+                'prefetch_pages', _es_root_name, 'should be between 0 and 3')
+        if self._serializer not in serializer.SERIALIZERS:
+            raise InvalidConfigError(
+                'serializer', _es_root_name,
+                'should be one of ' + ', '.join(serializer.SERIALIZERS))
+        if not serializer.is_available(self._serializer):
+            raise InvalidConfigError(
+                'serializer', _es_root_name,
+                '{} is not installed'.format(self._serializer))
+        if self._client_options.get('pool_size', 1) < 1:
+            raise InvalidConfigError(
+                'pool_size', _es_root_name, 'should be at least 1')
+        self._validate_time_config(_es_root_name)
+        if self.is_incremental and 'watermark_state' not in self._config:
+            raise MissingConfigError('watermark_state', _es_root_name)
+        self._validate_parquet_config()
+        self._validate_retry_config(_es_root_name)
         return None
 
-    def extract_to_parquet(self):
-        if self._no_of_workers > 1:
-            _async_worker = async_worker.AsyncWorker(
-                self._no_of_workers)
-            for i in range(self._no_of_workers):
-                _async_worker.send_data_to_worker(
-                    worker_id=i,
-                    **self._get_extract_job_fn_and_params()
-                )
-            logging.debug('Waiting for Extractor job results...')
-            return _async_worker.get_job_results()
+    def _validate_time_config(self, root_name):
+        if not self._time_field:
+            for _config in ('start_time', 'end_time', 'daily_index'):
+                if _config in self._config:
+                    raise MissingConfigError('time_field', root_name)
+            return
+        if self._daily_index and self._point_in_time:
+            raise InvalidConfigError(
+                'daily_index', root_name,
+                "point_in_time searches can't target daily indices")
+        if self._no_of_time_splits < 1:
+            raise InvalidConfigError(
+                'no_of_time_splits', root_name, 'should be at least 1')
+        if self._start_time and self._end_time and \
+                _to_datetime(self._start_time) >= \
+                _to_datetime(self._end_time):
+            raise InvalidConfigError(
+                'start_time', root_name, 'should be before end_time')
+
+    def extract_to_parquet(self, output_queue=None, storage_write_table=None):
+        _no_of_slices = self._no_of_slices()
+        _params = self._get_extract_job_fn_and_params(_no_of_slices)
+        _pit_id = None
+        if self._engine == 'search_after' and self._point_in_time:
+            # One point-in-time shared by all the slices
+            _pit_id = search_after.open_point_in_time(
+                self._config['url'], self._config['index'], self._timeout,
+                **self._client_options_arg())
+            _params['pit_id'] = _pit_id
+        try:
+            if self._time_field:
+                jobs = self._time_range_jobs(_params)
+            else:
+                # Each slice gets its own search_args, slicing is added
+                jobs = [dict(_params, search_args=copy.deepcopy(
+                             _params['search_args']))
+                        for _ in range(_no_of_slices)]
+            results = self._execute_jobs(
+                self._no_of_workers, jobs, output_queue=output_queue,
+                storage_write_table=storage_write_table)
+        finally:
+            if _pit_id:
+                search_after.close_point_in_time(
+                    self._config['url'], _pit_id,
+                    **self._client_options_arg())
+        return [_file for _files in results for _file in _files]
+
+    def _time_range_jobs(self, params):
+        """A job per time range of time_field, instead of slices
+
+        Splits the start_time to end_time window, the whole time range
+        of the index if not given, into no_of_time_splits ranges, or
+        into days with daily_index.
+        """
+        _start, _end = self._time_window()
+        if _start is None:
+            return []
+        if self._daily_index:
+            _ranges = []
+            _day = _start.replace(hour=0, minute=0, second=0, microsecond=0)
+            while _day < _end:
+                _next_day = _day + timedelta(days=1)
+                _ranges.append((_day.strftime(self._daily_index),
+                                max(_day, _start), min(_next_day, _end)))
+                _day = _next_day
         else:
-            args = self._get_extract_job_fn_and_params()
-            del args['worker_callback']
-            res = helper.ESHelper.scroll_and_extract_data(
-                worker_id=0,
-                **args
-            )
-            return [res]
-
-    def _get_extract_job_fn_and_params(self):
+            _ranges = [
+                (self._config['index'], _split['start'],
+                 min(_split['end'], _end))
+                for _split in math_util.calculate_splits(
+                    _start, _end, self._no_of_time_splits)
+                if _split['start'] < _end]
+        return [dict(params, total_worker_count=1,
+                     search_args=self._range_search_args(
+                         params['search_args'], _index, _range_start,
+                         _range_end))
+                for _index, _range_start, _range_end in _ranges]
+
+    def _time_window(self):
+        # start_time is inclusive and end_time exclusive
+        _start = _to_datetime(self._start_time)
+        _end = _to_datetime(self._end_time)
+        if _start is None or _end is None:
+            _min, _max = helper.ESHelper.get_time_range(
+                self._config['url'], self._config['index'], self._time_field,
+                **self._client_options_arg())
+            if _min is None:
+                return None, None
+            _start = _start or _min
+            # ES dates are in milliseconds
+            _end = _end or _max + timedelta(milliseconds=1)
+        return _start, _end
+
+    def _range_search_args(self, search_args, index, start, end):
+        search_args = copy.deepcopy(search_args)
+        search_args['index'] = index
+        if self._daily_index:
+            # Days without an index have no data
+            search_args['ignore_unavailable'] = True
+        search_args['body']['query'] = {'bool': {'filter': [
+            search_args['body']['query'],
+            {'range': {self._time_field: {
+                'gte': _epoch_millis(start), 'lt': _epoch_millis(end),
+                'format': 'epoch_millis'}}}]}}
+        return search_args
+
+    def _get_max_watermark(self, after):
+        return helper.ESHelper.get_max_value(
+            self._config['url'], self._config['index'],
+            self._watermark_field, self._watermark_query(after, None),
+            **self._client_options_arg())
+
+    def _watermark_query(self, after, up_to):
+        _range = {}
+        if after is not None:
+            _range['gt'] = after
+        if up_to is not None:
+            _range['lte'] = up_to
+        if not _range:
+            return {'match_all': {}}
+        return {'range': {self._watermark_field: _range}}
+
+    def _client_options_arg(self):
+        if self._client_options:
+            return dict(client_options=self._client_options)
+        return {}
+
+    def _no_of_slices(self):
+        if self._no_of_workers > 1:
+            return self._no_of_workers * self._splits_per_worker
+        return 1
+
+    def _get_extract_job_fn_and_params(self, no_of_slices):
         search_args = dict(
             index=self._config['index'],
             scroll=self._timeout,
             size=self._scroll_size,
+            filter_path=helper.SCROLL_FILTER_PATH,
             body={
                 'query': {
                     'match_all': {}
                 }
             }
         )
+        if self._next_watermark is not None:
+            search_args['body']['query'] = self._watermark_query(
+                self._last_watermark, self._next_watermark)
         _fields = helper.ESHelper.get_fields(
-            self._config['url'], self._config['index'])
+            self._config['url'], self._config['index'],
+            **self._client_options_arg())
         if '_all' not in self._fields:
             search_args['_source_include'] = ','.join(
                 self._fields)
@@ -76,13 +244,38 @@ class ElasticSearchExtractor(Extractor):
             schema = _fields
         fn_params = dict(
             worker_callback=helper.ESHelper.scroll_and_extract_data,
-            total_worker_count=self._no_of_workers,
+            total_worker_count=no_of_slices,
             es_hosts=self._config['url'],
             es_timeout=self._timeout,
             output_folder=self._output_folder,
             search_args=search_args,
             fields=schema,
-            type_cast=self._type_cast)
+            type_cast=self._type_cast,
+            **self._file_rolling_params(),
+            **self._writer_options_params(),
+            **self._client_options_arg())
         if "datetime_format" in self._config:
             fn_params["datetime_format"] = self._config["datetime_format"]
+        if "prefetch_pages" in self._config:
+            fn_params["prefetch_pages"] = self._prefetch_pages
+        if "serializer" in self._config:
+            fn_params["serializer"] = self._serializer
+        if self._engine == 'search_after':
+            fn_params['worker_callback'] = \
+                search_after.search_after_and_extract_data
+            fn_params['sort_field'] = self._sort_field
         return fn_params
+
+
+def _to_datetime(value):
+    # Naive UTC datetime of a TOML datetime or a date string
+    if value is None:
+        return None
+    _timestamp = pd.Timestamp(value)
+    if _timestamp.tzinfo is not None:
+        _timestamp = _timestamp.tz_convert('UTC').tz_localize(None)
+    return _timestamp.to_pydatetime()
+
+
+def _epoch_millis(value):
+    return (value - _EPOCH) // timedelta(milliseconds=1)
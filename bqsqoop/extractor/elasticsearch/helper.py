@@ -1,80 +1,314 @@
 import os
 import uuid
+import queue
+import logging
+import threading
 import elasticsearch
-import pandas as pd
 
-from bqsqoop.utils import parquet_util
+from datetime import datetime, timedelta
+from bqsqoop.utils import arrow_util, parquet_util
 from bqsqoop.utils.progressbar_util import ProgressBar
+from bqsqoop.extractor.elasticsearch import serializer as es_serializer
+
+
+_EPOCH = datetime(1970, 1, 1)
+# Marks the end of the prefetched pages
+_END_OF_PAGES = object()
+# Only the parts of scroll responses the extract reads
+SCROLL_FILTER_PATH = 'hits.hits._source,_scroll_id,hits.total'
+# Client options of the ES connections, see `ESHelper._get_es_client`
+CLIENT_OPTIONS = ('pool_size', 'http_compress', 'keep_alive', 'sniff')
+# Cached clients of this process, by pid as forked workers can't share
+# the parent's connections.
+_es_clients = {}
+_es_clients_lock = threading.Lock()
 
 
 class ESHelper():
     @classmethod
-    def get_fields(self, es_hosts, index):
-        _es = self._get_es_client(es_hosts)
+    def get_fields(self, es_hosts, index, client_options=None):
+        _es = self._get_es_client(es_hosts, client_options=client_options)
         _mappings = _es.indices.get_mapping(
             index=index
         )
         _fields = {}
         for index, value in _mappings.items():
             index_mappings = value['mappings']
+            if 'properties' in index_mappings:
+                # Typeless mappings of ES 7+
+                index_mappings = {index: index_mappings}
             for _, index_type_value in index_mappings.items():
-                _properties = index_type_value['properties']
-                _keys = list(_properties.keys())
-                for _key in _keys:
-                    if "type" in _properties[_key]:
-                        _fields[_key] = _properties[_key]["type"]
+                _fields.update(self._get_property_types(
+                    index_type_value['properties']))
                 break
         return _fields
 
+    @classmethod
+    def get_time_range(self, es_hosts, index, time_field,
+                       client_options=None):
+        """Min and max values of a date field
+
+        Returns: (tuple of datetime)
+            Naive UTC datetimes, (None, None) if there's no data
+        """
+        _es = self._get_es_client(es_hosts, client_options=client_options)
+        _page = _es.search(index=index, size=0, body={'aggs': {
+            'min_time': {'min': {'field': time_field}},
+            'max_time': {'max': {'field': time_field}}}})
+        _aggs = _page['aggregations']
+        if _aggs['min_time']['value'] is None:
+            return None, None
+        # Date aggregations are in epoch millis
+        return tuple(
+            _EPOCH + timedelta(milliseconds=_aggs[_agg]['value'])
+            for _agg in ('min_time', 'max_time'))
+
+    @classmethod
+    def get_max_value(self, es_hosts, index, field, query,
+                      client_options=None):
+        """Max value of a field in the documents matching the query
+
+        Returns:
+            Dates in the field's format, numbers as is, None if no
+            document matches
+        """
+        _es = self._get_es_client(es_hosts, client_options=client_options)
+        _page = _es.search(index=index, size=0, body={
+            'query': query, 'aggs': {'max_value': {'max': {'field': field}}}})
+        _max = _page['aggregations']['max_value']
+        if _max['value'] is None:
+            return None
+        if 'value_as_string' in _max:
+            return _max['value_as_string']
+        if float(_max['value']).is_integer():
+            return int(_max['value'])
+        return _max['value']
+
+    @classmethod
+    def _get_property_types(self, properties):
+        # object and nested fields are a list of a dict of their
+        # properties' types, see `ParquetUtil.build_pyarrow_schema`. ES
+        # lets object fields hold an array of objects too, a single
+        # object is read as a list of one.
+        _types = {}
+        for _key, _property in properties.items():
+            if _property.get('properties'):
+                _types[_key] = [self._get_property_types(
+                    _property['properties'])]
+            elif "type" in _property:
+                _types[_key] = _property["type"]
+        return _types
+
     @classmethod
     def scroll_and_extract_data(self, worker_id, total_worker_count, es_hosts,
                                 es_timeout, search_args, fields,
                                 output_folder, progress_bar=True,
                                 datetime_format="%Y-%m-%dT%H:%M:%S",
-                                type_cast={}):
-        _es = self._get_es_client(es_hosts)
+                                type_cast={}, output_queue=None,
+                                max_file_bytes=None, max_file_rows=None,
+                                prefetch_pages=1, serializer='auto',
+                                client_options=None, writer_options=None,
+                                storage_write_table=None):
+        _es = self._get_es_client(
+            es_hosts, serializer=serializer, client_options=client_options)
         search_args = self._add_slice_if_needed(
             total_worker_count, search_args, worker_id)
         _output_file = self._output_file_for(
             output_folder, search_args['index'])
-        _page = _es.search(**search_args)
-        _data, _sid = self._get_data_from_es_page(_page)
-        _total_hits = self._get_total_hits(_page)
-        _parquetUtil = parquet_util.ParquetUtil(_output_file)
-        _pbar = ProgressBar(
-            total_length=_total_hits, position=worker_id, enabled=progress_bar)
-        if _data:
-            schema = _parquetUtil.build_pyarrow_schema(fields)
-            self._write_data(_data, fields, _parquetUtil,
-                             _pbar, datetime_format, type_cast, schema)
+        _pages = self.prefetch_pages(
+            self._scroll_pages(_es, search_args, es_timeout), prefetch_pages)
+        return self.write_pages_to_parquet(
+            _pages, worker_id, fields, _output_file,
+            progress_bar=progress_bar, datetime_format=datetime_format,
+            type_cast=type_cast, output_queue=output_queue,
+            max_file_bytes=max_file_bytes, max_file_rows=max_file_rows,
+            writer_options=writer_options,
+            storage_write_table=storage_write_table)
+
+    @classmethod
+    def write_pages_to_parquet(self, pages, worker_id, fields, output_file,
+                               progress_bar=True,
+                               datetime_format="%Y-%m-%dT%H:%M:%S",
+                               type_cast={}, output_queue=None,
+                               max_file_bytes=None, max_file_rows=None,
+                               writer_options=None, storage_write_table=None):
+        """Writes the hits of ES search pages to parquet files
+
+        Stops at the first page without hits.
+
+        Args:
+            pages (iterable of dict): ES search responses, the first
+                one's total hits sizes the progress bar.
+            worker_id (int): Position of the worker's progress bar
+            fields (dict): ES field types by name, see `get_fields`
+            output_file (str): Parquet file path, see `ParquetUtil`
+            type_cast (dict): Field types by name, overriding the
+                mapping's types in `fields`
+            storage_write_table (str, optional): Writes to this table
+                with the Storage Write API instead, see `ParquetUtil`
+
+        Returns: (list of str)
+            The written parquet files, or the write stream with
+            storage_write_table
+        """
+        _parquetUtil = parquet_util.ParquetUtil(
+            output_file, output_queue=output_queue,
+            max_file_bytes=max_file_bytes, max_file_rows=max_file_rows,
+            writer_options=writer_options,
+            storage_write_table=storage_write_table)
+        _pbar = None
+        schema = None
+        for _page in pages:
+            if _pbar is None:
+                _pbar = ProgressBar(
+                    total_length=self._get_total_hits(_page),
+                    position=worker_id, enabled=progress_bar)
+            _data = self._get_rows_from_es_page(_page)
+            if not _data:
+                break
+            if schema is None:
+                schema = _parquetUtil.build_pyarrow_schema(
+                    self._cast_fields(fields, type_cast))
+            self._write_data(_data, fields, _parquetUtil, _pbar,
+                             datetime_format, type_cast, schema)
+        return _parquetUtil.close()
+
+    @classmethod
+    def prefetch_pages(self, pages, depth=1):
+        """Fetches pages ahead on a background thread
+
+        The next pages are fetched while the current one is written,
+        which hides the ES round trips behind the parquet conversion.
+        Errors while fetching are raised from the returned iterator.
+
+        Args:
+            pages (iterable of dict): ES search responses, iterated on
+                the background thread.
+            depth (int): Max no of fetched pages waiting to be written,
+                pages are fetched on the caller's thread if 0.
+
+        Returns: (iterable of dict)
+        """
+        if not depth:
+            return pages
+        return self._prefetched(iter(pages), depth)
+
+    @classmethod
+    def _prefetched(self, pages, depth):
+        _queue = queue.Queue(maxsize=depth)
+        _stop = threading.Event()
+
+        def _put(item):
+            while not _stop.is_set():
+                try:
+                    _queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _fetch():
+            try:
+                for _page in pages:
+                    if not _put(_page):
+                        return
+                _put(_END_OF_PAGES)
+            except Exception as exc:
+                _put(exc)
+
+        _thread = threading.Thread(target=_fetch, daemon=True)
+        _thread.start()
+        try:
             while True:
-                _page = _es.scroll(scroll_id=_sid, scroll=es_timeout)
-                _data, _sid = self._get_data_from_es_page(_page)
-                if _data:
-                    self._write_data(_data, fields, _parquetUtil, _pbar,
-                                     datetime_format, type_cast, schema)
-                else:
-                    break
-        _parquetUtil.close()
-        return _output_file
+                _item = _queue.get()
+                if _item is _END_OF_PAGES:
+                    return
+                if isinstance(_item, Exception):
+                    raise _item
+                yield _item
+        finally:
+            # Unblocks the fetching thread if the writer stopped early
+            _stop.set()
+            _thread.join()
+
+    @classmethod
+    def _scroll_pages(self, es, search_args, es_timeout):
+        _page = es.search(**search_args)
+        while True:
+            yield _page
+            _sid = _page.get('_scroll_id')
+            if not _sid or not self._get_rows_from_es_page(_page):
+                return
+            _page = es.scroll(scroll_id=_sid, scroll=es_timeout,
+                              **self._filter_path_arg(search_args))
 
     @classmethod
     def _write_data(self, data, fields, parquetUtil, pbar, datetime_format,
                     type_cast, schema):
-        df = pd.DataFrame.from_dict(data)
-        df = parquet_util.ParquetUtil.fix_dataframe_for_schema(
-            df, schema, datetime_format=datetime_format)
-        parquetUtil.append_df_to_parquet(df, schema=schema)
+        parquetUtil.append_table_to_parquet(arrow_util.records_to_table(
+            data, schema, datetime_format=datetime_format))
         pbar.move_progress(len(data))
 
+    @classmethod
+    def _cast_fields(self, fields, type_cast):
+        # type_cast overrides the mapping's type of the extracted fields
+        return dict(fields, **{
+            _field: _type for _field, _type in type_cast.items()
+            if _field in fields})
+
     @classmethod
     def _output_file_for(self, output_folder, index):
         return os.path.join(output_folder, '{}_{}.parq'.format(
             index, str(uuid.uuid4())[:8]))
 
     @classmethod
-    def _get_es_client(self, es_hosts):
-        return elasticsearch.Elasticsearch(es_hosts)
+    def _get_es_client(self, es_hosts, serializer='auto',
+                       client_options=None):
+        """A client shared by all the slices run in this process
+
+        Args:
+            es_hosts (str or list): ES hosts
+            serializer (str): Response decoder, see `es_serializer`
+            client_options (dict, optional): Connection options,
+                pool_size (int): Connections kept per host, default 10
+                http_compress (bool): gzip requests and responses,
+                    default True
+                keep_alive (bool): Reuse connections, default True
+                sniff (bool): Discover the cluster's nodes on start and
+                    on connection failures, default False
+
+        Returns: (elasticsearch.Elasticsearch)
+        """
+        _options = dict(pool_size=10, http_compress=True, keep_alive=True,
+                        sniff=False)
+        _options.update(client_options or {})
+        _key = (os.getpid(), str(es_hosts), serializer,
+                tuple(sorted(_options.items())))
+        with _es_clients_lock:
+            if _key not in _es_clients:
+                logging.debug("New ES client for {}".format(es_hosts))
+                _es_clients[_key] = self._new_es_client(
+                    es_hosts, serializer, **_options)
+            return _es_clients[_key]
+
+    @classmethod
+    def _new_es_client(self, es_hosts, serializer, pool_size, http_compress,
+                       keep_alive, sniff):
+        _kwargs = dict(
+            serializer=es_serializer.get_serializer(serializer),
+            maxsize=pool_size, http_compress=http_compress)
+        if not keep_alive:
+            _kwargs['headers'] = {'Connection': 'close'}
+        if sniff:
+            _kwargs.update(sniff_on_start=True, sniff_on_connection_fail=True,
+                           sniffer_timeout=60)
+        return elasticsearch.Elasticsearch(es_hosts, **_kwargs)
+
+    @classmethod
+    def _filter_path_arg(self, search_args):
+        if 'filter_path' in search_args:
+            return dict(filter_path=search_args['filter_path'])
+        return {}
 
     @classmethod
     def _add_slice_if_needed(self, total_worker_count, search_args, worker_id):
@@ -87,17 +321,19 @@ class ESHelper():
         return search_args
 
     @classmethod
-    def _get_data_from_es_page(self, _page):
+    def _get_rows_from_es_page(self, _page):
         if 'hits' in _page and 'hits' in _page['hits']:
-            _data = _page['hits']['hits']
-            if _data:
-                _rows = [_datumn['_source'] for _datumn in _data]
-                _sid = _page['_scroll_id']
-                return _rows, _sid
-        return None, None
+            # Documents without any of the fields have no _source
+            return [_datumn.get('_source', {})
+                    for _datumn in _page['hits']['hits']]
+        return None
 
     @classmethod
     def _get_total_hits(self, _page):
         if 'hits' in _page and 'total' in _page['hits']:
-            return _page['hits']['total']
+            _total = _page['hits']['total']
+            # ES 7+ reports {"value": <count>, "relation": "eq"}
+            if isinstance(_total, dict):
+                return _total.get('value', 0)
+            return _total
         return 0
@@ -0,0 +1,116 @@
+"""Elasticsearch search_after based extraction
+
+Pages through an index sorted on a tiebreaker field with `search_after`,
+instead of keeping scroll contexts open on the cluster for the whole
+extract. Pages can be anchored to a point-in-time (ES 7.10+), which
+gives every page and slice the same view of the index and is needed for
+sliced searches.
+"""
+from bqsqoop.extractor.elasticsearch.helper import ESHelper
+
+
+# Sort used with a point-in-time when no sort_field is given, ES adds
+# its own _shard_doc tiebreaker to point-in-time searches.
+_PIT_SORT_FIELD = '_doc'
+# Only the parts of search responses the extract reads
+_FILTER_PATH = 'hits.hits._source,hits.hits.sort,hits.total,pit_id'
+
+
+def open_point_in_time(es_hosts, index, keep_alive, client_options=None):
+    """Opens a point-in-time on the index
+
+    The 6.x elasticsearch client has no point-in-time helpers, so the
+    REST endpoint is called through the client's transport.
+
+    Returns: (str)
+        The point-in-time id
+    """
+    _es = ESHelper._get_es_client(es_hosts, client_options=client_options)
+    _response = _es.transport.perform_request(
+        'POST', '/{}/_pit'.format(index), params={'keep_alive': keep_alive})
+    return _response['id']
+
+
+def close_point_in_time(es_hosts, pit_id, client_options=None):
+    _es = ESHelper._get_es_client(es_hosts, client_options=client_options)
+    _es.transport.perform_request('DELETE', '/_pit', body={'id': pit_id})
+
+
+def search_after_and_extract_data(worker_id, total_worker_count, es_hosts,
+                                  es_timeout, search_args, fields,
+                                  output_folder, sort_field=None,
+                                  pit_id=None, progress_bar=True,
+                                  datetime_format="%Y-%m-%dT%H:%M:%S",
+                                  type_cast={}, output_queue=None,
+                                  max_file_bytes=None, max_file_rows=None,
+                                  prefetch_pages=1, serializer='auto',
+                                  client_options=None, writer_options=None,
+                                  storage_write_table=None):
+    """Extracts a slice of the index to parquet with search_after
+
+    Args:
+        search_args (dict): Same search args as the scroll engine, the
+            scroll arg is dropped.
+        sort_field (str, optional): Field to page on, needs to be unique
+            per document unless pit_id is given. Defaults to _doc with a
+            point-in-time.
+        pit_id (str, optional): Point-in-time to search, see
+            `open_point_in_time`. Required for more than one slice.
+        prefetch_pages (int): Pages fetched ahead while writing, see
+            `ESHelper.prefetch_pages`
+        serializer (str): Response decoder, see `serializer.SERIALIZERS`
+        client_options (dict, optional): See `ESHelper._get_es_client`
+        writer_options (dict, optional): See `ParquetUtil`
+        storage_write_table (str, optional): See `ParquetUtil`
+
+    Returns: (list of str)
+        The written parquet files
+    """
+    _es = ESHelper._get_es_client(
+        es_hosts, serializer=serializer, client_options=client_options)
+    _output_file = ESHelper._output_file_for(
+        output_folder, search_args['index'])
+    search_args = _search_after_args(
+        search_args, sort_field, pit_id, es_timeout)
+    search_args = ESHelper._add_slice_if_needed(
+        total_worker_count, search_args, worker_id)
+    _pages = ESHelper.prefetch_pages(
+        _search_after_pages(_es, search_args), prefetch_pages)
+    return ESHelper.write_pages_to_parquet(
+        _pages, worker_id, fields, _output_file,
+        progress_bar=progress_bar, datetime_format=datetime_format,
+        type_cast=type_cast, output_queue=output_queue,
+        max_file_bytes=max_file_bytes, max_file_rows=max_file_rows,
+        writer_options=writer_options,
+        storage_write_table=storage_write_table)
+
+
+def _search_after_args(search_args, sort_field, pit_id, keep_alive):
+    search_args = dict(search_args, body=dict(search_args.get('body', {})))
+    search_args.pop('scroll', None)
+    if 'filter_path' in search_args:
+        search_args['filter_path'] = _FILTER_PATH
+    if '_source_include' in search_args:
+        # ES 7+ dropped the singular form, the plural works since 6.6
+        search_args['_source_includes'] = search_args.pop('_source_include')
+    search_args['body']['sort'] = [
+        {sort_field or _PIT_SORT_FIELD: 'asc'}]
+    if pit_id:
+        # Point-in-time searches can't name an index
+        search_args.pop('index', None)
+        search_args['body']['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+    return search_args
+
+
+def _search_after_pages(es, search_args):
+    _size = search_args.get('size')
+    while True:
+        _page = es.search(**search_args)
+        yield _page
+        _hits = _page.get('hits', {}).get('hits')
+        if not _hits or (_size and len(_hits) < _size):
+            return
+        search_args['body']['search_after'] = _hits[-1]['sort']
+        if 'pit' in search_args['body'] and _page.get('pit_id'):
+            # The point-in-time id can change between pages
+            search_args['body']['pit']['id'] = _page['pit_id']
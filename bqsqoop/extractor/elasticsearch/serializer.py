@@ -0,0 +1,75 @@
+"""Fast JSON decoding of Elasticsearch responses
+
+Decoding large search pages with the stdlib json module takes a good
+part of the extract time. `FastJSONSerializer` decodes responses with
+orjson or ujson when one is installed, requests are still encoded by
+the client's default serializer as they are small.
+"""
+import gc
+import json
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+SERIALIZERS = ('auto', 'orjson', 'ujson', 'json')
+_DECODERS = {
+    'orjson': orjson.loads if orjson else None,
+    'ujson': ujson.loads if ujson else None,
+    'json': json.loads,
+}
+
+
+def is_available(name):
+    """Checks if the named serializer's library is installed
+    """
+    if name == 'auto':
+        return True
+    return _DECODERS.get(name) is not None
+
+
+def get_serializer(name='auto'):
+    """Creates the serializer for the ES client
+
+    Args:
+        name (str): One of `SERIALIZERS`, auto picks the fastest
+            installed decoder.
+
+    Returns: (elasticsearch.serializer.JSONSerializer)
+    """
+    if name == 'auto':
+        name = next(_name for _name in ('orjson', 'ujson', 'json')
+                    if is_available(_name))
+    if not is_available(name):
+        raise ValueError("{} is not installed".format(name))
+    return FastJSONSerializer(_DECODERS[name])
+
+
+class FastJSONSerializer(JSONSerializer):
+    def __init__(self, loads):
+        self._loads = loads
+
+    def loads(self, s):
+        # A page decodes to lots of new containers, which trigger garbage
+        # collections that can take longer than the decoding. Responses
+        # have no reference cycles, so collection is paused meanwhile.
+        _gc_enabled = gc.isenabled()
+        if _gc_enabled:
+            gc.disable()
+        try:
+            return self._loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+        finally:
+            if _gc_enabled:
+                gc.enable()
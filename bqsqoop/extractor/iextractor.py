@@ -1,4 +1,10 @@
+import logging
+
 from abc import ABC, abstractmethod
+from bqsqoop.utils import async_worker, parquet_util, retry
+from bqsqoop.utils.checkpoint import Manifest
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
+from bqsqoop.utils.watermark import WatermarkState
 
 
 class Extractor(ABC):
@@ -9,10 +15,19 @@ class Extractor(ABC):
 
     Args:
         _config: Extractor sub-config of the Sqoop Job
+        parquet_config (dict, optional): The Job's parquet section,
+            writer options of the extracted files, see `ParquetUtil`
     """
 
-    def __init__(self, _config):
+    def __init__(self, _config, parquet_config=None):
         self._config = _config
+        self._parquet_config = parquet_config or {}
+        self._watermark_field = self._config.get('watermark_field')
+        self._last_watermark = self._next_watermark = None
+        self._checkpoint_file = self._config.get('checkpoint_file')
+        self._retry_policy = retry.RetryPolicy(
+            max_attempts=self._config.get('max_retries', 0) + 1,
+            backoff_secs=self._config.get('retry_backoff_secs', 1))
         super().__init__()
 
     @abstractmethod
@@ -25,10 +40,199 @@ class Extractor(ABC):
         return False    # pragma: no cover
 
     @abstractmethod
-    def extract_to_parquet(self):
+    def extract_to_parquet(self, output_queue=None, storage_write_table=None):
         """Extracts data from source to parquet files
 
+        Args:
+            output_queue (FileQueue, optional): If given, each file is
+                put on it as soon as it's written, see
+                `bqsqoop.utils.file_queue`
+            storage_write_table (str, optional): If given, data is
+                appended to this table with the Storage Write API instead
+                of written to files, see `bqsqoop.utils.gcloud.storage_write`
+
         Returns:
-            List of all extracted full file path.
+            List of all extracted full file path, or the pending write
+            streams to commit with storage_write_table.
         """
         return []   # pragma: no cover
+
+    @property
+    def is_incremental(self):
+        """Whether only the rows after the last watermark are extracted
+
+        Set with the `watermark_field` and `watermark_state` configs.
+        """
+        return bool(self._watermark_field)
+
+    def prepare_increment(self):
+        """Finds the rows to extract in incremental mode
+
+        The extract then covers rows with watermark_field greater than
+        the saved watermark, up to its current max value, so rows added
+        meanwhile are left for the next run.
+
+        Returns: (bool)
+            False if there are no new rows
+        """
+        self._last_watermark = self._watermark_state().read()
+        self._next_watermark = self._get_max_watermark(self._last_watermark)
+        logging.info("Extracting {0} after {1} up to {2}".format(
+            self._watermark_field, self._last_watermark,
+            self._next_watermark))
+        return self._next_watermark is not None
+
+    def save_watermark(self):
+        """Saves the extracted increment's max, call after it's loaded
+        """
+        if self._next_watermark is not None:
+            self._watermark_state().save(self._next_watermark)
+
+    def _get_max_watermark(self, after):
+        """Implement for incremental extracts
+
+        Returns:
+            Max value of the watermark field greater than after, which
+            is None on the first run. None if there's no such row.
+        """
+        raise NotImplementedError(   # pragma: no cover
+            "{} doesn't support incremental extracts".format(
+                type(self).__name__))
+
+    def _watermark_state(self):
+        return WatermarkState(
+            self._config['watermark_state'], self._watermark_field)
+
+    def _file_rolling_params(self):
+        """Worker params for splitting output into part files
+
+        From the optional `max_file_size_mb` and `max_file_rows` configs,
+        see `ParquetUtil`.
+        """
+        params = {}
+        if self._config.get('max_file_size_mb'):
+            params['max_file_bytes'] = int(
+                self._config['max_file_size_mb'] * 1024 * 1024)
+        if self._config.get('max_file_rows'):
+            params['max_file_rows'] = self._config['max_file_rows']
+        return params
+
+    @property
+    def is_checkpointed(self):
+        """Whether finished splits are skipped on a rerun
+
+        Set with the `checkpoint_file` config.
+        """
+        return bool(self._checkpoint_file)
+
+    @property
+    def is_retried(self):
+        """Whether failed splits are extracted again
+
+        Set with the `max_retries` config.
+        """
+        return self._retry_policy.max_attempts > 1
+
+    def clear_checkpoint(self):
+        """Removes the split checkpoints, call once the extract is loaded
+        """
+        if self._checkpoint_file:
+            Manifest(self._checkpoint_file, self._config).remove()
+
+    def _writer_options_params(self):
+        """Worker params for the parquet writer options, if any
+        """
+        if self._parquet_config:
+            return dict(writer_options=dict(self._parquet_config))
+        return {}
+
+    def _validate_parquet_config(self):
+        _errors = parquet_util.validate_writer_options(self._parquet_config)
+        for option, reason in _errors.items():
+            raise InvalidConfigError(option, 'Parquet', reason)
+
+    def _validate_retry_config(self, root_name):
+        if self._retry_policy.max_attempts < 1:
+            raise InvalidConfigError(
+                'max_retries', root_name, 'should be at least 0')
+        if self._checkpoint_file and 'output_folder' not in self._config:
+            # Reruns need to find the earlier run's files
+            raise MissingConfigError('output_folder', root_name)
+
+    def _execute_jobs(self, no_of_workers, jobs, output_queue=None,
+                      storage_write_table=None):
+        """Runs extract jobs and returns their results in order
+
+        Args:
+            no_of_workers (int): Size of the process pool, with 1 the
+                jobs are run one after the other in the current process.
+            jobs (list of dict): worker_callback and its params for each
+                job, the job's index is passed as worker_id. Jobs beyond
+                no_of_workers are picked up as workers free up.
+            output_queue (FileQueue, optional): Passed on to each job
+            storage_write_table (str, optional): Passed on to each job
+
+        Failed jobs are retried as per the `max_retries` and
+        `retry_backoff_secs` configs. With `checkpoint_file`, jobs done
+        in an earlier run with the same config are skipped, see
+        `bqsqoop.utils.checkpoint.Manifest`.
+
+        Returns:
+            List of each job's result
+        """
+        _manifest = None
+        results = [None] * len(jobs)
+        _pending = list(range(len(jobs)))
+        if self._checkpoint_file:
+            _manifest = Manifest(self._checkpoint_file, self._config)
+            for i, job in enumerate(jobs):
+                results[i] = _manifest.completed_files(i, job)
+            _pending = [i for i in _pending if results[i] is None]
+            logging.info("Resuming from {0}, {1}/{2} splits done".format(
+                self._checkpoint_file, len(jobs) - len(_pending), len(jobs)))
+
+        def _on_result(i, result):
+            if isinstance(result, Exception):
+                _manifest.mark_failed(i, jobs[i])
+            else:
+                results[i] = result
+                _manifest.mark_done(i, jobs[i], result)
+
+        _jobs = {}
+        for i in _pending:
+            job = dict(jobs[i])
+            if output_queue is not None:
+                job['output_queue'] = output_queue
+            if storage_write_table is not None:
+                job['storage_write_table'] = storage_write_table
+            _jobs[i] = job
+        if no_of_workers > 1:
+            _worker_params = {}
+            if self._retry_policy.max_attempts > 1:
+                _worker_params['retry_policy'] = self._retry_policy
+            _async_worker = async_worker.AsyncWorker(
+                no_of_workers, **_worker_params)
+            for i, job in _jobs.items():
+                _async_worker.send_data_to_worker(worker_id=i, **job)
+            logging.debug('Waiting for Extractor job results...')
+            if _manifest:
+                _results = _async_worker.get_job_results(
+                    on_result=_on_result)
+            else:
+                return _async_worker.get_job_results()
+            for i, result in zip(_jobs, _results):
+                results[i] = result
+            return results
+        for i, job in _jobs.items():
+            args = dict(job)
+            worker_callback = args.pop('worker_callback')
+            try:
+                results[i] = retry.call_with_retries(
+                    self._retry_policy, worker_callback, worker_id=i, **args)
+            except Exception as exc:
+                if _manifest:
+                    _on_result(i, exc)
+                raise
+            if _manifest:
+                _on_result(i, results[i])
+        return results
@@ -6,9 +6,10 @@ import logging
 import traceback
 import sqlalchemy
 import pandas as pd
+import pyarrow as pa
 
 from datetime import datetime
-from bqsqoop.utils import parquet_util
+from bqsqoop.utils import arrow_util, parquet_util
 
 
 def get_results_cursor(sql_bind, query, pool_timeout=300):
@@ -35,51 +36,184 @@ def get_table_schema(sql_bind, table_name, pool_timeout=300):
     return table_schema
 
 
+def add_split_filter(query, filter_field, start_pos, end_pos):
+    """Fills the query's `%s` slot with the split's range filter
+
+    Query is returned as is if the split has no range.
+    """
+    if start_pos and end_pos:
+        filter_query = "{0} >= {1} AND {0} <= {2}".format(
+            filter_field, _sql_literal(start_pos), _sql_literal(end_pos))
+        query = query % filter_query
+    return query
+
+
+def _sql_literal(value):
+    if isinstance(value, (int, float)):
+        return value
+    return "'{}'".format(value)
+
+
+# Bounds and starting point for fetch_size="auto"
+MIN_FETCH_SIZE = 100
+MAX_FETCH_SIZE = 100000
+# Rough size of a fetched row as python objects w.r.t its arrow size
+_PY_ROW_OVERHEAD = 4
+# Aim for at least these many fetches per buffered row group
+_FETCHES_PER_ROW_GROUP = 4
+
+
 def export_to_parquet(worker_id, sql_bind, query, filter_field, start_pos,
                       end_pos, output_folder, progress_bar=True,
-                      fetch_size=100, table_schema=None):
+                      fetch_size=100, table_schema=None, columnar=False,
+                      row_group_bytes=None, max_memory_bytes=None,
+                      output_queue=None, max_file_bytes=None,
+                      max_file_rows=None, writer_options=None,
+                      storage_write_table=None):
     try:
         start_time = int(time.time())
         output_file = os.path.join(output_folder, "{}.parq".format(
             str(uuid.uuid4())[:8]))
-        if start_pos and end_pos:
-            filter_query = "{0} >= {1} AND {0} <= {2}".format(
-                filter_field, start_pos, end_pos)
-            query = query % filter_query
-        parquetUtil = parquet_util.ParquetUtil(output_file)
+        query = add_split_filter(query, filter_field, start_pos, end_pos)
+        if max_memory_bytes and row_group_bytes:
+            # Leave room for the in-flight fetch next to the buffer
+            row_group_bytes = min(row_group_bytes, max_memory_bytes // 2)
+        parquetUtil = parquet_util.ParquetUtil(
+            output_file, row_group_bytes=row_group_bytes,
+            output_queue=output_queue, max_file_bytes=max_file_bytes,
+            max_file_rows=max_file_rows, writer_options=writer_options,
+            storage_write_table=storage_write_table)
         parquet_schema = None
         if table_schema:
             parquet_schema = parquetUtil.build_pyarrow_schema(table_schema)
         logging.debug(output_file)
         logging.debug(query)
+        auto_fetch_size = fetch_size == "auto"
+        if auto_fetch_size:
+            fetch_size = MIN_FETCH_SIZE
         proxy = get_streaming_result_proxy(sql_bind, query)
         results = proxy.fetchmany(fetch_size)
         columns = [key[0] for key in proxy.cursor.description]
         while True:
             if results:
-                items = []
-                for row in results:
-                    row_dict = {}
-                    for x, y in zip(columns, row):
-                        row_dict[x] = _data_type_transform(y)
-                    items.append(row_dict)
-                df = pd.DataFrame.from_dict(items)
-                df = parquet_util.ParquetUtil.fix_dataframe_for_schema(
-                    df, parquet_schema)
-                parquetUtil.append_df_to_parquet(df, schema=parquet_schema)
+                if columnar:
+                    parquet_schema = _write_rows_columnar(
+                        results, columns, parquetUtil, parquet_schema)
+                else:
+                    parquet_schema = _write_rows(
+                        results, columns, parquetUtil, parquet_schema)
+                if auto_fetch_size:
+                    fetch_size = _tune_fetch_size(
+                        parquetUtil.bytes_appended /
+                        max(parquetUtil.rows_appended, 1),
+                        row_group_bytes, max_memory_bytes)
                 results = proxy.fetchmany(fetch_size)
             else:
                 break
-        parquetUtil.close()
+        if auto_fetch_size:
+            logging.debug("worker_id: {0}, tuned fetch_size: {1}".format(
+                worker_id, fetch_size))
+        output_files = parquetUtil.close()
         logging.info(
             "Dump -> worker_id: {0}, time_taken: {1} secs".format(
                 worker_id, int(time.time()) - start_time))
-        return output_file
+        return output_files
     except Exception:
         logging.error(traceback.format_exc())
         raise
 
 
+def _tune_fetch_size(row_width, row_group_bytes=None,
+                     max_memory_bytes=None):
+    """Picks a fetch size from the measured arrow width of a row
+
+    A fetch should fill a fraction of the row group buffer and, together
+    with the buffer, stay under max_memory_bytes.
+    """
+    row_width = max(row_width, 1)
+    fetch_bytes = None
+    if row_group_bytes:
+        fetch_bytes = row_group_bytes / _FETCHES_PER_ROW_GROUP
+    if max_memory_bytes:
+        memory_left = max(max_memory_bytes - (row_group_bytes or 0), 0)
+        memory_fetch_bytes = memory_left / _PY_ROW_OVERHEAD
+        fetch_bytes = memory_fetch_bytes if fetch_bytes is None else \
+            min(fetch_bytes, memory_fetch_bytes)
+    if fetch_bytes is None:
+        return MAX_FETCH_SIZE
+    return int(min(max(fetch_bytes / row_width, MIN_FETCH_SIZE),
+                   MAX_FETCH_SIZE))
+
+
+def _write_rows(rows, columns, parquetUtil, parquet_schema):
+    """Writes a fetched batch of rows through a DataFrame
+
+    Same as `_write_rows_columnar`, without a table schema the first
+    batch's schema is returned and used for the rest of the batches.
+    """
+    items = []
+    for row in rows:
+        row_dict = {}
+        for x, y in zip(columns, row):
+            row_dict[x] = _data_type_transform(y)
+        items.append(row_dict)
+    df = pd.DataFrame.from_dict(items)
+    if parquet_schema is None:
+        parquet_schema = arrow_util.stable_schema(
+            arrow_util.table_from_pandas(df).schema)
+    table = arrow_util.table_from_pandas(df, parquet_schema)
+    parquetUtil.append_table_to_parquet(table)
+    return table.schema
+
+
+def _write_rows_columnar(rows, columns, parquetUtil, parquet_schema):
+    """Writes a fetched batch of rows without building per-row dicts
+
+    Transposes the rows into per-column values, applies the type
+    transforms once per column and appends a RecordBatch built against
+    parquet_schema. Without a table schema, the schema inferred from the
+    first batch, widened with `arrow_util.stable_schema`, is returned
+    and used for the rest of the batches.
+    """
+    arrays = []
+    for i, values in enumerate(zip(*rows)):
+        arrow_type = None
+        if parquet_schema is not None and \
+                columns[i] in parquet_schema.names:
+            arrow_type = parquet_schema.field(columns[i]).type
+        arrays.append(arrow_util.values_to_array(
+            _column_type_transform(values), arrow_type))
+    if parquet_schema is None:
+        parquet_schema = arrow_util.stable_schema(pa.schema([
+            pa.field(name, array.type)
+            for name, array in zip(columns, arrays)]))
+    batch = arrow_util.arrays_to_record_batch(
+        arrays, columns, schema=parquet_schema)
+    parquetUtil.append_record_batch_to_parquet(batch)
+    return batch.schema
+
+
+def _column_type_transform(values, compound_types_to_json_string=True):
+    """Column wise version of _data_type_transform
+
+    The column's type is decided by its first non null value.
+    """
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime):
+        # Naive timestamps are taken as UTC, same as _data_type_transform
+        return pd.to_datetime(list(values), utc=True).tz_localize(None)
+    elif compound_types_to_json_string and \
+            isinstance(sample, (dict, list, tuple)):
+        return [_to_json_string(value) for value in values]
+    return values
+
+
+def _to_json_string(value):
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+    return value
+
+
 def _data_type_transform(value, compound_types_to_json_string=True):
     value_transformed = value
     if type(value) is datetime:
@@ -0,0 +1,169 @@
+"""PostgreSQL COPY based extraction
+
+Streams `COPY (query) TO STDOUT WITH (FORMAT csv)` output through
+pyarrow's streaming CSV reader, which is much faster than pulling rows
+through SQLAlchemy result proxies.
+
+Note: Compound types (json, arrays, etc.,) are written with postgres's
+text representation instead of the json strings the cursor path makes.
+"""
+import os
+import uuid
+import time
+import logging
+import threading
+import traceback
+import sqlalchemy
+import pyarrow as pa
+
+try:
+    from pyarrow import csv as pa_csv
+except ImportError:  # pragma: no cover
+    pa_csv = None
+
+from bqsqoop.utils import arrow_util, parquet_util
+from bqsqoop.extractor.sql import helper
+
+
+# Postgres type OIDs to the arrow types the CSV values are parsed as
+_PG_OID_TYPES = {
+    16: pa.bool_(),                     # bool
+    20: pa.int64(),                     # int8
+    21: pa.int64(),                     # int2
+    23: pa.int64(),                     # int4
+    700: pa.float64(),                  # float4
+    701: pa.float64(),                  # float8
+    1700: pa.float64(),                 # numeric
+    1082: pa.date32(),                  # date
+    1114: pa.timestamp('ns'),           # timestamp
+    1184: pa.timestamp('ns', 'UTC'),    # timestamptz
+}
+_CSV_BLOCK_SIZE = 1 << 22
+
+
+def is_available():
+    """Checks if the installed pyarrow has a streaming CSV reader
+    """
+    return pa_csv is not None and hasattr(pa_csv, 'open_csv')
+
+
+def export_to_parquet(worker_id, sql_bind, query, filter_field, start_pos,
+                      end_pos, output_folder, progress_bar=True,
+                      table_schema=None, row_group_bytes=None,
+                      block_size=_CSV_BLOCK_SIZE, pool_timeout=300,
+                      output_queue=None, max_file_bytes=None,
+                      max_file_rows=None, writer_options=None,
+                      storage_write_table=None):
+    try:
+        start_time = int(time.time())
+        output_file = os.path.join(output_folder, "{}.parq".format(
+            str(uuid.uuid4())[:8]))
+        query = helper.add_split_filter(
+            query, filter_field, start_pos, end_pos)
+        parquetUtil = parquet_util.ParquetUtil(
+            output_file, row_group_bytes=row_group_bytes,
+            output_queue=output_queue, max_file_bytes=max_file_bytes,
+            max_file_rows=max_file_rows, writer_options=writer_options,
+            storage_write_table=storage_write_table)
+        logging.debug(output_file)
+        logging.debug(query)
+        engine = sqlalchemy.create_engine(sql_bind, pool_timeout=pool_timeout)
+        connection = engine.raw_connection()
+        try:
+            csv_types = _get_csv_column_types(connection, query)
+            if table_schema:
+                parquet_schema = parquetUtil.build_pyarrow_schema(
+                    table_schema)
+            else:
+                parquet_schema = pa.schema([
+                    pa.field(name, _without_tz(arrow_type))
+                    for name, arrow_type in csv_types])
+            for batch in _stream_copy(connection, query, csv_types,
+                                      block_size):
+                batch = arrow_util.arrays_to_record_batch(
+                    batch.columns, batch.schema.names, schema=parquet_schema)
+                parquetUtil.append_record_batch_to_parquet(batch)
+        finally:
+            connection.close()
+        output_files = parquetUtil.close()
+        logging.info(
+            "COPY Dump -> worker_id: {0}, time_taken: {1} secs".format(
+                worker_id, int(time.time()) - start_time))
+        return output_files
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+
+
+def _get_csv_column_types(connection, query):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select * from ({}) as t limit 0".format(query))
+        return [(column[0], _PG_OID_TYPES.get(column[1], pa.string()))
+                for column in cursor.description]
+    finally:
+        cursor.close()
+
+
+def _without_tz(arrow_type):
+    if pa.types.is_timestamp(arrow_type) and arrow_type.tz:
+        return pa.timestamp(arrow_type.unit)
+    return arrow_type
+
+
+def _stream_copy(connection, query, csv_types, block_size):
+    """Yields RecordBatches of the query's COPY output
+
+    COPY writes into a pipe from a background thread, while the
+    CSV reader parses the other end in blocks of block_size bytes.
+    """
+    if not is_available():
+        raise Exception(
+            "COPY engine needs a pyarrow version with pyarrow.csv.open_csv")
+    copy_sql = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(query)
+    read_fd, write_fd = os.pipe()
+    copy_errors = []
+
+    def _copy():
+        cursor = connection.cursor()
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_writer:
+                cursor.copy_expert(copy_sql, pipe_writer)
+        except Exception as exc:
+            copy_errors.append(exc)
+        finally:
+            cursor.close()
+
+    copy_thread = threading.Thread(target=_copy, daemon=True)
+    copy_thread.start()
+    pipe_reader = os.fdopen(read_fd, 'rb')
+    try:
+        reader = pa_csv.open_csv(
+            pipe_reader,
+            read_options=pa_csv.ReadOptions(block_size=block_size),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=dict(csv_types),
+                # COPY writes NULL as an unquoted empty field only, text
+                # like NA or null isn't quoted
+                null_values=[''],
+                true_values=['t'], false_values=['f'],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False))
+        for batch in reader:
+            yield batch
+    except Exception:
+        _close_pipe(pipe_reader, copy_thread)
+        # A failed COPY shows up as a broken CSV stream on the reader
+        if copy_errors:
+            raise copy_errors[0]
+        raise
+    finally:
+        _close_pipe(pipe_reader, copy_thread)
+    if copy_errors:
+        raise copy_errors[0]
+
+
+def _close_pipe(pipe_reader, copy_thread):
+    # Unblocks the COPY thread in case the reader stopped early
+    pipe_reader.close()
+    copy_thread.join()
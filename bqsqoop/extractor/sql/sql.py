@@ -1,10 +1,13 @@
 import logging
 import uuid
 
-from bqsqoop.utils import async_worker, math_util
+from bqsqoop.utils import math_util
 from bqsqoop.extractor import Extractor
-from bqsqoop.utils.errors import MissingConfigError
-from bqsqoop.extractor.sql import helper
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
+from bqsqoop.extractor.sql import helper, pg_copy
+
+
+_MB = 1024 * 1024
 
 
 class SQLExtractor(Extractor):
@@ -14,12 +17,21 @@ class SQLExtractor(Extractor):
 
     """
 
-    def __init__(self, _config):
-        super().__init__(_config)
+    def __init__(self, _config, parquet_config=None):
+        super().__init__(_config, parquet_config=parquet_config)
         self._no_of_workers = self._config.get('no_of_workers', 1)
         self._output_folder = self._config.get(
             'output_folder', "./" + str(uuid.uuid4())[:8])
         self._source_table_name = self._config.get('source_table_name')
+        self._fetch_size = self._config.get('fetch_size', 'auto')
+        self._row_group_size_mb = self._config.get('row_group_size_mb', 64)
+        self._max_memory_mb = self._config.get('max_memory_mb', 512)
+        self._engine = self._config.get('engine', 'cursor')
+        self._split_strategy = self._config.get('split_strategy', 'range')
+        self._splits_per_worker = self._config.get('splits_per_worker', 1)
+        self._no_of_splits = self._config.get(
+            'no_of_splits', self._no_of_workers * self._splits_per_worker)
+        self._split_sample_percent = self._config.get('split_sample_percent')
 
     def validate_config(self):
         """Validates required configs for SQL extraction
@@ -31,45 +43,96 @@ class SQLExtractor(Extractor):
             raise MissingConfigError('query', root_name)
         if self._no_of_workers > 1 and 'filter_field' not in self._config:
             raise MissingConfigError('filter_field', root_name)
+        if self._split_strategy not in ('range', 'quantile'):
+            raise InvalidConfigError(
+                'split_strategy', root_name,
+                'should be one of range or quantile')
+        if self._engine not in ('cursor', 'copy'):
+            raise InvalidConfigError(
+                'engine', root_name, 'should be one of cursor or copy')
+        if self._engine == 'copy':
+            if not self._config['sql_bind'].startswith('postgres'):
+                raise InvalidConfigError(
+                    'engine', root_name, 'copy only supports postgres')
+            if not pg_copy.is_available():
+                raise InvalidConfigError(
+                    'engine', root_name,
+                    'copy needs pyarrow with streaming CSV support')
+        if self.is_incremental:
+            if 'watermark_state' not in self._config:
+                raise MissingConfigError('watermark_state', root_name)
+            if '%s' not in self._config['query']:
+                raise InvalidConfigError(
+                    'query', root_name,
+                    'needs a %s filter slot for watermark_field')
+        self._validate_parquet_config()
+        self._validate_retry_config(root_name)
         return None
 
-    def extract_to_parquet(self):
+    def extract_to_parquet(self, output_queue=None, storage_write_table=None):
         table_schema = None
         if self._source_table_name:
             table_schema = helper.get_table_schema(
                 self._config['sql_bind'],
                 self._source_table_name
             )
+        splits = [None]
         if self._no_of_workers > 1:
-            _async_worker = async_worker.AsyncWorker(
-                self._no_of_workers)
             splits = self._add_filter_to_query()
-            for i in range(self._no_of_workers):
-                _async_worker.send_data_to_worker(
-                    worker_id=i,
-                    **self._get_extract_job_fn_and_params(
-                        splits[i], table_schema)
-                )
-            logging.debug('Waiting for Extractor job results...')
-            return _async_worker.get_job_results()
-        else:
-            args = self._get_extract_job_fn_and_params(None, table_schema)
-            del args['worker_callback']
-            res = helper.export_to_parquet(
-                worker_id=0,
-                **args
-            )
-            return [res]
+        jobs = [self._get_extract_job_fn_and_params(split, table_schema)
+                for split in splits]
+        results = self._execute_jobs(
+            self._no_of_workers, jobs, output_queue=output_queue,
+            storage_write_table=storage_write_table)
+        return [_file for _files in results for _file in _files]
 
     def _add_filter_to_query(self):
         min_id, max_id = self._get_min_max()
-        splits = math_util.calculate_splits(
-            min_id, max_id, self._no_of_workers)
+        if self._split_strategy == 'quantile':
+            buckets = self._get_quantile_buckets(self._no_of_splits)
+            splits = math_util.calculate_splits_from_buckets(
+                min_id, max_id, buckets)
+        else:
+            splits = math_util.calculate_splits(
+                min_id, max_id, self._no_of_splits)
+        for i, split in enumerate(splits):
+            logging.debug("Split {0}: {1} -> {2}, estimated rows: {3}".format(
+                i, split['start'], split['end'], split.get('rows', 'n/a')))
         return splits
 
+    def _get_quantile_buckets(self, n):
+        """Gets n equal row count buckets of the filter_field
+
+        Uses NTILE over the filter_field, on a random() sample of the
+        rows if split_sample_percent is given.
+
+        Returns:
+            list of (start, end, rows) tuples, rows are scaled up to the
+            full table when sampled.
+        """
+        filter_field = self._config['filter_field']
+        sub_query = self._query() % "1=1"
+        sample_filter = ""
+        scale = 1
+        if self._split_sample_percent:
+            sample_filter = "AND random() < {}".format(
+                self._split_sample_percent / 100.0)
+            scale = 100.0 / self._split_sample_percent
+        sql_ntile_query = """
+            select min(s.{0}), max(s.{0}), count(*) from (
+                select t.{0}, ntile({1}) over (order by t.{0}) as bucket
+                from ({2}) as t where t.{0} is not null {3}
+            ) as s group by s.bucket order by s.bucket
+        """.format(filter_field, n, sub_query, sample_filter)
+        logging.debug("Running PSQL query: {}".format(sql_ntile_query))
+        rows = helper.get_results_cursor(
+            self._config['sql_bind'], sql_ntile_query).fetchall()
+        return [(start, end, int(count * scale))
+                for start, end, count in rows]
+
     def _get_min_max(self):
         filter_field = self._config['filter_field']
-        query = self._config['query']
+        query = self._query()
         sql_bind = self._config['sql_bind']
         sub_mix_max_query = query % "1=1"
         sql_min_max_query = """
@@ -80,16 +143,69 @@ class SQLExtractor(Extractor):
             sql_bind, sql_min_max_query).fetchone()
         return min_id, max_id
 
+    def _get_max_watermark(self, after):
+        watermark_field = self._watermark_field
+        watermark_filter = "1=1"
+        if after is not None:
+            watermark_filter = "{0} > {1}".format(
+                watermark_field, helper._sql_literal(after))
+        sql_max_query = """
+            select max(t.{0}) from ({1}) as t
+        """.format(watermark_field, self._config['query'] % watermark_filter)
+        logging.debug("Running PSQL query: {}".format(sql_max_query))
+        max_value, = helper.get_results_cursor(
+            self._config['sql_bind'], sql_max_query).fetchone()
+        return max_value
+
+    def _query(self):
+        """The query, limited to the increment in incremental mode
+
+        The `%s` slot is kept for the split filters.
+        """
+        query = self._config['query']
+        if self._next_watermark is None:
+            return query
+        watermark_filter = "{0} <= {1}".format(
+            self._watermark_field, helper._sql_literal(self._next_watermark))
+        if self._last_watermark is not None:
+            watermark_filter = "{0} > {1} AND {2}".format(
+                self._watermark_field,
+                helper._sql_literal(self._last_watermark), watermark_filter)
+        return query.replace('%s', watermark_filter + ' AND %s', 1)
+
     def _get_extract_job_fn_and_params(self, split_range, table_schema):
         start_pos = end_pos = None
+        query = self._query()
         if split_range:
             start_pos = split_range['start']
             end_pos = split_range['end']
-        return dict(worker_callback=helper.export_to_parquet,
-                    sql_bind=self._config['sql_bind'],
-                    query=self._config['query'],
-                    filter_field=self._config.get('filter_field'),
-                    output_folder=self._output_folder,
-                    start_pos=start_pos,
-                    end_pos=end_pos,
-                    table_schema=table_schema)
+        elif self._next_watermark is not None:
+            query = query % "1=1"
+        if self._engine == 'copy':
+            return dict(worker_callback=pg_copy.export_to_parquet,
+                        sql_bind=self._config['sql_bind'],
+                        query=query,
+                        filter_field=self._config.get('filter_field'),
+                        output_folder=self._output_folder,
+                        start_pos=start_pos,
+                        end_pos=end_pos,
+                        table_schema=table_schema,
+                        row_group_bytes=self._row_group_size_mb * _MB,
+                        **self._file_rolling_params(),
+                        **self._writer_options_params())
+        fn_params = dict(worker_callback=helper.export_to_parquet,
+                         sql_bind=self._config['sql_bind'],
+                         query=query,
+                         filter_field=self._config.get('filter_field'),
+                         output_folder=self._output_folder,
+                         start_pos=start_pos,
+                         end_pos=end_pos,
+                         table_schema=table_schema,
+                         fetch_size=self._fetch_size,
+                         row_group_bytes=self._row_group_size_mb * _MB,
+                         max_memory_bytes=self._max_memory_mb * _MB,
+                         **self._file_rolling_params(),
+                         **self._writer_options_params())
+        if "columnar" in self._config:
+            fn_params["columnar"] = self._config["columnar"]
+        return fn_params
@@ -35,7 +35,28 @@ class Job():
         _bq_config = self._configs.get("bigquery")
         if not _bq_config:
             raise Exception("Missing bigquery configs")
+        if self._extractor.is_incremental:
+            # Increments are appended to the loaded rows, in a partition
+            # too, as it holds the rows of earlier runs
+            if _bq_config.get('write_truncate'):
+                raise Exception(
+                    "write_truncate can't be set for incremental extracts")
+            _bq_config = dict(_bq_config, write_truncate=False)
         self._bq_job = bq_job.BigqueryParquetLoadJob(_bq_config)
+        if self._bq_job.pipeline_upload and self._extractor.is_checkpointed:
+            # Uploaded files are removed, a rerun can't reuse them
+            raise Exception("checkpoint_file can't be used with "
+                            "pipeline_upload")
+        if self._bq_job.pipeline_upload and self._extractor.is_retried:
+            # A failed attempt's part files are already uploaded, they'd
+            # be loaded along with the retry's
+            raise Exception("max_retries can't be used with "
+                            "pipeline_upload")
+        if self._bq_job.sink == 'storage_write' and \
+                self._extractor.is_checkpointed:
+            # Uncommitted streams don't outlive a failed run
+            raise Exception("checkpoint_file can't be used with the "
+                            "storage_write sink")
         if not self._bq_job.is_config_valid:
             logging.error("Invalid Bigquery configs: {}".format(
                 self._bq_job.errors))
@@ -43,6 +64,27 @@ class Job():
 
     def execute(self):
         """Executes the job of extracting data to  Bigquery
+
+        For incremental extracts, the watermark is saved only after the
+        increment is loaded, a failed run is retried from the last one.
+        """
+        if self._extractor.is_incremental:
+            if not self._extractor.prepare_increment():
+                logging.info("No new rows since the last watermark")
+                return
+        if self._bq_job.sink == 'storage_write':
+            self._bq_job.execute_streamed(self._extractor.extract_to_parquet)
+        elif self._bq_job.pipeline_upload:
+            self._bq_job.execute_pipelined(self._extractor.extract_to_parquet)
+        else:
+            _extracted_files = self._extractor.extract_to_parquet()
+            self._bq_job.execute(_extracted_files)
+        if self._extractor.is_incremental:
+            self._extractor.save_watermark()
+        self._extractor.clear_checkpoint()
+
+    def wait_for_cleanup(self):
+        """Waits for the GCS tmp files cleanup, with `async_cleanup` set
+        execute returns as soon as the table is loaded.
         """
-        _extracted_files = self._extractor.extract_to_parquet()
-        self._bq_job.execute(_extracted_files)
+        self._bq_job.wait_for_cleanup()
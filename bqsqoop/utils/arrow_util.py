@@ -0,0 +1,416 @@
+import functools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from bqsqoop.utils.pandas_util import PandasUtil
+
+
+# Arrow types with the numpy dtypes which convert to them as is
+_MATCHING_DTYPES = {
+    pa.int64(): np.dtype('int64'),
+    pa.float64(): np.dtype('float64'),
+    pa.bool_(): np.dtype('bool'),
+    pa.timestamp('ns'): np.dtype('datetime64[ns]'),
+}
+
+
+def _strptime_error_is_null():
+    # Parsing errors can only be nulls since pyarrow 8.0, older versions
+    # raise and the column is parsed with pandas instead
+    try:
+        pc.StrptimeOptions('%Y', 's', error_is_null=True)
+    except TypeError:
+        return {}
+    return {'error_is_null': True}
+
+
+_STRPTIME_OPTIONS = _strptime_error_is_null()
+
+
+def values_to_array(values, arrow_type=None):
+    """Converts a column of python values to a pyarrow.Array
+
+    Tries a direct typed conversion first and falls back to an
+    inferred conversion followed by an unsafe cast, which covers
+    values like Decimal -> float64 or int -> string.
+
+    Args:
+        values (list or pandas.Series): Values of a single column,
+            None/NaN are treated as nulls.
+        arrow_type (pyarrow.DataType, optional): Expected type of the
+            array, inferred from the values if not given.
+
+    Returns: (pyarrow.Array)
+    """
+    try:
+        return pa.array(values, type=arrow_type, from_pandas=True)
+    except (pa.ArrowException, TypeError, ValueError):
+        if arrow_type is None:
+            raise
+        return pa.array(values, from_pandas=True).cast(
+            arrow_type, safe=False)
+
+
+def null_array(arrow_type, length):
+    """Creates an all null pyarrow.Array of given type and length
+    """
+    return pa.array([None] * length, type=arrow_type)
+
+
+def arrays_to_record_batch(arrays, names, schema=None):
+    """Builds a pyarrow.RecordBatch from named column arrays
+
+    If a schema is given, the batch will have exactly the schema's
+    columns in the schema's order, missing columns are filled with nulls
+    and extra columns are dropped.
+
+    Args:
+        arrays (list of pyarrow.Array): Column arrays
+        names (list of str): Column names for the arrays
+        schema (pyarrow.Schema, optional): Expected schema of the batch
+
+    Returns: (pyarrow.RecordBatch)
+    """
+    if schema is None:
+        return pa.RecordBatch.from_arrays(arrays, names)
+    _length = len(arrays[0]) if arrays else 0
+    _by_name = dict(zip(names, arrays))
+    _arrays = []
+    for field in schema:
+        _array = _by_name.get(field.name)
+        if _array is None:
+            _array = null_array(field.type, _length)
+        elif _array.type != field.type:
+            _array = _array.cast(field.type, safe=False)
+        _arrays.append(_array)
+    return pa.RecordBatch.from_arrays(_arrays, schema.names)
+
+
+def stable_schema(schema):
+    """Widens a schema inferred from a sample to fit the rest of the data
+
+    Inferred types that depend on the sampled values are replaced, all
+    null columns become strings and decimals, whose precision and scale
+    come from the sample, float64 like `ParquetUtil.build_pyarrow_schema`
+    maps Decimal. Later data cast to the sample's types would fail or
+    lose digits otherwise.
+
+    Returns: (pyarrow.Schema)
+    """
+    return pa.schema([field.with_type(_stable_type(field.type))
+                      for field in schema])
+
+
+def _stable_type(arrow_type):
+    if pa.types.is_null(arrow_type):
+        return pa.string()
+    if pa.types.is_decimal(arrow_type):
+        return pa.float64()
+    return arrow_type
+
+
+def table_from_pandas(df, schema=None, datetime_format=None):
+    """Builds a pyarrow.Table conforming to schema from a DataFrame
+
+    Arrow version of `ParquetUtil.fix_dataframe_for_schema`, each column
+    is converted to its Arrow type on its own without copying the
+    frame. Columns whose dtype already matches are converted as is,
+    others are cast with an unsafe cast. Nulls stay nulls. Missing
+    columns are filled with nulls and extra columns dropped.
+    Conversions are planned once per schema and cached.
+
+    Args:
+        df (pandas.DataFrame): Data to convert
+        schema (pyarrow.Schema, optional): Expected schema, the types
+            are inferred from the frame if not given.
+        datetime_format (str, optional): strftime format to parse string
+            values of timestamp columns
+
+    Returns: (pyarrow.Table)
+    """
+    if schema is None:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    arrays = []
+    for field, converter in _schema_converters(schema, datetime_format):
+        if field.name in df.columns:
+            arrays.append(converter(df[field.name]))
+        else:
+            arrays.append(null_array(field.type, len(df)))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+# Arrow types field values were actually read as, for fields of a
+# schema whose values don't have the expected type, eg., double for
+# numbers in a string field. None reads the values as python objects.
+_raw_type_overrides = {}
+
+
+def records_to_table(records, schema, datetime_format=None):
+    """Builds a pyarrow.Table conforming to schema from a list of dicts
+
+    Converts documents like ES hits' `_source` straight to typed Arrow
+    columns without a pandas round trip, all columns are read in one
+    pass over the records. Fields whose values don't have the expected
+    JSON type are read on their own and cast, like `table_from_pandas`
+    does, the type they were read as is remembered for the schema so
+    following records are read in one pass again. Missing keys are
+    nulls and extra keys are dropped.
+
+    Args:
+        records (list of dict): Rows to convert
+        schema (pyarrow.Schema): Expected schema
+        datetime_format (str, optional): strptime format to parse string
+            values of timestamp columns, invalid values are nulls.
+
+    Returns: (pyarrow.Table)
+    """
+    _key = (schema, datetime_format)
+    _overrides = _raw_type_overrides.get(_key, {})
+    converters = _record_converters(schema, datetime_format)
+    _raw_fields = []
+    for field, raw_type, _ in converters:
+        raw_type = _overrides.get(field.name, raw_type)
+        if raw_type is not None:
+            _raw_fields.append(pa.field(field.name, raw_type))
+    try:
+        columns = dict(zip(
+            [raw_field.name for raw_field in _raw_fields],
+            pa.array(records, type=pa.struct(_raw_fields)).flatten()))
+    except (pa.ArrowException, TypeError, ValueError):
+        columns = {}
+    arrays = []
+    for field, raw_type, converter in converters:
+        column = columns.get(field.name)
+        if column is None:
+            column = [record.get(field.name) for record in records]
+            if _overrides.get(field.name, raw_type) is not None:
+                column, _read_type = _read_values(column, raw_type)
+                if _read_type != raw_type:
+                    _overrides = dict(_overrides, **{field.name: _read_type})
+        arrays.append(converter(column))
+    _raw_type_overrides[_key] = _overrides
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _read_values(values, raw_type):
+    # Returns the values as an array and the type it was read as, or
+    # the values themselves and None if they don't fit in an array.
+    try:
+        return pa.array(values, type=raw_type), raw_type
+    except (pa.ArrowException, TypeError, ValueError):
+        if pa.types.is_nested(raw_type):
+            return values, None
+    try:
+        array = pa.array(values)
+        return array, array.type
+    except (pa.ArrowException, TypeError, ValueError):
+        return values, None
+
+
+@functools.lru_cache(maxsize=64)
+def _record_converters(schema, datetime_format=None):
+    # JSON values are read as the raw arrow types, the converters take
+    # the read arrays, or python values where reading them failed or
+    # there's no raw type.
+    converters = []
+    for field in schema:
+        if pa.types.is_nested(field.type):
+            converter = functools.partial(
+                _record_nested_array, arrow_type=field.type,
+                datetime_format=datetime_format)
+        elif field.type == pa.binary():
+            converter = _record_binary_array
+        elif pa.types.is_timestamp(field.type):
+            converter = functools.partial(
+                _record_timestamp_array, arrow_type=field.type,
+                datetime_format=datetime_format)
+        else:
+            converter = functools.partial(
+                _record_array, arrow_type=field.type)
+        _raw_type = _raw_arrow_type(field.type)
+        if _has_list_type(field.type):
+            # Arrow reads a single string value of a list as its chars,
+            # these are read as python values and normalized instead.
+            _raw_type = None
+        converters.append((field, _raw_type, converter))
+    return tuple(converters)
+
+
+def _has_list_type(arrow_type):
+    if pa.types.is_list(arrow_type):
+        return True
+    if pa.types.is_struct(arrow_type):
+        return any(_has_list_type(field.type) for field in arrow_type)
+    return False
+
+
+def _raw_arrow_type(arrow_type):
+    # The arrow type JSON values of an arrow_type column are read as
+    if pa.types.is_struct(arrow_type):
+        return pa.struct([pa.field(field.name, _raw_arrow_type(field.type))
+                          for field in arrow_type])
+    if pa.types.is_list(arrow_type):
+        return pa.list_(_raw_arrow_type(arrow_type.value_type))
+    if arrow_type == pa.binary():
+        return pa.bool_()
+    if pa.types.is_timestamp(arrow_type):
+        return pa.string()
+    return arrow_type
+
+
+def _record_array(values, arrow_type):
+    if isinstance(values, pa.Array):
+        if values.type == arrow_type:
+            return values
+        try:
+            return values.cast(arrow_type, safe=False)
+        except (pa.ArrowException, TypeError, ValueError):
+            if arrow_type != pa.string():
+                raise
+            values = values.to_pylist()
+    else:
+        try:
+            return values_to_array(values, arrow_type)
+        except (pa.ArrowException, TypeError, ValueError):
+            if arrow_type != pa.string():
+                raise
+    # Mixed or nested python values, eg., dicts in ES documents
+    return pa.array([None if value is None else str(value)
+                     for value in values], type=arrow_type)
+
+
+def _record_nested_array(values, arrow_type, datetime_format):
+    _raw_type = _raw_arrow_type(arrow_type)
+    if not isinstance(values, pa.Array) or values.type != _raw_type:
+        if isinstance(values, pa.Array):
+            values = values.to_pylist()
+        values = _nested_values_to_array(values, arrow_type)
+    return _finish_nested_array(values, arrow_type, datetime_format)
+
+
+def _nested_values_to_array(values, arrow_type):
+    # Reads python values as the raw type of arrow_type, a child array
+    # at a time so the leaves are read and cast like top level values.
+    # ES fields can hold a single value or an array of values.
+    if pa.types.is_list(arrow_type):
+        items, offsets = [], [0]
+        for value in values:
+            if value is not None:
+                items.extend(value if isinstance(value, list) else [value])
+            offsets.append(len(items))
+        return pa.ListArray.from_arrays(
+            pa.array(offsets, type=pa.int32()),
+            _nested_values_to_array(items, arrow_type.value_type),
+            mask=pa.array([value is None for value in values],
+                          type=pa.bool_()))
+    if pa.types.is_struct(arrow_type):
+        values = [value if isinstance(value, dict) else None
+                  for value in values]
+        children = [
+            _nested_values_to_array(
+                [None if value is None else value.get(field.name)
+                 for value in values], field.type)
+            for field in arrow_type]
+        return pa.StructArray.from_arrays(
+            children, fields=[pa.field(field.name, child.type)
+                              for field, child in zip(arrow_type, children)],
+            mask=pa.array([value is None for value in values],
+                          type=pa.bool_()))
+    return _record_array(values, _raw_arrow_type(arrow_type))
+
+
+def _finish_nested_array(array, arrow_type, datetime_format):
+    # Converts an array read as the raw type of arrow_type to arrow_type
+    if pa.types.is_struct(arrow_type):
+        return pa.StructArray.from_arrays(
+            [_finish_nested_array(array.field(i), field.type,
+                                  datetime_format)
+             for i, field in enumerate(arrow_type)],
+            fields=list(arrow_type), mask=array.is_null())
+    if pa.types.is_list(arrow_type):
+        return pa.ListArray.from_arrays(
+            array.offsets, _finish_nested_array(
+                array.values, arrow_type.value_type, datetime_format),
+            type=arrow_type, mask=array.is_null())
+    if arrow_type == pa.binary():
+        return _record_binary_array(array)
+    if pa.types.is_timestamp(arrow_type):
+        return _record_timestamp_array(array, arrow_type, datetime_format)
+    return _record_array(array, arrow_type)
+
+
+def _record_binary_array(values):
+    # Binary columns hold booleans, as b'\x01' and b''
+    return pc.if_else(_record_array(values, pa.bool_()),
+                      pa.scalar(b'\x01'), pa.scalar(b''))
+
+
+def _record_timestamp_array(values, arrow_type, datetime_format):
+    if isinstance(values, pa.Array):
+        try:
+            if datetime_format:
+                array = pc.strptime(
+                    values, format=datetime_format, unit=arrow_type.unit,
+                    **_STRPTIME_OPTIONS)
+            else:
+                array = values.cast(arrow_type)
+            return array.cast(arrow_type)
+        except (pa.ArrowException, TypeError, ValueError):
+            # eg., ISO strings with timezones
+            values = values.to_pylist()
+    # eg., epoch millis
+    series = PandasUtil(datetime_format=datetime_format).fix_timestamp(
+        pd.Series(values, dtype=object))
+    return pa.Array.from_pandas(series, type=arrow_type)
+
+
+@functools.lru_cache(maxsize=64)
+def _schema_converters(schema, datetime_format=None):
+    converters = []
+    for field in schema:
+        if field.type == pa.binary():
+            converter = _to_binary_array
+        elif pa.types.is_timestamp(field.type):
+            converter = functools.partial(
+                _to_timestamp_array, arrow_type=field.type,
+                pandas_util=PandasUtil(datetime_format=datetime_format))
+        else:
+            converter = functools.partial(_to_array, arrow_type=field.type)
+        converters.append((field, converter))
+    return tuple(converters)
+
+
+def _matches_dtype(series, arrow_type):
+    # Not a plain ==, numpy takes a None dtype as float64
+    _dtype = _MATCHING_DTYPES.get(arrow_type)
+    return _dtype is not None and _dtype == series.dtype
+
+
+def _to_array(series, arrow_type):
+    if _matches_dtype(series, arrow_type):
+        return pa.Array.from_pandas(series, type=arrow_type)
+    try:
+        array = pa.Array.from_pandas(series)
+        if array.type == arrow_type:
+            return array
+        return array.cast(arrow_type, safe=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        if arrow_type != pa.string():
+            raise
+        # Mixed or nested python values, eg., dicts from ES documents
+        return pa.Array.from_pandas(
+            series.astype(str), mask=series.isna().values, type=arrow_type)
+
+
+def _to_binary_array(series):
+    # Binary columns hold booleans, as b'\x01' and b''
+    return pc.if_else(_to_array(series, pa.bool_()),
+                      pa.scalar(b'\x01'), pa.scalar(b''))
+
+
+def _to_timestamp_array(series, arrow_type, pandas_util):
+    if not _matches_dtype(series, arrow_type):
+        series = pandas_util.fix_timestamp(series)
+    return pa.Array.from_pandas(series, type=arrow_type)
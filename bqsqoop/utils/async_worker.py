@@ -1,20 +1,30 @@
+import time
 import logging
 
-from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from bqsqoop.utils.retry import RetryPolicy
 
 
 class AsyncWorker(object):
     """
         Wrapper for ProcessPoolExectuor
 
+        Jobs can outnumber the workers, they are queued and picked up
+        by the workers as they free up. Failed jobs are resubmitted as
+        per the retry_policy.
+
         Args:
             num_workers - Number of parallel workers to run
+            retry_policy - Optional `bqsqoop.utils.retry.RetryPolicy`,
+                failed jobs aren't retried by default
         Note: other functions `send_data_to_worker` and `get_job_results`
     """
 
-    def __init__(self, num_workers, num_jobs=None):
+    def __init__(self, num_workers, num_jobs=None, retry_policy=None):
         self.num_workers = num_workers
         self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._jobs = []
         self._futures = []
 
     def send_data_to_worker(self, worker_callback, **args):
@@ -26,24 +36,104 @@ class AsyncWorker(object):
                 **args - args for worker_callback
 
         """
-        self._futures.append(self._executor.submit(worker_callback, **args))
+        self._jobs.append((worker_callback, args))
+        self._futures.append(self._submit(len(self._jobs) - 1))
+
+    def _submit(self, index):
+        worker_callback, args = self._jobs[index]
+        return self._executor.submit(
+            _timed_call, worker_callback, **args)
 
-    def get_job_results(self):
+    def get_job_results(self, on_result=None):
         """
             Waits and gets results from all jobs
 
+            Args:
+                on_result - Optional callable, called with the index and
+                    the return value of each job as soon as it's done.
+                    Failed jobs are called with an exception instead.
+
             Returns:
-                array of return values from each task
+                array of return values from each task, in the order
+                they were sent
             Note: It checks for exceptions inside the tasks and in case of
-            any exceptions, they will be printed
-            and a final RuntimeError will be raisen.
+            any exceptions, they will be printed and retried as per the
+            retry policy. Once a job is out of retries, jobs yet to start
+            are cancelled and a final RuntimeError will be raisen once the
+            running jobs finish.
         """
-        _job_results = []
+        _total = len(self._futures)
+        _attempts = [1] * _total
+        _results = [None] * _total
+        _running = {_future: i for i, _future in enumerate(self._futures)}
+        # (time to resubmit, job index) of failed jobs waiting to retry
+        _retries = []
+        _done = 0
+        _failed = None
         try:
-            all_futures = wait(self._futures).done
-            for x in all_futures:
-                _job_results.append((x.result()))
+            while _running or _retries:
+                _now = time.time()
+                for _retry in [r for r in _retries if r[0] <= _now]:
+                    _retries.remove(_retry)
+                    _running[self._submit(_retry[1])] = _retry[1]
+                _timeout = None
+                if _retries:
+                    _timeout = max(min(r[0] for r in _retries) - _now, 0)
+                _finished, _ = wait(
+                    list(_running), timeout=_timeout,
+                    return_when=FIRST_COMPLETED)
+                for _future in _finished:
+                    i = _running.pop(_future)
+                    _exc = _future.exception()
+                    if _exc is None:
+                        _results[i], _secs = _future.result()
+                        _done += 1
+                        logging.debug(
+                            '{0}/{1} jobs done, job {2} attempt {3} took '
+                            '{4:.1f} secs'.format(
+                                _done, _total, i, _attempts[i], _secs))
+                        if on_result:
+                            on_result(i, _results[i])
+                        continue
+                    logging.warning(
+                        'Job {0} attempt {1} failed after {2:.1f} secs: '
+                        '{3!r}'.format(i, _attempts[i],
+                                       getattr(_exc, 'attempt_secs', 0),
+                                       _exc))
+                    if not self._retry_policy.should_retry(
+                            _attempts[i], _exc):
+                        _failed = i
+                        raise _exc
+                    _retries.append(
+                        (time.time() +
+                         self._retry_policy.backoff(_attempts[i]), i))
+                    _attempts[i] += 1
         except Exception as exc:
             logging.error('A slice ended with Exception: %s' % exc)
+            for _future in _running:
+                _future.cancel()
+            if on_result:
+                # Jobs still running are waited for, so their results
+                # aren't lost
+                _unreported = [_future for _future in _running
+                               if not _future.cancelled()]
+                wait(_unreported)
+                for _future in _unreported:
+                    on_result(_running[_future], _future.exception() or
+                              _future.result()[0])
+                if _failed is not None:
+                    on_result(_failed, exc)
             raise RuntimeError("One or more worker ended in Exception.")
-        return _job_results
+        return _results
+
+
+def _timed_call(worker_callback, **args):
+    """Runs the job in the worker, with its time taken
+    """
+    _start = time.time()
+    try:
+        return worker_callback(**args), time.time() - _start
+    except Exception as exc:
+        # Pickled back to the parent along with the exception
+        exc.attempt_secs = time.time() - _start
+        raise
@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import logging
+
+
+# Job params that don't identify a split, eg., a point-in-time is
+# opened anew on each run
+_RUNTIME_PARAMS = ('worker_callback', 'output_queue', 'storage_write_table',
+                   'pit_id')
+
+
+class Manifest(object):
+    """Checkpoints of the splits of an extract, in a local JSON file
+
+    Records each split's params (its boundaries), status and output
+    files as they finish. A rerun with the same config skips the splits
+    done with all their files still on disk, splits that failed,
+    changed or never ran are extracted again. A manifest of another
+    config is discarded.
+
+    Args:
+        path (str): The manifest file
+        config (dict): The extractor's config
+    """
+
+    def __init__(self, path, config):
+        self._path = path
+        self._config_hash = _hash(config)
+        self._splits = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                _manifest = json.load(f)
+            if _manifest.get('config_hash') == self._config_hash:
+                self._splits = _manifest['splits']
+            else:
+                logging.info(
+                    "Config changed, ignoring checkpoints in {}".format(path))
+
+    def completed_files(self, split_id, job):
+        """Output files of the split if it's done in an earlier run
+
+        Returns: (list of str)
+            None if the split has to be extracted
+        """
+        _split = self._splits.get(str(split_id))
+        if not _split or _split['status'] != 'done' or \
+                _split['params'] != _describe(job):
+            return None
+        if not all(os.path.exists(_file) for _file in _split['files']):
+            return None
+        return _split['files']
+
+    def mark_done(self, split_id, job, files):
+        self._mark(split_id, job, 'done', files)
+
+    def mark_failed(self, split_id, job):
+        self._mark(split_id, job, 'failed', [])
+
+    def remove(self):
+        """Drops the manifest once the extract is loaded
+        """
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _mark(self, split_id, job, status, files):
+        self._splits[str(split_id)] = {
+            'params': _describe(job), 'status': status, 'files': files}
+        _tmp_path = self._path + ".tmp"
+        with open(_tmp_path, "w") as f:
+            json.dump({'config_hash': self._config_hash,
+                       'splits': self._splits}, f)
+        os.replace(_tmp_path, self._path)
+
+
+def _describe(job):
+    # JSON round trip, so it compares equal to the one read back
+    return json.loads(json.dumps(
+        {k: v for k, v in job.items() if k not in _RUNTIME_PARAMS},
+        sort_keys=True, default=str))
+
+
+def _hash(config):
+    return hashlib.sha1(json.dumps(
+        config, sort_keys=True, default=str).encode()).hexdigest()
@@ -22,3 +22,12 @@ class InvalidTypeError(ValueError):
 
     def __str__(self):
         return self.error
+
+
+class InvalidConfigError(ValueError):
+    def __init__(self, config_name, root_name, reason):
+        self.error = 'Invalid config for {0} under {1}, {2}'.format(
+            config_name, root_name, reason)
+
+    def __str__(self):
+        return self.error
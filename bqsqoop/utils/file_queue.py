@@ -0,0 +1,102 @@
+import os
+import threading
+
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+
+
+class FileQueue(object):
+    """A queue of finished local files, accounted by their size on disk
+
+    Producers (extract workers) `put` files as soon as they are written,
+    consumers (uploaders) `get` them and call `done` once the file is
+    removed from local disk. Producers call `wait_for_space` before
+    writing a new file, which blocks while the queued and in-progress
+    files are over max_bytes.
+
+    Args:
+        max_bytes (int, optional): Local disk cap for the queued files,
+            no backpressure if not given.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._files = []
+        self._pending_bytes = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, path):
+        """Adds a finished local file to the queue
+        """
+        with self._condition:
+            self._pending_bytes += os.path.getsize(path)
+            self._files.append(path)
+            self._condition.notify_all()
+
+    def get(self):
+        """Blocks till a file is available
+
+        Returns: (str)
+            The file path, or None once the queue is closed and empty.
+        """
+        with self._condition:
+            while not self._files and not self._closed:
+                self._condition.wait()
+            if self._files:
+                return self._files.pop(0)
+            return None
+
+    def done(self, nbytes):
+        """Releases the disk space of a consumed file
+        """
+        with self._condition:
+            self._pending_bytes -= nbytes
+            self._condition.notify_all()
+
+    def wait_for_space(self):
+        """Blocks while pending files are over the disk cap
+
+        Returns immediately once the queue is closed, so producers never
+        hang on a failed consumer.
+        """
+        with self._condition:
+            while self._max_bytes and not self._closed and \
+                    self._pending_bytes >= self._max_bytes:
+                self._condition.wait()
+
+    def pending_bytes(self):
+        with self._condition:
+            return self._pending_bytes
+
+    def close(self):
+        """No more files will be added, wakes up all waiting calls
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class _FileQueueManager(BaseManager):
+    pass
+
+
+_FileQueueManager.register('FileQueue', FileQueue)
+
+
+@contextmanager
+def shared_file_queue(max_bytes=None):
+    """A FileQueue which can be passed to worker processes
+
+    The queue lives in a manager process, the yielded proxy can be sent
+    to ProcessPoolExecutor jobs and used from threads.
+
+    Args:
+        max_bytes (int, optional): Local disk cap, see FileQueue
+    """
+    manager = _FileQueueManager()
+    manager.start()
+    try:
+        yield manager.FileQueue(max_bytes)
+    finally:
+        manager.shutdown()
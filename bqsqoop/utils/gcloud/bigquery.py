@@ -1,11 +1,18 @@
 import re
+import uuid
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
 
 
+# Granularities of time partitioned tables
+PARTITION_TYPES = ('HOUR', 'DAY', 'MONTH', 'YEAR')
+
+
 def load_parquet_files(gcs_path, gcs_project, dataset_name, table_name,
-                       write_truncate=True):
+                       write_truncate=True, time_partitioning=None,
+                       clustering_fields=None, partition=None):
     """Creates/Updates BQ table with parquet files from GCS bucket path
 
     Args:
@@ -15,30 +22,217 @@ def load_parquet_files(gcs_path, gcs_project, dataset_name, table_name,
         table_name (str): Bigquery table name
         write_truncate (bool): flag to define either to Override or Append
             data to the table. Default is True.
+        time_partitioning (dict, optional): Partitioning of the table
+            when it's created, `field` (ingestion time if not given),
+            `type` one of PARTITION_TYPES (default DAY) and
+            `expiration_days`.
+        clustering_fields (list of str, optional): Clustering columns of
+            the table when it's created, up to 4.
+        partition (str, optional): Loads into this partition of the
+            table, eg., 20180910 for a day, so write_truncate only
+            replaces that partition.
 
     Returns:
         None
     """
     _validate_gcs_path(gcs_path)
     _load_files_from_gcs(gcs_path, gcs_project, dataset_name,
-                         table_name, "PARQUET", write_truncate)
+                         table_name, "PARQUET", write_truncate,
+                         time_partitioning=time_partitioning,
+                         clustering_fields=clustering_fields,
+                         partition=partition)
+
+
+def load_parquet_files_staged(files, gcs_project, dataset_name, table_name,
+                              write_truncate=True, max_files_per_job=10000,
+                              max_bytes_per_job=None, max_concurrency=4,
+                              time_partitioning=None, clustering_fields=None,
+                              partition=None):
+    """Loads parquet files with concurrent load jobs and a final copy
+
+    Files are grouped into batches within max_files_per_job and
+    max_bytes_per_job, each loaded by its own load job into a staging
+    table next to table_name. The staging tables are then copied into
+    table_name with one copy job, so readers never see a partial load,
+    and dropped. A single batch is loaded straight into table_name.
+
+    Args:
+        files (list of tuple): gs:// uri and size in bytes of each file,
+            see `storage.list_files_in`
+        max_files_per_job (int): Source uris per load job, Bigquery's
+            limit is 10000.
+        max_bytes_per_job (int, optional): Bytes per load job
+        max_concurrency (int): Max load jobs running at a time
+        time_partitioning, clustering_fields, partition: See
+            `load_parquet_files`, staging tables are partitioned and
+            clustered like the table.
+
+    Returns:
+        None
+    """
+    _batches = _batch_files(files, max_files_per_job, max_bytes_per_job)
+    if len(_batches) <= 1:
+        _load_files_from_gcs([uri for uri, _ in files], gcs_project,
+                             dataset_name, table_name, "PARQUET",
+                             write_truncate,
+                             time_partitioning=time_partitioning,
+                             clustering_fields=clustering_fields,
+                             partition=partition)
+        return
+    _client = bigquery.Client(project=gcs_project)
+    _dataset = _client.dataset(dataset_name)
+    _staging_name = "{0}_staging_{1}".format(
+        table_name, uuid.uuid4().hex[:8])
+    _staging_tables = [_dataset.table("{0}_{1}".format(_staging_name, i))
+                       for i in range(len(_batches))]
+    try:
+        with ThreadPoolExecutor(
+                max_workers=max(min(max_concurrency, len(_batches)), 1)
+        ) as executor:
+            for future in [
+                    executor.submit(
+                        _run_load_job, _client, [uri for uri, _ in _batch],
+                        _staging_table, "PARQUET", 'WRITE_TRUNCATE',
+                        time_partitioning=time_partitioning,
+                        clustering_fields=clustering_fields)
+                    for _batch, _staging_table in zip(
+                        _batches, _staging_tables)]:
+                future.result()
+        _job_config = bigquery.CopyJobConfig()
+        _job_config.write_disposition = 'WRITE_TRUNCATE' if \
+            write_truncate else 'WRITE_APPEND'
+        logging.debug("Copying {0} staging tables to {1}".format(
+            len(_staging_tables), table_name))
+        _client.copy_table(
+            _staging_tables, _dataset.table(_with_partition(
+                table_name, partition)),
+            job_config=_job_config).result()
+        logging.info("Table {} created".format(table_name))
+    finally:
+        for _staging_table in _staging_tables:
+            _client.delete_table(_staging_table, not_found_ok=True)
+
+
+def copy_staging_table(staging_table_name, gcs_project, dataset_name,
+                       table_name, write_truncate=True,
+                       time_partitioning=None, clustering_fields=None,
+                       partition=None):
+    """Copies a staging table into table_name with one copy job
+
+    The staging table is dropped afterwards, even if the copy fails.
+
+    Args:
+        staging_table_name (str): Table in dataset_name to copy from
+        write_truncate (bool): Override or Append to table_name
+        time_partitioning, clustering_fields, partition: See
+            `load_parquet_files`, table_name is created with the staging
+            table's schema if it doesn't exist.
+
+    Returns:
+        None
+    """
+    _client = bigquery.Client(project=gcs_project)
+    _dataset = _client.dataset(dataset_name)
+    _staging_table = _dataset.table(staging_table_name)
+    try:
+        if time_partitioning is not None or clustering_fields:
+            # Copy jobs can't partition or cluster the tables they create
+            _table = bigquery.Table(
+                _dataset.table(table_name),
+                schema=_client.get_table(_staging_table).schema)
+            if time_partitioning is not None:
+                _table.time_partitioning = _time_partitioning(
+                    time_partitioning)
+            if clustering_fields:
+                _table.clustering_fields = clustering_fields
+            _client.create_table(_table, exists_ok=True)
+        _job_config = bigquery.CopyJobConfig()
+        _job_config.write_disposition = 'WRITE_TRUNCATE' if \
+            write_truncate else 'WRITE_APPEND'
+        logging.debug("Copying {0} to {1}".format(
+            staging_table_name, table_name))
+        _client.copy_table(
+            _staging_table, _dataset.table(_with_partition(
+                table_name, partition)),
+            job_config=_job_config).result()
+        logging.info("Table {} created".format(table_name))
+    finally:
+        _client.delete_table(_staging_table, not_found_ok=True)
+
+
+def delete_table(gcs_project, dataset_name, table_name):
+    """Drops a table, no-op if it doesn't exist
+    """
+    _client = bigquery.Client(project=gcs_project)
+    _client.delete_table(_client.dataset(dataset_name).table(table_name),
+                         not_found_ok=True)
+
+
+def _batch_files(files, max_files, max_bytes):
+    _batches = []
+    _batch_bytes = 0
+    for uri, size in files:
+        if not _batches or len(_batches[-1]) >= max_files or (
+                max_bytes and _batches[-1] and
+                _batch_bytes + size > max_bytes):
+            _batches.append([])
+            _batch_bytes = 0
+        _batches[-1].append((uri, size))
+        _batch_bytes += size
+    return _batches
+
+
+def _with_partition(table_name, partition):
+    if partition:
+        return "{0}${1}".format(table_name, partition)
+    return table_name
 
 
 def _load_files_from_gcs(gcs_path, gcs_project, dataset_name,
-                         table_name, file_format, write_truncate):
+                         table_name, file_format, write_truncate,
+                         time_partitioning=None, clustering_fields=None,
+                         partition=None):
+    table_name = _with_partition(table_name, partition)
     logging.debug("Loading data from {0} to bq table {1}.{2}.{3}\n".format(
         gcs_path, gcs_project, dataset_name, table_name))
     _client = bigquery.Client(project=gcs_project)
+    target_table = _client.dataset(dataset_name).table(table_name)
+    _run_load_job(_client, gcs_path, target_table, file_format,
+                  'WRITE_TRUNCATE' if write_truncate else 'WRITE_APPEND',
+                  time_partitioning=time_partitioning,
+                  clustering_fields=clustering_fields)
+    logging.info("Table {} created".format(table_name))
+
+
+def _run_load_job(client, gcs_path, target_table, file_format,
+                  write_disposition, time_partitioning=None,
+                  clustering_fields=None):
     _job_config = bigquery.LoadJobConfig()
     _job_config.source_format = file_format
-    _job_config.write_disposition = 'WRITE_TRUNCATE' if \
-        write_truncate else 'WRITE_APPEND'
-    target_table = _client.dataset(dataset_name).table(table_name)
-    job = _client.load_table_from_uri(gcs_path, target_table,
-                                      job_config=_job_config)
+    if file_format == "PARQUET" and hasattr(bigquery, 'ParquetOptions'):
+        # Loads parquet lists, eg., ES nested fields, as REPEATED columns
+        _parquet_options = bigquery.ParquetOptions()
+        _parquet_options.enable_list_inference = True
+        _job_config.parquet_options = _parquet_options
+    _job_config.write_disposition = write_disposition
+    if time_partitioning is not None:
+        _job_config.time_partitioning = _time_partitioning(
+            time_partitioning)
+    if clustering_fields:
+        _job_config.clustering_fields = clustering_fields
+    job = client.load_table_from_uri(gcs_path, target_table,
+                                     job_config=_job_config)
     logging.debug("Waiting for load job to finish...")
     job.result()
-    logging.info("Table {} created".format(table_name))
+
+
+def _time_partitioning(time_partitioning):
+    _expiration_days = time_partitioning.get('expiration_days')
+    return bigquery.TimePartitioning(
+        type_=time_partitioning.get('type', 'DAY'),
+        field=time_partitioning.get('field'),
+        expiration_ms=_expiration_days and int(
+            _expiration_days * 24 * 3600 * 1000))
 
 
 def _validate_gcs_path(gcs_path):
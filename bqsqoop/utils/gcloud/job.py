@@ -1,5 +1,15 @@
-from bqsqoop.utils import typed
-from bqsqoop.utils.gcloud import auth, storage, bigquery
+import re
+import uuid
+import logging
+import threading
+
+from bqsqoop.utils import typed, file_queue
+from bqsqoop.utils.gcloud import auth, storage, bigquery, storage_write
+
+
+_MB = 1024 * 1024
+# Where extracted data is written to before it's in the table
+SINKS = ('gcs', 'storage_write')
 
 
 class BigqueryParquetLoadJob():
@@ -20,23 +30,86 @@ class BigqueryParquetLoadJob():
         self._gcs_tmp_path = configs.get("gcs_tmp_path")
         self._service_account_key = configs.get('service_account_key')
         self._write_truncate = configs.get('write_truncate', True)
+        self.pipeline_upload = configs.get('pipeline_upload', False)
+        self._max_local_disk_mb = configs.get('max_local_disk_mb', 10240)
+        self._upload_concurrency = configs.get('upload_concurrency', 4)
+        self._upload_mode = configs.get('upload_mode', 'simple')
+        self._upload_chunk_size_mb = configs.get('upload_chunk_size_mb', 64)
+        self._async_cleanup = configs.get('async_cleanup', False)
+        self._max_files_per_load_job = configs.get('max_files_per_load_job')
+        self._max_load_job_size_gb = configs.get('max_load_job_size_gb')
+        self._load_concurrency = configs.get('load_concurrency', 4)
+        self._time_partitioning = configs.get('time_partitioning')
+        self._clustering_fields = configs.get('clustering_fields')
+        self._partition = configs.get('partition')
+        self.sink = configs.get('sink', 'gcs')
+        self._cleanup_thread = None
         self._validate_configs()
 
     def _validate_configs(self):
         self.errors = {}
         self.is_config_valid = True
-        _strings = ["project_id", "dataset_name",
-                    "table_name", "gcs_tmp_path"]
+        _strings = ["project_id", "dataset_name", "table_name"]
+        if self.sink != 'storage_write':
+            _strings.append("gcs_tmp_path")
         for _str_vars in _strings:
             _res = typed.non_empty_string(getattr(self, "_" + _str_vars))
             if _res:
                 self.errors[_str_vars] = _res
+        self._validate_sink()
+        if self._upload_mode not in storage.UPLOAD_MODES:
+            self.errors["upload_mode"] = "should be one of {}".format(
+                ", ".join(storage.UPLOAD_MODES))
+        if self._max_files_per_load_job is not None and \
+                self._max_files_per_load_job < 1:
+            self.errors["max_files_per_load_job"] = "should be at least 1"
+        self._validate_table_options()
         _res = auth.setup_credentials(self._service_account_key)
         if _res:
             self.errors["google_auth"] = _res
         if self.errors:
             self.is_config_valid = False
 
+    def _validate_sink(self):
+        if self.sink not in SINKS:
+            self.errors["sink"] = "should be one of {}".format(
+                ", ".join(SINKS))
+        elif self.sink == 'storage_write':
+            if not storage_write.is_available():
+                self.errors["sink"] = \
+                    "storage_write needs google-cloud-bigquery-storage"
+            if self.pipeline_upload:
+                self.errors["pipeline_upload"] = \
+                    "can't be used with the storage_write sink"
+
+    def _validate_table_options(self):
+        if self._time_partitioning is not None:
+            if not isinstance(self._time_partitioning, dict):
+                self.errors["time_partitioning"] = \
+                    "should be a table of field, type and expiration_days"
+            elif self._time_partitioning.get('type', 'DAY') not in \
+                    bigquery.PARTITION_TYPES:
+                self.errors["time_partitioning"] = \
+                    "type should be one of {}".format(
+                        ", ".join(bigquery.PARTITION_TYPES))
+        if self._clustering_fields is not None and (
+                not isinstance(self._clustering_fields, list) or
+                not 1 <= len(self._clustering_fields) <= 4):
+            self.errors["clustering_fields"] = \
+                "should be a list of 1 to 4 columns"
+        if self._partition is not None and \
+                not re.match(r'^\d{4}(\d{2}){0,3}$', str(self._partition)):
+            self.errors["partition"] = \
+                "should be a partition id like YYYYMMDD or YYYYMMDDHH"
+
+    def _table_options(self):
+        """Load params for the table's partitioning and clustering
+        """
+        _options = dict(time_partitioning=self._time_partitioning,
+                        clustering_fields=self._clustering_fields,
+                        partition=self._partition)
+        return {k: v for k, v in _options.items() if v is not None}
+
     def execute(self, files):
         """Executes the job to load parquet files to Bigquery tables
 
@@ -49,12 +122,136 @@ class BigqueryParquetLoadJob():
         """
         _gcs_dest_path = storage.parallel_copy_files_to_gcs(
             files, self._gcs_tmp_path, self._project_id,
-            use_new_tmp_folder=True)
-        bigquery.load_parquet_files(
-            _gcs_dest_path + "*.parq",
+            use_new_tmp_folder=True,
+            max_concurrency=self._upload_concurrency,
+            upload_mode=self._upload_mode,
+            chunk_size=self._upload_chunk_size_mb * _MB)
+        self._load_and_cleanup(_gcs_dest_path)
+
+    def execute_pipelined(self, extract_fn):
+        """Uploads files to GCS while they are being extracted
+
+        Each file is uploaded and removed from local disk as soon as
+        it's written, extraction waits while the local files waiting for
+        upload are over `max_local_disk_mb`. Loads to Bigquery once all
+        files are uploaded.
+
+        Args:
+            extract_fn (callable): Extracts to parquet files, called with
+                an output_queue. eg., Extractor.extract_to_parquet
+
+        Returns:
+            None if the job is successful, errors if failed
+        """
+        _gcs_dest_path = storage.new_tmp_folder_path(self._gcs_tmp_path)
+        with file_queue.shared_file_queue(
+                self._max_local_disk_mb * _MB) as _queue:
+            _uploader = storage.QueueUploader(
+                _queue, _gcs_dest_path, self._project_id,
+                no_of_threads=self._upload_concurrency,
+                upload_mode=self._upload_mode,
+                chunk_size=self._upload_chunk_size_mb * _MB)
+            _uploader.start()
+            try:
+                extract_fn(output_queue=_queue)
+            finally:
+                _queue.close()
+                _uploader.join()
+        self._load_and_cleanup(_gcs_dest_path)
+
+    def execute_streamed(self, extract_fn):
+        """Writes the extracted data with the Bigquery Storage Write API
+
+        Skips writing to GCS, each extract worker appends to its own
+        pending write stream of a staging table, see
+        `bqsqoop.utils.gcloud.storage_write`. The streams are committed
+        together once all workers are done, and the staging table copied
+        into the table, so a failed worker's rows are never loaded.
+
+        Args:
+            extract_fn (callable): Extracts to write streams, called with
+                a storage_write_table. eg., Extractor.extract_to_parquet
+
+        Returns:
+            None if the job is successful, errors if failed
+        """
+        _staging_table_name = "{0}_staging_{1}".format(
+            self._table_name, uuid.uuid4().hex[:8])
+        _table = storage_write.table_path(
+            self._project_id, self._dataset_name, _staging_table_name)
+        try:
+            _streams = extract_fn(storage_write_table=_table)
+            if _streams:
+                storage_write.commit_streams(_table, _streams)
+        except Exception:
+            # Workers create the staging table on their first append
+            bigquery.delete_table(
+                self._project_id, self._dataset_name, _staging_table_name)
+            raise
+        if not _streams:
+            logging.info("Nothing extracted to load")
+            return
+        bigquery.copy_staging_table(
+            _staging_table_name,
+            self._project_id,
+            self._dataset_name,
+            self._table_name,
+            write_truncate=self._write_truncate,
+            **self._table_options())
+
+    def _load_and_cleanup(self, _gcs_dest_path):
+        if self._max_files_per_load_job or self._max_load_job_size_gb:
+            self._load_staged(_gcs_dest_path)
+        else:
+            bigquery.load_parquet_files(
+                _gcs_dest_path + "*.parq",
+                self._project_id,
+                self._dataset_name,
+                self._table_name,
+                write_truncate=self._write_truncate,
+                **self._table_options()
+            )
+        if not self._async_cleanup:
+            storage.delete_files_in(
+                _gcs_dest_path, self._project_id,
+                max_concurrency=self._upload_concurrency)
+            return
+        self._cleanup_thread = threading.Thread(
+            target=self._cleanup, args=(_gcs_dest_path,))
+        self._cleanup_thread.start()
+
+    def _load_staged(self, _gcs_dest_path):
+        # Concurrent load jobs of file batches, see
+        # `bigquery.load_parquet_files_staged`
+        _max_bytes = None
+        if self._max_load_job_size_gb:
+            _max_bytes = int(self._max_load_job_size_gb * 1024 * _MB)
+        bigquery.load_parquet_files_staged(
+            storage.list_files_in(
+                _gcs_dest_path, self._project_id, suffix=".parq"),
             self._project_id,
             self._dataset_name,
             self._table_name,
-            write_truncate=self._write_truncate
-        )
-        storage.delete_files_in(_gcs_dest_path, self._project_id)
+            write_truncate=self._write_truncate,
+            max_files_per_job=self._max_files_per_load_job or 10000,
+            max_bytes_per_job=_max_bytes,
+            max_concurrency=self._load_concurrency,
+            **self._table_options())
+
+    def _cleanup(self, _gcs_dest_path):
+        try:
+            storage.delete_files_in(
+                _gcs_dest_path, self._project_id,
+                max_concurrency=self._upload_concurrency)
+        except Exception as exc:
+            # Data is already loaded, leftover files don't fail the job
+            logging.warning("Cleanup of {0} failed: {1}".format(
+                _gcs_dest_path, exc))
+
+    def wait_for_cleanup(self):
+        """Waits for an async cleanup of the GCS tmp files to finish
+
+        No-op if cleanup isn't async or not started.
+        """
+        if self._cleanup_thread:
+            self._cleanup_thread.join()
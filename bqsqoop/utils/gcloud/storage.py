@@ -1,9 +1,12 @@
+import os
 import re
+import time
 import uuid
 import logging
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
-from bqsqoop.utils import async_worker
 
 
 def copy_files_to_gcs(files, gcs_bucket_path, project_id,
@@ -22,72 +25,364 @@ def copy_files_to_gcs(files, gcs_bucket_path, project_id,
         str: path to the folder in gcs where the files are uploaded
     """
     _validate_gcs_path(gcs_bucket_path)
-    client = storage.Client(project=project_id)
     bucket_name, folder_path, _ = _get_details_from_gcs_path(
         gcs_bucket_path, use_new_tmp_folder)
-    bucket = client.get_bucket(bucket_name)
+    bucket = _get_bucket(bucket_name, project_id)
     for file in files:
-        filename = file.split('/')[-1]
-        blob = bucket.blob(folder_path + filename)
-        blob.upload_from_filename(filename=file)
+        _upload_file(bucket, folder_path, file)
     return "gs://" + bucket_name + "/" + folder_path
 
 
 def parallel_copy_files_to_gcs(files, gcs_bucket_path, project_id,
-                               use_new_tmp_folder=False):
-    """copies given files to GCS bucket path using multi-process
+                               use_new_tmp_folder=False, max_concurrency=8,
+                               upload_mode='simple', chunk_size=None):
+    """copies given files to GCS bucket path using a thread pool
+
+    Same as copy_files_to_gcs, except this method uploads up to
+    max_concurrency files at a time. All uploads share one client and
+    bucket handle.
 
-    Same as copy_files_to_gcs, except this method does a parallel upload
-    one file per process.
+    Args:
+        max_concurrency (int): Max parallel uploads, Default: 8
+        upload_mode (str): One of UPLOAD_MODES, see `FileUploader`
+        chunk_size (int, optional): Chunk size in bytes for the
+            resumable and composite upload modes
     """
-    _no_of_files = len(files)
     _validate_gcs_path(gcs_bucket_path)
-    _async_worker = async_worker.AsyncWorker(_no_of_files)
     if use_new_tmp_folder:
         # Add tmp folder outside and make sure all files are in the same path
-        gcs_bucket_path = gcs_bucket_path + str(uuid.uuid4()) + "/"
-    if _no_of_files == 1:
-        copy_files_to_gcs(
-            files=[files[0]],
-            gcs_bucket_path=gcs_bucket_path,
-            project_id=project_id,
-            use_new_tmp_folder=False
-        )
-    else:
-        for file in files:
-            _async_worker.send_data_to_worker(
-                worker_callback=copy_files_to_gcs,
-                files=[file],
-                gcs_bucket_path=gcs_bucket_path,
-                project_id=project_id,
-                use_new_tmp_folder=False
-            )
-        logging.debug('Waiting for all files to be uploaded to GCS...')
-        _async_worker.get_job_results()
+        gcs_bucket_path = new_tmp_folder_path(gcs_bucket_path)
+    bucket_name, folder_path, _ = _get_details_from_gcs_path(
+        gcs_bucket_path, False)
+    uploader = FileUploader(
+        _get_bucket(bucket_name, project_id), folder_path,
+        upload_mode=upload_mode, chunk_size=chunk_size,
+        max_concurrency=max_concurrency)
+    _start_time = time.time()
+    _no_of_threads = max(min(max_concurrency, len(files)), 1)
+    try:
+        with ThreadPoolExecutor(max_workers=_no_of_threads) as executor:
+            futures = [executor.submit(uploader.upload, file)
+                       for file in files]
+            logging.debug('Waiting for all files to be uploaded to GCS...')
+            _total_bytes = sum(future.result() for future in futures)
+    finally:
+        uploader.close()
+    logging.info("Uploaded {0} files to {1}, {2}".format(
+        len(files), gcs_bucket_path,
+        _throughput(_total_bytes, time.time() - _start_time)))
     return gcs_bucket_path
 
 
-def delete_files_in(gcs_bucket_path, project_id, delimiter=None):
+def new_tmp_folder_path(gcs_bucket_path):
+    """Returns a path to a new uniquely named folder in gcs_bucket_path
+    """
+    _validate_gcs_path(gcs_bucket_path)
+    if not gcs_bucket_path.endswith("/"):
+        gcs_bucket_path = gcs_bucket_path + "/"
+    return gcs_bucket_path + str(uuid.uuid4()) + "/"
+
+
+UPLOAD_MODES = ('simple', 'resumable', 'composite')
+# Max no of calls in a single GCS batch request
+_MAX_BATCH_SIZE = 100
+# Max no of source objects in a single GCS compose request
+_MAX_COMPOSE_SOURCES = 32
+# Resumable upload chunks have to be multiples of 256 KB
+_RESUMABLE_CHUNK_UNIT = 256 * 1024
+
+
+class FileUploader(object):
+    """Uploads local files into a GCS bucket folder
+
+    Upload modes:
+        simple: A single request per file, resumable for files over 8MB
+            with the client library's default chunk size.
+        resumable: Resumable upload in chunk_size chunks, files up to
+            8MB are still sent in a single request.
+        composite: Files over chunk_size are split into chunks, which
+            are uploaded concurrently as temporary objects and then
+            composed into the final object. Each failed chunk is
+            retried on its own. Chunks are made larger if needed to
+            fit into a single compose request.
+
+    Args:
+        bucket (google.cloud.storage.Bucket): Destination bucket
+        folder_path (str): Destination folder in bucket, ends with `/`
+        upload_mode (str): One of UPLOAD_MODES, Default: simple
+        chunk_size (int, optional): Chunk size in bytes, Default: 64MB
+        max_concurrency (int): Max parallel chunk uploads across all
+            files in composite mode, Default: 4
+        max_retries (int): Retries of a failed chunk, Default: 3
+    """
+
+    def __init__(self, bucket, folder_path, upload_mode='simple',
+                 chunk_size=None, max_concurrency=4, max_retries=3):
+        if upload_mode not in UPLOAD_MODES:
+            raise ValueError("Unknown upload_mode {}, should be one of {}"
+                             .format(upload_mode, UPLOAD_MODES))
+        self._bucket = bucket
+        self._folder_path = folder_path
+        self._upload_mode = upload_mode
+        self._chunk_size = chunk_size or 64 * 1024 * 1024
+        self._max_retries = max_retries
+        self._chunk_executor = None
+        if upload_mode == 'composite':
+            self._chunk_executor = ThreadPoolExecutor(
+                max_workers=max_concurrency)
+
+    def upload(self, file):
+        """Uploads a local file, named by its file name
+
+        Returns: (int)
+            Uploaded no of bytes
+        """
+        _size = os.path.getsize(file)
+        if self._upload_mode == 'composite' and _size > self._chunk_size:
+            return self._upload_composite(file, _size)
+        if self._upload_mode == 'resumable':
+            _chunk_size = max(
+                self._chunk_size // _RESUMABLE_CHUNK_UNIT, 1) * \
+                _RESUMABLE_CHUNK_UNIT
+            return _upload_file(self._bucket, self._folder_path, file,
+                                chunk_size=_chunk_size)
+        return _upload_file(self._bucket, self._folder_path, file)
+
+    def close(self):
+        if self._chunk_executor:
+            self._chunk_executor.shutdown()
+
+    def _upload_composite(self, file, size):
+        filename = file.split('/')[-1]
+        _start_time = time.time()
+        _chunk_size = max(
+            self._chunk_size, -(-size // _MAX_COMPOSE_SOURCES))
+        # Kept outside of the *.parq pattern of the loads
+        _chunk_prefix = "{0}_composite/{1}.".format(
+            self._folder_path, filename)
+        futures = []
+        for i, offset in enumerate(range(0, size, _chunk_size)):
+            futures.append(self._chunk_executor.submit(
+                _retry, self._max_retries, self._upload_chunk, file,
+                "{0}{1:05d}".format(_chunk_prefix, i),
+                offset, min(_chunk_size, size - offset)))
+        chunks = [future.result() for future in futures]
+        blob = self._bucket.blob(self._folder_path + filename)
+        _retry(self._max_retries, blob.compose, chunks)
+        for chunk in chunks:
+            chunk.delete()
+        logging.info("Uploaded {0} in {1} chunks, {2}".format(
+            file, len(chunks), _throughput(size, time.time() - _start_time)))
+        return size
+
+    def _upload_chunk(self, file, blob_name, offset, length):
+        blob = self._bucket.blob(blob_name)
+        with _FileSlice(file, offset, length) as file_slice:
+            blob.upload_from_file(file_slice, size=length)
+        return blob
+
+
+class _FileSlice(object):
+    """Read only file object over `length` bytes of a file from `offset`
+
+    Positions are relative to offset, so the slice looks like a whole
+    file to the upload calls.
+    """
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._file.seek(offset)
+
+    def read(self, size=-1):
+        _left = self._length - self.tell()
+        if size is None or size < 0 or size > _left:
+            size = _left
+        return self._file.read(max(size, 0))
+
+    def tell(self):
+        return self._file.tell() - self._offset
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos = self.tell() + pos
+        elif whence == os.SEEK_END:
+            pos = self._length + pos
+        self._file.seek(self._offset + pos)
+        return self.tell()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _retry(max_retries, fn, *args):
+    """Calls fn, retrying failures with an exponential backoff
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args)
+        except Exception as exc:
+            if attempt == max_retries:
+                raise
+            logging.warning("Retrying after error: {}".format(exc))
+            time.sleep(2 ** attempt)
+
+
+class QueueUploader(object):
+    """Uploads files from a FileQueue to GCS as they get written
+
+    Runs no_of_threads upload threads sharing one client and bucket
+    handle, each file is deleted from local disk once uploaded and its
+    space is released on the queue.
+    Stops once the queue is closed and drained, see `join`.
+
+    Args:
+        file_queue (FileQueue): Queue of local files to upload,
+            see `bqsqoop.utils.file_queue`
+        gcs_bucket_path (str): GCS folder to upload to, starts with gs://
+        project_id (str): Google project id
+        no_of_threads (int): Parallel uploads, Default: 4
+    """
+
+    def __init__(self, file_queue, gcs_bucket_path, project_id,
+                 no_of_threads=4, upload_mode='simple', chunk_size=None):
+        _validate_gcs_path(gcs_bucket_path)
+        self._file_queue = file_queue
+        self._gcs_bucket_path = gcs_bucket_path
+        self._project_id = project_id
+        self._no_of_threads = no_of_threads
+        self._upload_mode = upload_mode
+        self._chunk_size = chunk_size
+        self._threads = [
+            threading.Thread(target=self._upload_from_queue, daemon=True)
+            for _ in range(no_of_threads)]
+        self._lock = threading.Lock()
+        self._uploader = None
+        self.uploaded_files = []
+        self.errors = []
+
+    def start(self):
+        bucket_name, folder_path, _ = _get_details_from_gcs_path(
+            self._gcs_bucket_path, False)
+        self._uploader = FileUploader(
+            _get_bucket(bucket_name, self._project_id), folder_path,
+            upload_mode=self._upload_mode, chunk_size=self._chunk_size,
+            max_concurrency=self._no_of_threads)
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        """Waits for all uploads to finish
+
+        Returns: (list_of_str)
+            Uploaded local file paths, in the order they were uploaded
+        Raises:
+            RuntimeError if any of the uploads failed
+        """
+        for thread in self._threads:
+            thread.join()
+        if self._uploader:
+            self._uploader.close()
+        if self.errors:
+            raise RuntimeError(
+                "Upload to GCS failed: {}".format(self.errors[0]))
+        return self.uploaded_files
+
+    def _upload_from_queue(self):
+        while True:
+            _file = self._file_queue.get()
+            if _file is None:
+                return
+            _size = 0
+            try:
+                _size = os.path.getsize(_file)
+                self._uploader.upload(_file)
+                os.remove(_file)
+                logging.debug("Uploaded and removed {}".format(_file))
+                with self._lock:
+                    self.uploaded_files.append(_file)
+            except Exception as exc:
+                logging.error("Upload of {0} failed: {1}".format(_file, exc))
+                with self._lock:
+                    self.errors.append(exc)
+                # Unblocks the producers, the job is failing anyway
+                self._file_queue.close()
+            finally:
+                self._file_queue.done(_size)
+
+
+def delete_files_in(gcs_bucket_path, project_id, delimiter=None,
+                    max_concurrency=8):
     """Deletes all files in given GCS bucket path
 
+    Deletes are sent as GCS batch requests of up to 100 blobs each,
+    with up to max_concurrency batches in flight.
+
     Args:
         gcs_bucket_path (str): Should be a path in GCS.
             Starts with gs://
         delimiter (str): can be used to restrict the results to only the
             "files" in the given "folder". Without the delimiter,
             the entire tree under the prefix is returned.
+        max_concurrency (int): Max parallel batch requests, Default: 8
     Returns:
         None
     """
     _validate_gcs_path(gcs_bucket_path)
-    client = storage.Client(project=project_id)
     bucket_name, folder_path, _ = _get_details_from_gcs_path(
         gcs_bucket_path, False)
-    bucket = client.get_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=folder_path, delimiter=delimiter)
-    for blob in blobs:
-        blob.delete()
-        logging.debug("Deleted blob: {}".format(blob.name))
+    bucket = _get_bucket(bucket_name, project_id)
+    blob_names = [blob.name for blob in bucket.list_blobs(
+        prefix=folder_path, delimiter=delimiter)]
+    batches = [blob_names[i:i + _MAX_BATCH_SIZE]
+               for i in range(0, len(blob_names), _MAX_BATCH_SIZE)]
+    _thread_clients = threading.local()
+
+    def _delete_batch(names):
+        # A client tracks its open batch, so each thread needs its own
+        if not hasattr(_thread_clients, 'client'):
+            _thread_clients.client = storage.Client(project=project_id)
+        _client = _thread_clients.client
+        _bucket = _client.bucket(bucket_name)
+        with _client.batch():
+            for name in names:
+                _bucket.delete_blob(name)
+        logging.debug("Deleted {0} blobs in {1}".format(
+            len(names), gcs_bucket_path))
+
+    _no_of_threads = max(min(max_concurrency, len(batches)), 1)
+    with ThreadPoolExecutor(max_workers=_no_of_threads) as executor:
+        for future in [executor.submit(_delete_batch, names)
+                       for names in batches]:
+            future.result()
+
+
+def list_files_in(gcs_bucket_path, project_id, suffix=""):
+    """Lists the files in given GCS bucket path
+
+    Args:
+        gcs_bucket_path (str): Should be a path in GCS.
+            Starts with gs://
+        suffix (str): Only lists the files ending with it
+
+    Returns: (list of tuple)
+        gs:// uri and size in bytes of each file, sorted by uri
+    """
+    _validate_gcs_path(gcs_bucket_path)
+    bucket_name, folder_path, _ = _get_details_from_gcs_path(
+        gcs_bucket_path, False)
+    bucket = _get_bucket(bucket_name, project_id)
+    return sorted(
+        ("gs://{0}/{1}".format(bucket_name, blob.name), blob.size)
+        for blob in bucket.list_blobs(prefix=folder_path)
+        if blob.name.endswith(suffix))
 
 
 def download_file_as_string(gcs_uri):
@@ -98,7 +393,7 @@ def download_file_as_string(gcs_uri):
             Starts with gs://
 
     Returns: (str)
-        Files content as a string
+        Files content as a string, None if the file doesn't exist
     """
     _validate_gcs_path(gcs_uri)
     client = storage.Client()
@@ -106,9 +401,57 @@ def download_file_as_string(gcs_uri):
         gcs_uri, False)
     bucket = client.get_bucket(bucket_name)
     blob = bucket.get_blob(file_path)
+    if blob is None:
+        return None
     return blob.download_as_string()
 
 
+def upload_string_to_file(content, gcs_uri):
+    """Uploads a string as the file at given GCS uri
+
+    Args:
+        content (str): The file's content
+        gcs_uri (str): Should be a path in GCS.
+            Starts with gs://
+    """
+    _validate_gcs_path(gcs_uri)
+    client = storage.Client()
+    bucket_name, _, file_path = _get_details_from_gcs_path(
+        gcs_uri, False)
+    bucket = client.get_bucket(bucket_name)
+    bucket.blob(file_path).upload_from_string(content)
+
+
+def _get_bucket(bucket_name, project_id):
+    client = storage.Client(project=project_id)
+    return client.get_bucket(bucket_name)
+
+
+def _upload_file(bucket, folder_path, file, chunk_size=None):
+    """Uploads a local file into the bucket's folder_path
+
+    Returns: (int)
+        Uploaded no of bytes
+    """
+    filename = file.split('/')[-1]
+    _start_time = time.time()
+    if chunk_size:
+        blob = bucket.blob(folder_path + filename, chunk_size=chunk_size)
+    else:
+        blob = bucket.blob(folder_path + filename)
+    blob.upload_from_filename(filename=file)
+    _nbytes = os.path.getsize(file)
+    logging.info("Uploaded {0}, {1}".format(
+        file, _throughput(_nbytes, time.time() - _start_time)))
+    return _nbytes
+
+
+def _throughput(nbytes, seconds):
+    _mb = nbytes / (1024 * 1024)
+    return "{0:.1f} MB in {1:.2f} secs ({2:.1f} MB/s)".format(
+        _mb, seconds, _mb / max(seconds, 1e-6))
+
+
 def _validate_gcs_path(gcs_path):
     gcs_bucket_path_re_pattern = r'gs://.+'
     _match_obj = re.match(gcs_bucket_path_re_pattern, gcs_path)
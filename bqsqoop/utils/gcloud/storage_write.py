@@ -0,0 +1,203 @@
+"""Bigquery Storage Write API sink
+
+Appends Arrow data straight to a Bigquery table over pending write
+streams, instead of writing parquet files that are uploaded to GCS and
+loaded. Each extract worker writes its own stream, which is finalized
+when the worker is done, and `commit_streams` commits all of them at
+once, so the rows show up together or not at all.
+
+Needs the optional google-cloud-bigquery-storage package with Arrow
+appends (2.26+).
+"""
+import logging
+import pyarrow as pa
+
+from google.cloud import bigquery
+
+try:
+    from google.cloud import bigquery_storage_v1
+except ImportError:  # pragma: no cover
+    bigquery_storage_v1 = None
+
+
+# AppendRows requests are limited to 10MB, batches are kept under it
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+
+
+def is_available():
+    """Checks if the Storage Write API client is installed
+    """
+    return bigquery_storage_v1 is not None and hasattr(
+        bigquery_storage_v1.types.AppendRowsRequest, 'ArrowData')
+
+
+def table_path(project_id, dataset_name, table_name):
+    """The table's resource path used by the Storage Write API
+    """
+    return "projects/{0}/datasets/{1}/tables/{2}".format(
+        project_id, dataset_name, table_name)
+
+
+def commit_streams(table, streams):
+    """Commits finalized pending streams to the table atomically
+
+    Args:
+        table (str): Table path, see `table_path`
+        streams (list of str): Stream names, see `PendingStreamWriter`
+    """
+    _client = bigquery_storage_v1.BigQueryWriteClient()
+    _response = _client.batch_commit_write_streams(
+        bigquery_storage_v1.types.BatchCommitWriteStreamsRequest(
+            parent=table, write_streams=streams))
+    if _response.stream_errors:
+        raise Exception("Commit of {0} failed: {1}".format(
+            table, _response.stream_errors))
+    logging.info("Committed {0} write streams to {1}".format(
+        len(streams), table))
+
+
+class PendingStreamWriter(object):
+    """Appends Arrow tables to a pending write stream of a table
+
+    The table is created from the first table's schema if it doesn't
+    exist. Rows are only visible once the stream is committed with
+    `commit_streams`.
+
+    Args:
+        table (str): Table path, see `table_path`
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self._client = None
+        self._stream = None
+        self._schema = None
+        self.rows_written = 0
+
+    def write(self, table):
+        """Appends a pyarrow Table, in requests of up to MAX_REQUEST_BYTES
+        """
+        table = _for_write(table)
+        if self._stream is None:
+            self._open(table.schema)
+        _responses = self._client.append_rows(iter(self._requests(table)))
+        for _response in _responses:
+            if _response.error.code:
+                raise Exception("Append to {0} failed: {1}".format(
+                    self._stream.name, _response.error.message))
+        self.rows_written += table.num_rows
+
+    def close(self):
+        """Finalizes the stream, no more rows can be appended to it
+
+        Returns: (list of str)
+            The stream name to commit, empty if nothing was written
+        """
+        if self._stream is None:
+            return []
+        self._client.finalize_write_stream(name=self._stream.name)
+        logging.info("Wrote {0} rows to stream {1}".format(
+            self.rows_written, self._stream.name))
+        return [self._stream.name]
+
+    def _open(self, schema):
+        _create_table_if_needed(self._table, schema)
+        self._schema = schema
+        self._client = bigquery_storage_v1.BigQueryWriteClient()
+        _types = bigquery_storage_v1.types
+        self._stream = self._client.create_write_stream(
+            parent=self._table, write_stream=_types.WriteStream(
+                type_=_types.WriteStream.Type.PENDING))
+
+    def _requests(self, table):
+        _types = bigquery_storage_v1.types
+        _offset = self.rows_written
+        for i, batch in enumerate(_batches(table, MAX_REQUEST_BYTES)):
+            _arrow_rows = _types.AppendRowsRequest.ArrowData(
+                rows=_types.ArrowRecordBatch(
+                    serialized_record_batch=batch.serialize().to_pybytes()))
+            if i == 0:
+                # Only the first request of a connection has the schema
+                _arrow_rows.writer_schema = _types.ArrowSchema(
+                    serialized_schema=self._schema.serialize().to_pybytes())
+            _request = _types.AppendRowsRequest(
+                arrow_rows=_arrow_rows, offset=_offset)
+            if i == 0:
+                _request.write_stream = self._stream.name
+            _offset += batch.num_rows
+            yield _request
+
+
+def _for_write(table):
+    # The Write API takes timestamps in microseconds
+    _schema = pa.schema([field.with_type(_write_type(field.type))
+                         for field in table.schema])
+    if _schema.equals(table.schema):
+        return table
+    return table.cast(_schema, safe=False)
+
+
+def _write_type(arrow_type):
+    if pa.types.is_timestamp(arrow_type) and arrow_type.unit == 'ns':
+        return pa.timestamp('us', arrow_type.tz)
+    if pa.types.is_struct(arrow_type):
+        return pa.struct([field.with_type(_write_type(field.type))
+                          for field in arrow_type])
+    if pa.types.is_list(arrow_type):
+        return pa.list_(arrow_type.value_field.with_type(
+            _write_type(arrow_type.value_type)))
+    return arrow_type
+
+
+def _batches(table, max_bytes):
+    # Record batches of at most max_bytes, by their average row size
+    for batch in table.to_batches():
+        _rows_per_batch = max(
+            int(max_bytes / max(batch.nbytes / max(batch.num_rows, 1), 1)),
+            1)
+        for start in range(0, batch.num_rows, _rows_per_batch):
+            yield batch.slice(start, _rows_per_batch)
+
+
+def _create_table_if_needed(table, schema):
+    _, project_id, _, dataset_name, _, table_name = table.split("/")
+    _client = bigquery.Client(project=project_id)
+    _client.create_table(bigquery.Table(
+        "{0}.{1}.{2}".format(project_id, dataset_name, table_name),
+        schema=bq_schema(schema)), exists_ok=True)
+
+
+_BQ_TYPES = [
+    (pa.types.is_boolean, 'BOOLEAN'),
+    (pa.types.is_integer, 'INTEGER'),
+    (pa.types.is_floating, 'FLOAT'),
+    (pa.types.is_decimal, 'NUMERIC'),
+    (pa.types.is_string, 'STRING'),
+    (pa.types.is_large_string, 'STRING'),
+    (pa.types.is_binary, 'BYTES'),
+    (pa.types.is_timestamp, 'TIMESTAMP'),
+    (pa.types.is_date, 'DATE'),
+    (pa.types.is_time, 'TIME'),
+]
+
+
+def bq_schema(arrow_schema):
+    """Bigquery schema of an Arrow schema, like a parquet load infers it
+
+    Structs are RECORD and lists REPEATED fields.
+
+    Returns: (list of bigquery.SchemaField)
+    """
+    return [_bq_field(field.name, field.type) for field in arrow_schema]
+
+
+def _bq_field(name, arrow_type, mode='NULLABLE'):
+    if pa.types.is_list(arrow_type):
+        return _bq_field(name, arrow_type.value_type, mode='REPEATED')
+    if pa.types.is_struct(arrow_type):
+        return bigquery.SchemaField(
+            name, 'RECORD', mode=mode, fields=[
+                _bq_field(field.name, field.type) for field in arrow_type])
+    _type = next((bq_type for is_type, bq_type in _BQ_TYPES
+                  if is_type(arrow_type)), 'STRING')
+    return bigquery.SchemaField(name, _type, mode=mode)
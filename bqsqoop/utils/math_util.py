@@ -46,3 +46,47 @@ def calculate_splits(min_value, max_value, n):
         return fn(min_value, max_value, n)
     else:
         raise Exception("Type of the split-by column is not supported.")
+
+
+# Smallest increment of a split-by value, used to cut splits right
+# after a boundary value. Microseconds is the timestamp precision of
+# most DBs.
+_step_map = {
+    int: 1,
+    datetime: timedelta(microseconds=1)
+}
+
+
+def calculate_splits_from_buckets(min_value, max_value, buckets):
+    """Turns key buckets into contiguous, non overlapping splits
+
+    Args:
+        min_value: Smallest value of the split-by column
+        max_value: Largest value of the split-by column
+        buckets (list of tuple): Sorted (start, end, rows) of each
+            bucket, eg., from an NTILE or a sampled NTILE query
+
+    Adjacent buckets sharing a boundary value are cut right after
+    that value, so no row falls in two splits. The first and the last
+    splits are stretched to min_value and max_value, which covers
+    rows missed by sampling.
+
+    Returns:
+        list of dict with start, end and estimated rows of each split
+    """
+    step = _step_map.get(type(min_value))
+    if not step:
+        raise Exception("Type of the split-by column is not supported.")
+    splits = []
+    for start, end, rows in buckets:
+        if splits:
+            if end <= splits[-1]['end']:
+                splits[-1]['rows'] += rows
+                continue
+            start = splits[-1]['end'] + step
+        else:
+            start = min_value
+        splits.append({'start': start, 'end': end, 'rows': rows})
+    if splits:
+        splits[-1]['end'] = max(splits[-1]['end'], max_value)
+    return splits
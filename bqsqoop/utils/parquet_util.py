@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
@@ -6,15 +7,90 @@ from datetime import datetime
 from bqsqoop.utils.pandas_util import PandasUtil
 
 
+# pq.ParquetWriter options settable from the [parquet] config section
+WRITER_OPTIONS = ('compression', 'compression_level', 'use_dictionary',
+                  'data_page_size', 'write_statistics')
+COMPRESSION_CODECS = ('none', 'snappy', 'gzip', 'brotli', 'zstd', 'lz4')
+
+
+def validate_writer_options(writer_options):
+    """Checks the writer options of `ParquetUtil`
+
+    Returns: (dict)
+        Errors by option name, empty if the options are valid
+    """
+    errors = {}
+    for option in writer_options:
+        if option not in WRITER_OPTIONS:
+            errors[option] = "should be one of {}".format(
+                ", ".join(WRITER_OPTIONS))
+    _codec = writer_options.get('compression', 'snappy')
+    if _codec not in COMPRESSION_CODECS:
+        errors['compression'] = "should be one of {}".format(
+            ", ".join(COMPRESSION_CODECS))
+    elif _codec != 'none' and not pa.Codec.is_available(_codec):
+        errors['compression'] = "{} isn't available in pyarrow".format(
+            _codec)
+    elif 'compression_level' in writer_options and (
+            _codec == 'none' or
+            not pa.Codec.supports_compression_level(_codec)):
+        # Writers would fail on their first write otherwise
+        errors['compression_level'] = \
+            "isn't supported by {} compression".format(_codec)
+    return errors
+
+
 class ParquetUtil():
-    def __init__(self, output_file):
+    def __init__(self, output_file, row_group_bytes=None,
+                 output_queue=None, max_file_bytes=None, max_file_rows=None,
+                 writer_options=None, storage_write_table=None):
         """Helper for writing Parquet files
 
         Args:
             output_file (str): output file name with full path
+            row_group_bytes (int, optional): If given, appended data is
+                buffered in memory and written as one row group once the
+                buffer reaches this size (in Arrow bytes), instead of a
+                row group per append.
+            output_queue (FileQueue, optional): If given, waits for disk
+                space on it before starting each file and puts the file
+                on it once closed. see `bqsqoop.utils.file_queue`
+            max_file_bytes (int, optional): Starts a new part file once
+                the current one reaches this size on disk, checked after
+                each row group.
+            max_file_rows (int, optional): Max no of rows in a part file
+            writer_options (dict, optional): `WRITER_OPTIONS` for each
+                file's pq.ParquetWriter, eg., compression="zstd",
+                compression_level=3, use_dictionary=["country"] or
+                data_page_size=1048576. Defaults to pyarrow's.
+            storage_write_table (str, optional): Table path to append the
+                data to with the Bigquery Storage Write API instead of
+                writing files, see `gcloud.storage_write`. output_files
+                are then the pending stream to commit.
+
+        With max_file_bytes or max_file_rows, data is written to ordered
+        part files named `<output_file name>_00000.parq`,
+        `<output_file name>_00001.parq`.. instead of output_file.
+        `output_files` lists all the written files.
         """
         self._output_file = output_file
+        self._output_queue = output_queue
         self._pqwriter = None
+        self._row_group_bytes = row_group_bytes
+        self._max_file_bytes = max_file_bytes
+        self._max_file_rows = max_file_rows
+        self._writer_options = writer_options or {}
+        self._stream_writer = None
+        if storage_write_table:
+            from bqsqoop.utils.gcloud import storage_write
+            self._stream_writer = storage_write.PendingStreamWriter(
+                storage_write_table)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._file_rows = 0
+        self.bytes_appended = 0
+        self.rows_appended = 0
+        self.output_files = []
 
     @classmethod
     def fix_dataframe_for_schema(self, df, arrow_schema, datetime_format=None):
@@ -22,6 +98,8 @@ class ParquetUtil():
 
         Since arrow has strict types and pandas is not so,
         this function can help fix some of those issues.
+        `arrow_util.table_from_pandas` does the same without copying
+        the dataframe and is what the extractors use.
 
         Args:
             df (obj): A pandas dataframe
@@ -62,6 +140,9 @@ class ParquetUtil():
                         "column_name_3": "int",
                         ..etc
                     }
+                A dict type is a struct of its column schema, and a
+                list of one type a list of that type. eg.,
+                    {"address": {"city": "text"}, "tags": ["text"]}
 
         Returns: (pyarrow.Schema)
             returns built schema for pyarrow
@@ -86,11 +167,22 @@ class ParquetUtil():
             datetime: pa.timestamp('ns'),
             bool: pa.bool_(),
         }
+
+        def _arrow_type(col_type):
+            if isinstance(col_type, dict):
+                return pa.struct([
+                    pa.field(name=name, type=_arrow_type(sub_type),
+                             nullable=True)
+                    for name, sub_type in col_type.items()])
+            if isinstance(col_type, list):
+                return pa.list_(_arrow_type(col_type[0]))
+            return column_types_map.get(col_type, pa.string())
+
         for col_name, col_type in column_schema.items():
             fields.append(
                 pa.field(
                     name=col_name,
-                    type=column_types_map.get(col_type, pa.string()),
+                    type=_arrow_type(col_type),
                     nullable=True))
         return pa.schema(fields=fields)
 
@@ -113,8 +205,7 @@ class ParquetUtil():
         """
         table = pa.Table.from_pandas(df, preserve_index=preserve_index,
                                      schema=schema)
-        self._pqwriter = pq.ParquetWriter(self._output_file, table.schema)
-        self._pqwriter.write_table(table)
+        self._write_table(table)
         if close_writer:
             self.close()
 
@@ -133,20 +224,106 @@ class ParquetUtil():
                 Arrow Table. This can be used to indicate the type of columns
                 if we cannot infer it automatically.
         """
+        table = pa.Table.from_pandas(
+            df, preserve_index=preserve_index, schema=schema)
+        self.append_table_to_parquet(table)
+
+    def append_table_to_parquet(self, table):
+        """Writes a pyarrow Table to the Parquet file in Append mode
+
+        Same as append_df_to_parquet, but skips the pandas conversion
+        for callers which already build Arrow data.
+        Need to call close() after done with all appends.
+
+        Args:
+            table (pyarrow.Table): Data to be written to parquet file.
+        """
+        _nbytes = table.nbytes
+        self.bytes_appended += _nbytes
+        self.rows_appended += table.num_rows
+        if not self._row_group_bytes:
+            self._write_table(table)
+            return
+        self._buffer.append(table)
+        self._buffered_bytes += _nbytes
+        if self._buffered_bytes >= self._row_group_bytes:
+            self.flush()
+
+    def append_record_batch_to_parquet(self, batch):
+        """Writes a pyarrow RecordBatch to the Parquet file in Append mode
+
+        Args:
+            batch (pyarrow.RecordBatch): Data to be written to parquet file.
+        """
+        self.append_table_to_parquet(pa.Table.from_batches([batch]))
+
+    def flush(self):
+        """Writes the buffered data as a single row group
+
+        No-op when nothing is buffered.
+        """
+        if not self._buffer:
+            return
+        table = pa.concat_tables(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._write_table(table, row_group_size=table.num_rows)
+
+    def _write_table(self, table, row_group_size=None):
+        if self._stream_writer:
+            self._stream_writer.write(table)
+            return
+        # Tables crossing max_file_rows are split across part files
+        while self._max_file_rows and \
+                self._file_rows + table.num_rows > self._max_file_rows:
+            _room = self._max_file_rows - self._file_rows
+            self._write_to_file(table.slice(0, _room),
+                                row_group_size and _room)
+            table = table.slice(_room)
+        self._write_to_file(table, row_group_size and table.num_rows)
+
+    def _write_to_file(self, table, row_group_size=None):
         if not self._pqwriter:
-            self.write_df_to_parquet(df, preserve_index=preserve_index,
-                                     close_writer=False, schema=schema)
-        else:
-            table = pa.Table.from_pandas(
-                df, preserve_index=preserve_index, schema=schema)
-            self._pqwriter.write_table(table)
+            if self._output_queue is not None:
+                self._output_queue.wait_for_space()
+            _file = self._next_file_path()
+            self._pqwriter = pq.ParquetWriter(
+                _file, table.schema, **self._writer_options)
+            self.output_files.append(_file)
+        self._pqwriter.write_table(table, row_group_size=row_group_size)
+        self._file_rows += table.num_rows
+        if self._max_file_rows and self._file_rows >= self._max_file_rows:
+            self._close_file()
+        elif self._max_file_bytes and os.path.getsize(
+                self.output_files[-1]) >= self._max_file_bytes:
+            self._close_file()
+
+    def _next_file_path(self):
+        if not (self._max_file_bytes or self._max_file_rows):
+            return self._output_file
+        _name, _ext = os.path.splitext(self._output_file)
+        return "{}_{:05d}{}".format(_name, len(self.output_files), _ext)
+
+    def _close_file(self):
+        self._pqwriter.close()
+        self._pqwriter = None
+        self._file_rows = 0
+        if self._output_queue is not None:
+            self._output_queue.put(self.output_files[-1])
 
     def close(self):
         """Closes the parquet writer to the output file
 
+        Flushes any buffered data before closing.
         It's safe to call it multiple times, will only close if a writer
         is open.
+
+        Returns: (list of str)
+            All the files written, see `output_files`
         """
+        self.flush()
         if self._pqwriter:
-            self._pqwriter.close()
-            self._pqwriter = None
+            self._close_file()
+        if self._stream_writer and not self.output_files:
+            self.output_files = self._stream_writer.close()
+        return self.output_files
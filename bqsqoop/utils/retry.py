@@ -0,0 +1,59 @@
+import time
+import logging
+
+
+class RetryPolicy(object):
+    """Retries of a failed split with exponential backoff
+
+    Args:
+        max_attempts (int): Attempts including the first one, 1 disables
+            retries.
+        backoff_secs (float): Wait before the first retry, doubled for
+            each retry after that.
+        max_backoff_secs (float): Cap on the wait between attempts
+        retry_on (tuple of Exception classes): Errors that are retried,
+            others fail right away.
+    """
+
+    def __init__(self, max_attempts=1, backoff_secs=1, max_backoff_secs=300,
+                 retry_on=(Exception,)):
+        self.max_attempts = max_attempts
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.retry_on = retry_on
+
+    def should_retry(self, attempt, exc):
+        """Whether to retry after the attempt (1 based) failed with exc
+        """
+        return attempt < self.max_attempts and \
+            isinstance(exc, self.retry_on)
+
+    def backoff(self, attempt):
+        """Seconds to wait after the attempt (1 based) failed
+        """
+        return min(self.backoff_secs * 2 ** (attempt - 1),
+                   self.max_backoff_secs)
+
+
+def call_with_retries(retry_policy, fn, **args):
+    """Calls fn with args, retrying errors as per the retry_policy
+
+    Used for the splits run in this process, pooled jobs are retried by
+    `AsyncWorker` with its retry_policy instead.
+    """
+    attempt = 1
+    while True:
+        _start = time.time()
+        try:
+            return fn(**args)
+        except Exception as exc:
+            logging.warning(
+                "Attempt {0} of {1} failed after {2:.1f} secs: {3!r}".format(
+                    attempt, fn.__name__, time.time() - _start, exc))
+            if not retry_policy.should_retry(attempt, exc):
+                raise
+            _wait = retry_policy.backoff(attempt)
+            logging.info("Retrying {0} in {1} secs".format(
+                fn.__name__, _wait))
+            time.sleep(_wait)
+            attempt += 1
@@ -0,0 +1,91 @@
+import os
+import json
+import decimal
+import logging
+import pandas as pd
+
+from datetime import date, datetime
+from bqsqoop.utils.gcloud import storage
+
+
+class WatermarkState(object):
+    """High-watermark of an incremental extract
+
+    Keeps the largest extracted value of the watermark field in a JSON
+    state file, a local path or a GCS uri (gs://). Values keep their
+    type, so datetimes are compared as datetimes on the next run.
+
+    Args:
+        path (str): Local file path or GCS uri of the state
+        field (str): The watermark field, a state saved for another
+            field is ignored.
+    """
+
+    def __init__(self, path, field):
+        self._path = path
+        self._field = field
+
+    def read(self):
+        """Reads the last saved watermark
+
+        Returns:
+            The watermark value, None if there's no state yet
+        """
+        if self._path.startswith("gs://"):
+            _content = storage.download_file_as_string(self._path)
+        elif os.path.exists(self._path):
+            with open(self._path) as f:
+                _content = f.read()
+        else:
+            _content = None
+        if not _content:
+            return None
+        _state = json.loads(_content)
+        if _state.get('field') != self._field:
+            logging.warning(
+                "Ignoring watermark state of {0} in {1}".format(
+                    _state.get('field'), self._path))
+            return None
+        return _decode(_state['type'], _state['value'])
+
+    def save(self, value):
+        """Saves the watermark, once its rows are loaded
+        """
+        _type, _value = _encode(value)
+        _content = json.dumps(
+            {'field': self._field, 'type': _type, 'value': _value})
+        if self._path.startswith("gs://"):
+            storage.upload_string_to_file(_content, self._path)
+        else:
+            # Written next to the state and renamed, a failed write
+            # doesn't lose the previous watermark
+            _tmp_path = self._path + ".tmp"
+            with open(_tmp_path, "w") as f:
+                f.write(_content)
+            os.replace(_tmp_path, self._path)
+        logging.info("Saved watermark {0}={1}".format(self._field, value))
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return 'datetime', value.isoformat()
+    if isinstance(value, date):
+        return 'date', value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return 'decimal', str(value)
+    if isinstance(value, (bool, int, float, str)):
+        return type(value).__name__, value
+    raise TypeError(
+        "Unsupported watermark type {}".format(type(value).__name__))
+
+
+# No fromisoformat before python 3.7
+_decoders = {
+    'datetime': lambda v: pd.Timestamp(v).to_pydatetime(),
+    'date': lambda v: datetime.strptime(v, "%Y-%m-%d").date(),
+    'decimal': decimal.Decimal,
+}
+
+
+def _decode(_type, value):
+    return _decoders.get(_type, lambda v: v)(value)
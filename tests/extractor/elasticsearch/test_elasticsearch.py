@@ -1,8 +1,10 @@
 import pytest
 import unittest
 
+from datetime import datetime
+
 from unittest.mock import patch, MagicMock
-from bqsqoop.utils.errors import MissingConfigError
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
 from bqsqoop.extractor.elasticsearch import ElasticSearchExtractor
 
 
@@ -37,6 +39,208 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(_e._scroll_size, 1000)
         self.assertEqual(_e._fields, ['_all'])
         self.assertEqual(_e._output_folder, './F43C2651')
+        self.assertEqual(_e._engine, 'scroll')
+
+    def test_invalid_engine(self):
+        _e = ElasticSearchExtractor(dict(_valid_config, engine='unknown'))
+        with pytest.raises(InvalidConfigError, match=r'.* engine .*'):
+            _e.validate_config()
+
+    def test_search_after_needs_sort_field_or_point_in_time(self):
+        _config = dict(_valid_config, engine='search_after')
+        with pytest.raises(MissingConfigError, match=r'.* sort_field .*'):
+            ElasticSearchExtractor(_config).validate_config()
+        ElasticSearchExtractor(
+            dict(_config, sort_field='id')).validate_config()
+        ElasticSearchExtractor(
+            dict(_config, point_in_time=True)).validate_config()
+
+    def test_invalid_prefetch_pages(self):
+        _e = ElasticSearchExtractor(dict(_valid_config, prefetch_pages=4))
+        with pytest.raises(InvalidConfigError, match=r'.* prefetch_pages .*'):
+            _e.validate_config()
+
+    def test_invalid_serializer(self):
+        _e = ElasticSearchExtractor(dict(_valid_config, serializer='yaml'))
+        with pytest.raises(InvalidConfigError, match=r'.* serializer .*'):
+            _e.validate_config()
+
+    @patch('bqsqoop.extractor.elasticsearch.serializer.is_available',
+           return_value=False)
+    def test_serializer_not_installed(self, is_available):
+        _e = ElasticSearchExtractor(dict(_valid_config, serializer='ujson'))
+        with pytest.raises(InvalidConfigError, match=r'ujson is not'):
+            _e.validate_config()
+
+    def test_invalid_pool_size(self):
+        _e = ElasticSearchExtractor(dict(_valid_config, pool_size=0))
+        with pytest.raises(InvalidConfigError, match=r'.* pool_size .*'):
+            _e.validate_config()
+
+    def test_sliced_search_after_needs_point_in_time(self):
+        _config = dict(_valid_config, engine='search_after',
+                       sort_field='id', no_of_workers=2)
+        with pytest.raises(InvalidConfigError, match=r'.* point_in_time'):
+            ElasticSearchExtractor(_config).validate_config()
+        ElasticSearchExtractor(
+            dict(_config, point_in_time=True)).validate_config()
+
+    def test_time_configs_need_time_field(self):
+        for _config in ({'start_time': '2018-09-10'},
+                        {'daily_index': 'logs-%Y.%m.%d'}):
+            _e = ElasticSearchExtractor(dict(_valid_config, **_config))
+            with pytest.raises(MissingConfigError, match=r'.* time_field .*'):
+                _e.validate_config()
+
+    def test_invalid_time_window(self):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, time_field='created_at',
+            start_time='2018-09-11', end_time='2018-09-10'))
+        with pytest.raises(InvalidConfigError, match=r'.* start_time .*'):
+            _e.validate_config()
+
+    def test_daily_index_with_point_in_time(self):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, time_field='created_at', engine='search_after',
+            point_in_time=True, daily_index='logs-%Y.%m.%d'))
+        with pytest.raises(InvalidConfigError, match=r'.* daily_index .*'):
+            _e.validate_config()
+
+    def test_sliced_search_after_on_time_ranges(self):
+        ElasticSearchExtractor(dict(
+            _valid_config, engine='search_after', sort_field='id',
+            no_of_workers=2, time_field='created_at')).validate_config()
+
+
+def _time_range(search_args):
+    return search_args['body']['query']['bool']['filter'][1]['range']
+
+
+class TestTimeRanges(unittest.TestCase):
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_time_window_splits(self, es_helper):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, no_of_workers=1, time_field='created_at',
+            start_time='2018-09-10T00:00:00Z',
+            end_time='2018-09-10T00:00:10Z', no_of_time_splits=3))
+        _e.validate_config()
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
+
+        self.assertEqual(_e.extract_to_parquet(), ["file1.parq"] * 3)
+        es_helper.get_time_range.assert_not_called()
+        _call_args = es_helper.scroll_and_extract_data.call_args_list
+        # 2018-09-10T00:00:00Z in epoch millis
+        _start = 1536537600000
+        self.assertEqual(
+            [_time_range(kwargs['search_args']) for _, kwargs in _call_args],
+            [{'created_at': {'gte': _start + _gte, 'lt': _start + _lt,
+                             'format': 'epoch_millis'}}
+             for _gte, _lt in ((0, 4000), (4000, 8000), (8000, 10000))])
+        _, _kwargs = _call_args[0]
+        self.assertEqual(_kwargs['total_worker_count'], 1)
+        self.assertEqual(_kwargs['search_args']['index'], 'some_es_index')
+        self.assertEqual(
+            _kwargs['search_args']['body']['query']['bool']['filter'][0],
+            {'match_all': {}})
+
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_time_window_from_index(self, es_helper):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, no_of_workers=1, time_field='created_at',
+            no_of_time_splits=1))
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.get_time_range.return_value = (
+            datetime(2018, 9, 10), datetime(2018, 9, 10, 0, 0, 5))
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
+
+        _e.extract_to_parquet()
+        es_helper.get_time_range.assert_called_once_with(
+            'es_endpoint', 'some_es_index', 'created_at')
+        _, _kwargs = es_helper.scroll_and_extract_data.call_args
+        # Includes the latest document
+        self.assertEqual(_time_range(_kwargs['search_args']), {
+            'created_at': {'gte': 1536537600000, 'lt': 1536537605001,
+                           'format': 'epoch_millis'}})
+
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_empty_index(self, es_helper):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, no_of_workers=1, time_field='created_at'))
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.get_time_range.return_value = (None, None)
+
+        self.assertEqual(_e.extract_to_parquet(), [])
+        es_helper.scroll_and_extract_data.assert_not_called()
+
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_daily_index(self, es_helper):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, no_of_workers=1, time_field='created_at',
+            daily_index='logs-%Y.%m.%d', start_time='2018-09-10T12:00:00',
+            end_time='2018-09-12T06:00:00'))
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.scroll_and_extract_data.return_value = []
+
+        _e.extract_to_parquet()
+        _search_args = [
+            kwargs['search_args'] for _, kwargs in
+            es_helper.scroll_and_extract_data.call_args_list]
+        self.assertEqual([_args['index'] for _args in _search_args],
+                         ['logs-2018.09.10', 'logs-2018.09.11',
+                          'logs-2018.09.12'])
+        self.assertTrue(all(_args['ignore_unavailable']
+                            for _args in _search_args))
+        # Days are clipped to the window
+        _day = 24 * 3600 * 1000
+        _start = 1536537600000
+        self.assertEqual(
+            [(_time_range(_args)['created_at']['gte'] - _start,
+              _time_range(_args)['created_at']['lt'] - _start)
+             for _args in _search_args],
+            [(_day // 2, _day), (_day, 2 * _day),
+             (2 * _day, 2 * _day + _day // 4)])
+
+
+class TestIncrementalExtract(unittest.TestCase):
+    def test_needs_watermark_state(self):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, watermark_field='updated_at'))
+        with pytest.raises(MissingConfigError, match=r'.* watermark_state'):
+            _e.validate_config()
+
+    @patch('bqsqoop.utils.watermark.WatermarkState.read',
+           return_value='2018-09-10T00:00:00.000Z')
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_docs_after_watermark(self, es_helper, read_state):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, no_of_workers=1, watermark_field='updated_at',
+            watermark_state='state.json'))
+        es_helper.get_max_value.return_value = '2018-09-11T00:00:00.000Z'
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
+
+        self.assertTrue(_e.prepare_increment())
+        es_helper.get_max_value.assert_called_with(
+            'es_endpoint', 'some_es_index', 'updated_at',
+            {'range': {'updated_at': {'gt': '2018-09-10T00:00:00.000Z'}}})
+        self.assertEqual(_e.extract_to_parquet(), ["file1.parq"])
+        _, _kwargs = es_helper.scroll_and_extract_data.call_args
+        self.assertEqual(_kwargs['search_args']['body']['query'], {
+            'range': {'updated_at': {
+                'gt': '2018-09-10T00:00:00.000Z',
+                'lte': '2018-09-11T00:00:00.000Z'}}})
+
+    @patch('bqsqoop.utils.watermark.WatermarkState.read', return_value=None)
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_empty_index(self, es_helper, read_state):
+        _e = ElasticSearchExtractor(dict(
+            _valid_config, watermark_field='id', watermark_state='s.json'))
+        es_helper.get_max_value.return_value = None
+
+        self.assertFalse(_e.prepare_increment())
+        es_helper.get_max_value.assert_called_with(
+            'es_endpoint', 'some_es_index', 'id', {'match_all': {}})
 
 
 class TestExtractToParquet(unittest.TestCase):
@@ -52,11 +256,12 @@ class TestExtractToParquet(unittest.TestCase):
         async_worker.return_value = _mock_worker
         _mock_send_data_to_worker = MagicMock()
         _mock_worker.send_data_to_worker = _mock_send_data_to_worker
-        _mock_job_results = MagicMock(return_value=["file1.parq"])
+        _mock_job_results = MagicMock(return_value=[["file1.parq"]])
         _mock_worker.get_job_results = _mock_job_results
         _search_args = {
             'index': 'some_es_index', 'scroll': '60s',
             'size': 1000, 'body': {'query': {'match_all': {}}},
+            'filter_path': 'hits.hits._source,_scroll_id,hits.total',
             '_source_include': 'fieldA,fieldB'
         }
 
@@ -82,6 +287,31 @@ class TestExtractToParquet(unittest.TestCase):
         es_helper.get_fields.assert_called_with(
             'es_endpoint', 'some_es_index')
 
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    def test_splits_per_worker(self, async_worker, es_helper):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 2
+        config['splits_per_worker'] = 3
+        _e = ElasticSearchExtractor(config)
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        _mock_worker = MagicMock()
+        async_worker.return_value = _mock_worker
+
+        _e.extract_to_parquet()
+        async_worker.assert_called_with(2)
+        es_helper.get_fields.assert_called_once()
+        _call_args = _mock_worker.send_data_to_worker.call_args_list
+        self.assertEqual(len(_call_args), 6)
+        self.assertEqual(
+            [kwargs['worker_id'] for _, kwargs in _call_args],
+            [0, 1, 2, 3, 4, 5])
+        for _, kwargs in _call_args:
+            self.assertEqual(kwargs['total_worker_count'], 6)
+        # slices can't share the search_args they add slicing to
+        self.assertIsNot(_call_args[0][1]['search_args'],
+                         _call_args[1][1]['search_args'])
+
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
     @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
     def test_extract_specific_fields_with_single_worker(
@@ -93,7 +323,7 @@ class TestExtractToParquet(unittest.TestCase):
         es_helper.get_fields = MagicMock()
         es_helper.get_fields.return_value = {
             "field1": "int", "field2": "bool", "ignored_field": "text"}
-        es_helper.scroll_and_extract_data.return_value = "file1.parq"
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
 
         self.assertEqual(_e.extract_to_parquet(), ["file1.parq"])
         es_helper.scroll_and_extract_data.assert_called_with(
@@ -103,6 +333,7 @@ class TestExtractToParquet(unittest.TestCase):
             search_args={
                 'index': 'some_es_index', 'scroll': '60s', 'size': 1000,
                 'body': {'query': {'match_all': {}}},
+                'filter_path': 'hits.hits._source,_scroll_id,hits.total',
                 '_source_include': 'field1,field2'},
             total_worker_count=1,
             worker_id=0,
@@ -124,7 +355,7 @@ class TestExtractToParquet(unittest.TestCase):
         es_helper.get_fields = MagicMock()
         es_helper.get_fields.return_value = {
             "field1": "int", "field2": "bool", "ignored_field": "text"}
-        es_helper.scroll_and_extract_data.return_value = "file1.parq"
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
 
         self.assertEqual(_e.extract_to_parquet(), ["file1.parq"])
         es_helper.scroll_and_extract_data.assert_called_with(
@@ -134,6 +365,7 @@ class TestExtractToParquet(unittest.TestCase):
             search_args={
                 'index': 'some_es_index', 'scroll': '60s', 'size': 1000,
                 'body': {'query': {'match_all': {}}},
+                'filter_path': 'hits.hits._source,_scroll_id,hits.total',
                 '_source_include': 'field1,field2'},
             total_worker_count=1,
             worker_id=0,
@@ -143,3 +375,76 @@ class TestExtractToParquet(unittest.TestCase):
             },
             datetime_format='some datetime_format'
         )
+
+    @patch('bqsqoop.extractor.elasticsearch.search_after.'
+           'close_point_in_time')
+    @patch('bqsqoop.extractor.elasticsearch.search_after.open_point_in_time',
+           return_value='pit1')
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    def test_search_after_with_point_in_time(
+            self, async_worker, es_helper, open_pit, close_pit):
+        config = dict(_valid_config, no_of_workers=2, engine='search_after',
+                      point_in_time=True)
+        _e = ElasticSearchExtractor(config)
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        _mock_worker = MagicMock()
+        async_worker.return_value = _mock_worker
+        _mock_worker.get_job_results.return_value = [["file1.parq"], []]
+
+        self.assertEqual(_e.extract_to_parquet(), ["file1.parq"])
+        open_pit.assert_called_once_with(
+            'es_endpoint', 'some_es_index', '60s')
+        close_pit.assert_called_once_with('es_endpoint', 'pit1')
+        for _, kwargs in _mock_worker.send_data_to_worker.call_args_list:
+            self.assertEqual(
+                kwargs['worker_callback'].__name__,
+                'search_after_and_extract_data')
+            self.assertEqual(kwargs['pit_id'], 'pit1')
+            self.assertIsNone(kwargs['sort_field'])
+
+    @patch('bqsqoop.extractor.elasticsearch.search_after.'
+           'close_point_in_time')
+    @patch('bqsqoop.extractor.elasticsearch.search_after.open_point_in_time',
+           return_value='pit1')
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    def test_point_in_time_closed_on_failure(
+            self, async_worker, es_helper, open_pit, close_pit):
+        config = dict(_valid_config, no_of_workers=2, engine='search_after',
+                      point_in_time=True)
+        _e = ElasticSearchExtractor(config)
+        async_worker.return_value.get_job_results.side_effect = \
+            Exception("worker failed")
+
+        with pytest.raises(Exception, match='worker failed'):
+            _e.extract_to_parquet()
+        close_pit.assert_called_once_with('es_endpoint', 'pit1')
+
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_parquet_writer_options(self, es_helper):
+        _e = ElasticSearchExtractor(
+            dict(_valid_config, no_of_workers=1),
+            parquet_config={'compression': 'gzip'})
+        _e.validate_config()
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.scroll_and_extract_data.return_value = []
+
+        _e.extract_to_parquet()
+        _, _kwargs = es_helper.scroll_and_extract_data.call_args
+        self.assertEqual(_kwargs['writer_options'], {'compression': 'gzip'})
+
+    @patch('bqsqoop.extractor.elasticsearch.helper.ESHelper')
+    def test_client_options(self, es_helper):
+        config = dict(_valid_config, no_of_workers=1, pool_size=4,
+                      http_compress=False, timeout='60s')
+        _e = ElasticSearchExtractor(config)
+        es_helper.get_fields.return_value = {"fieldA": "int"}
+        es_helper.scroll_and_extract_data.return_value = ["file1.parq"]
+
+        _e.extract_to_parquet()
+        _client_options = {'pool_size': 4, 'http_compress': False}
+        es_helper.get_fields.assert_called_with(
+            'es_endpoint', 'some_es_index', client_options=_client_options)
+        _, _kwargs = es_helper.scroll_and_extract_data.call_args
+        self.assertEqual(_kwargs['client_options'], _client_options)
@@ -1,10 +1,19 @@
+import time
+import pytest
+import threading
 import unittest
 
+from datetime import datetime
 from unittest.mock import patch, MagicMock, call
+from bqsqoop.extractor.elasticsearch import helper
 from bqsqoop.extractor.elasticsearch.helper import ESHelper
+from bqsqoop.extractor.elasticsearch.serializer import FastJSONSerializer
 
 
 class TestESHelper(unittest.TestCase):
+    def setUp(self):
+        helper._es_clients.clear()
+
     @patch('elasticsearch.Elasticsearch')
     def test_get_fields(self, elasticsearch):
         _mock_es = MagicMock()
@@ -41,12 +50,91 @@ class TestESHelper(unittest.TestCase):
             'field1': 'text', 'field2': 'long', 'field3': 'date'})
         _mock_es.indices.get_mapping.assert_called_with(index='some_es_index')
 
+    @patch('elasticsearch.Elasticsearch')
+    def test_get_nested_fields(self, elasticsearch):
+        _mock_es = elasticsearch.return_value
+        # ES 7+ typeless mappings
+        _mock_es.indices.get_mapping.return_value = {
+            'some_es_index': {
+                'mappings': {
+                    'properties': {
+                        'field1': {'type': 'text'},
+                        'address': {
+                            'properties': {
+                                'city': {'type': 'keyword'},
+                                'geo': {
+                                    'properties': {
+                                        'lat': {'type': 'float'}
+                                    }
+                                }
+                            }
+                        },
+                        'comments': {
+                            'type': 'nested',
+                            'properties': {
+                                'author': {'type': 'text'},
+                                'likes': {'type': 'long'}
+                            }
+                        },
+                        'disabled': {'type': 'object', 'enabled': False}
+                    }
+                }
+            }
+        }
+
+        self.assertEqual(ESHelper.get_fields('es_endpoint', 'some_es_index'), {
+            'field1': 'text',
+            'address': [{'city': 'keyword', 'geo': [{'lat': 'float'}]}],
+            'comments': [{'author': 'text', 'likes': 'long'}],
+            'disabled': 'object'})
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_get_time_range(self, elasticsearch):
+        _mock_es = elasticsearch.return_value
+        _mock_es.search.return_value = {'aggregations': {
+            'min_time': {'value': 1536537600000.0},
+            'max_time': {'value': 1536537605500.0}}}
+
+        self.assertEqual(
+            ESHelper.get_time_range('es_endpoint', 'some_es_index',
+                                    'created_at'),
+            (datetime(2018, 9, 10), datetime(2018, 9, 10, 0, 0, 5, 500000)))
+        _mock_es.search.assert_called_with(
+            index='some_es_index', size=0, body={'aggs': {
+                'min_time': {'min': {'field': 'created_at'}},
+                'max_time': {'max': {'field': 'created_at'}}}})
+        _mock_es.search.return_value = {'aggregations': {
+            'min_time': {'value': None}, 'max_time': {'value': None}}}
+        self.assertEqual(
+            ESHelper.get_time_range('es_endpoint', 'some_es_index',
+                                    'created_at'),
+            (None, None))
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_get_max_value(self, elasticsearch):
+        _mock_es = elasticsearch.return_value
+        _query = {'range': {'field1': {'gt': 10}}}
+        for _max, _value in [
+                ({'value': 12.0}, 12), ({'value': 12.5}, 12.5),
+                ({'value': 1536537600000.0,
+                  'value_as_string': '2018-09-10T00:00:00.000Z'},
+                 '2018-09-10T00:00:00.000Z'),
+                ({'value': None}, None)]:
+            _mock_es.search.return_value = {
+                'aggregations': {'max_value': _max}}
+            self.assertEqual(ESHelper.get_max_value(
+                'es_endpoint', 'some_es_index', 'field1', _query), _value)
+        _mock_es.search.assert_called_with(
+            index='some_es_index', size=0, body={
+                'query': _query,
+                'aggs': {'max_value': {'max': {'field': 'field1'}}}})
+
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
-    @patch('bqsqoop.utils.pandas_util.PandasUtil')
+    @patch('bqsqoop.utils.arrow_util.records_to_table')
     @patch('bqsqoop.utils.parquet_util.ParquetUtil')
     @patch('elasticsearch.Elasticsearch')
     def test_scroll_and_extract_data(self, elasticsearch, parquet_util,
-                                     pandas_util, uuid):
+                                     records_to_table, uuid):
         _mock_es = MagicMock()
         elasticsearch.return_value = _mock_es
         _search_args = {'index': 'some_es_index'}
@@ -74,40 +162,50 @@ class TestESHelper(unittest.TestCase):
 
         _mock_parquet_util = MagicMock()
         parquet_util.return_value = _mock_parquet_util
-        parquet_util.fix_dataframe_for_schema.side_effect = [
-            "df_after_corrections"
-        ]
+        records_to_table.side_effect = ["table_after_corrections"]
         _mock_parquet_util.build_pyarrow_schema.return_value = "pyarrow_schema"
+        _mock_parquet_util.close.return_value = [
+            "_output_folder/some_es_index_F43C2651.parq"]
 
-        _output_file = ESHelper.scroll_and_extract_data(
+        _output_files = ESHelper.scroll_and_extract_data(
             worker_id=0, total_worker_count=1, es_hosts=['url'],
             es_timeout='60s', search_args=_search_args.copy(), fields=_fields,
             output_folder='_output_folder',
             type_cast={'field2': "string"}
         )
-        self.assertEqual(_output_file,
-                         "_output_folder/some_es_index_F43C2651.parq")
+        self.assertEqual(_output_files,
+                         ["_output_folder/some_es_index_F43C2651.parq"])
 
-        elasticsearch.assert_called_with(['url'])
+        _args, _kwargs = elasticsearch.call_args
+        self.assertEqual(_args, (['url'],))
+        self.assertIsInstance(_kwargs['serializer'], FastJSONSerializer)
         _mock_es.search.assert_called_once()
         _args, _kwargs = _mock_es.search.call_args_list[0]
         self.assertEquals(_kwargs, {'index': 'some_es_index'})
         _mock_es.scroll.assert_called_once_with(
             scroll='60s', scroll_id='_scroll_id1')
         parquet_util.assert_called_with(
-            '_output_folder/some_es_index_F43C2651.parq')
+            '_output_folder/some_es_index_F43C2651.parq', output_queue=None,
+            max_file_bytes=None, max_file_rows=None, writer_options=None,
+            storage_write_table=None)
+        # type_cast overrides the field's mapping type
         _mock_parquet_util.build_pyarrow_schema.assert_called_with(
-            {'field1': 'text', 'field2': 'long', 'field3': 'date'}
+            {'field1': 'text', 'field2': 'string', 'field3': 'date'}
         )
-        _mock_parquet_util.append_df_to_parquet.assert_called_once_with(
-            "df_after_corrections", schema='pyarrow_schema')
+        _args, _kwargs = records_to_table.call_args
+        self.assertEqual(_args[0], [
+            {'field1': 'value1', 'field2': 2, 'field3': 'some_date'}])
+        self.assertEqual(_args[1], "pyarrow_schema")
+        self.assertEqual(_kwargs, {'datetime_format': '%Y-%m-%dT%H:%M:%S'})
+        _mock_parquet_util.append_table_to_parquet.assert_called_once_with(
+            "table_after_corrections")
 
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
-    @patch('bqsqoop.utils.pandas_util.PandasUtil')
+    @patch('bqsqoop.utils.arrow_util.records_to_table')
     @patch('bqsqoop.utils.parquet_util.ParquetUtil')
     @patch('elasticsearch.Elasticsearch')
     def test_scroll_untill_no_data_left(
-            self, elasticsearch, parquet_util, pandas_util, uuid):
+            self, elasticsearch, parquet_util, records_to_table, uuid):
         _mock_es = MagicMock()
         elasticsearch.return_value = _mock_es
         _search_args = {'index': 'some_es_index'}
@@ -158,9 +256,9 @@ class TestESHelper(unittest.TestCase):
         _mock_parquet_util = MagicMock()
         parquet_util.return_value = _mock_parquet_util
         _mock_parquet_util.build_pyarrow_schema.return_value = "pyarrow_schema"
-        parquet_util.fix_dataframe_for_schema.side_effect = [
-            "df_after_corrections1", "df_after_corrections2",
-            "df_after_corrections3"
+        records_to_table.side_effect = [
+            "table_after_corrections1", "table_after_corrections2",
+            "table_after_corrections3"
         ]
 
         ESHelper.scroll_and_extract_data(
@@ -177,12 +275,39 @@ class TestESHelper(unittest.TestCase):
         )
         _mock_es.scroll.assert_called_with(
             scroll='60s', scroll_id='_scroll_id1')
-        _mock_parquet_util.append_df_to_parquet.assert_has_calls([
-            call("df_after_corrections1", schema='pyarrow_schema'),
-            call("df_after_corrections2", schema='pyarrow_schema'),
-            call("df_after_corrections3", schema='pyarrow_schema')
+        _mock_parquet_util.append_table_to_parquet.assert_has_calls([
+            call("table_after_corrections1"),
+            call("table_after_corrections2"),
+            call("table_after_corrections3")
         ])
 
+    @patch('bqsqoop.utils.arrow_util.records_to_table')
+    @patch('bqsqoop.utils.parquet_util.ParquetUtil')
+    @patch('elasticsearch.Elasticsearch')
+    def test_scroll_with_filter_path(self, elasticsearch, parquet_util,
+                                     records_to_table):
+        _mock_es = elasticsearch.return_value
+        _filter_path = 'hits.hits._source,_scroll_id,hits.total'
+        # Documents without any of the fields have no _source
+        _mock_es.search.return_value = {
+            '_scroll_id': '_scroll_id1',
+            'hits': {'total': 2, 'hits': [{'_source': {'field1': 'a'}}, {}]}}
+        _mock_es.scroll.return_value = {
+            '_scroll_id': '_scroll_id1', 'hits': {'total': 2}}
+
+        ESHelper.scroll_and_extract_data(
+            worker_id=0, total_worker_count=1, es_hosts=['url'],
+            es_timeout='60s', search_args={
+                'index': 'some_es_index', 'filter_path': _filter_path},
+            fields={'field1': 'text'}, output_folder='_output_folder',
+            serializer='json')
+        _mock_es.search.assert_called_once_with(
+            index='some_es_index', filter_path=_filter_path)
+        _mock_es.scroll.assert_called_once_with(
+            scroll='60s', scroll_id='_scroll_id1', filter_path=_filter_path)
+        self.assertEqual(records_to_table.call_args[0][0],
+                         [{'field1': 'a'}, {}])
+
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
     @patch('bqsqoop.utils.pandas_util.PandasUtil')
     @patch('bqsqoop.utils.parquet_util.ParquetUtil')
@@ -201,7 +326,6 @@ class TestESHelper(unittest.TestCase):
 
         _mock_parquet_util = MagicMock()
         parquet_util.return_value = _mock_parquet_util
-        parquet_util.fix_dataframe_for_schema = self.mock_fix_dataframe_for_schema  # noqa
         _mock_parquet_util.build_pyarrow_schema.return_value = "pyarrow_schema"
         ESHelper.scroll_and_extract_data(
             worker_id=1, total_worker_count=2, es_hosts=['url'],
@@ -214,6 +338,88 @@ class TestESHelper(unittest.TestCase):
             _kwargs,
             {'body': {'slice': {'id': 1, 'max': 2}}, 'index': 'some_es_index'})
 
-    def mock_fix_dataframe_for_schema(self, df, arrow_schema,
-                                      datetime_format=None):
-        return df
+
+class TestESClient(unittest.TestCase):
+    def setUp(self):
+        helper._es_clients.clear()
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_default_client_options(self, elasticsearch):
+        ESHelper._get_es_client(['url'])
+        _args, _kwargs = elasticsearch.call_args
+        self.assertEqual(_args, (['url'],))
+        self.assertEqual(_kwargs['maxsize'], 10)
+        self.assertTrue(_kwargs['http_compress'])
+        self.assertNotIn('headers', _kwargs)
+        self.assertNotIn('sniff_on_start', _kwargs)
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_client_options(self, elasticsearch):
+        ESHelper._get_es_client(['url'], client_options=dict(
+            pool_size=4, http_compress=False, keep_alive=False, sniff=True))
+        _, _kwargs = elasticsearch.call_args
+        self.assertEqual(_kwargs['maxsize'], 4)
+        self.assertFalse(_kwargs['http_compress'])
+        self.assertEqual(_kwargs['headers'], {'Connection': 'close'})
+        self.assertTrue(_kwargs['sniff_on_start'])
+        self.assertTrue(_kwargs['sniff_on_connection_fail'])
+
+    @patch('os.getpid')
+    @patch('elasticsearch.Elasticsearch')
+    def test_client_cached_per_process(self, elasticsearch, getpid):
+        elasticsearch.side_effect = lambda *args, **kwargs: MagicMock()
+        getpid.return_value = 1
+        _es = ESHelper._get_es_client(['url'])
+        self.assertIs(ESHelper._get_es_client(['url']), _es)
+        self.assertIsNot(ESHelper._get_es_client(
+            ['url'], client_options=dict(pool_size=4)), _es)
+        self.assertIsNot(ESHelper._get_es_client(['other_url']), _es)
+        # Forked workers don't reuse the parent's connections
+        getpid.return_value = 2
+        self.assertIsNot(ESHelper._get_es_client(['url']), _es)
+        self.assertEqual(elasticsearch.call_count, 4)
+
+
+class TestPrefetchPages(unittest.TestCase):
+    def test_pages_fetched_on_background_thread(self):
+        _threads = []
+
+        def _pages():
+            for i in range(5):
+                _threads.append(threading.current_thread())
+                yield {'page': i}
+
+        self.assertEqual(
+            [_page['page'] for _page in ESHelper.prefetch_pages(_pages(), 2)],
+            [0, 1, 2, 3, 4])
+        self.assertNotIn(threading.current_thread(), _threads)
+
+    def test_no_prefetch(self):
+        _pages = iter([{'page': 0}])
+        self.assertIs(ESHelper.prefetch_pages(_pages, 0), _pages)
+
+    def test_prefetch_is_bounded(self):
+        _fetched = []
+
+        def _pages():
+            for i in range(20):
+                _fetched.append(i)
+                yield {'page': i}
+
+        _prefetched = ESHelper.prefetch_pages(_pages(), 2)
+        next(_prefetched)
+        time.sleep(0.3)
+        # 2 queued pages and one waiting to be queued
+        self.assertEqual(len(_fetched), 4)
+        _prefetched.close()
+        self.assertLess(len(_fetched), 20)
+
+    def test_fetch_errors_are_raised(self):
+        def _pages():
+            yield {'page': 0}
+            raise ValueError("scroll failed")
+
+        _prefetched = ESHelper.prefetch_pages(_pages(), 1)
+        self.assertEqual(next(_prefetched), {'page': 0})
+        with pytest.raises(ValueError, match='scroll failed'):
+            next(_prefetched)
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from unittest.mock import patch, MagicMock
+from bqsqoop.extractor.elasticsearch import helper, search_after
+
+
+def _page(values, start=0, pit_id=None):
+    page = {'hits': {'total': {'value': 5, 'relation': 'eq'}, 'hits': [{
+        '_source': {'field1': value},
+        'sort': [start + i]} for i, value in enumerate(values)]}}
+    if pit_id:
+        page['pit_id'] = pit_id
+    return page
+
+
+class TestSearchAfter(unittest.TestCase):
+    def setUp(self):
+        helper._es_clients.clear()
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.utils.arrow_util.records_to_table')
+    @patch('bqsqoop.utils.parquet_util.ParquetUtil')
+    @patch('elasticsearch.Elasticsearch')
+    def test_pages_with_search_after(self, elasticsearch, parquet_util,
+                                     records_to_table, uuid):
+        _mock_es = MagicMock()
+        elasticsearch.return_value = _mock_es
+        _searches = []
+        _pages = [_page(['a', 'b'], 0), _page(['c', 'd'], 2), _page(['e'], 4)]
+
+        def _search(**kwargs):
+            _searches.append(dict(kwargs, body=dict(kwargs['body'])))
+            return _pages[len(_searches) - 1]
+        _mock_es.search.side_effect = _search
+        _mock_parquet_util = MagicMock()
+        parquet_util.return_value = _mock_parquet_util
+        _mock_parquet_util.close.return_value = ["file1.parq"]
+        records_to_table.side_effect = ["table1", "table2", "table3"]
+
+        _output_files = search_after.search_after_and_extract_data(
+            worker_id=0, total_worker_count=1, es_hosts=['url'],
+            es_timeout='60s', search_args={
+                'index': 'some_es_index', 'scroll': '60s', 'size': 2,
+                'body': {'query': {'match_all': {}}},
+                'filter_path': 'hits.hits._source,_scroll_id,hits.total',
+                '_source_include': 'field1'},
+            fields={'field1': 'text'}, output_folder='_output_folder',
+            sort_field='id')
+        self.assertEqual(_output_files, ["file1.parq"])
+        # Stops after the short page without another search
+        self.assertEqual(len(_searches), 3)
+        self.assertEqual(_searches[0], {
+            'index': 'some_es_index', 'size': 2,
+            '_source_includes': 'field1',
+            'filter_path':
+                'hits.hits._source,hits.hits.sort,hits.total,pit_id',
+            'body': {'query': {'match_all': {}}, 'sort': [{'id': 'asc'}]}})
+        self.assertEqual(_searches[1]['body']['search_after'], [1])
+        self.assertEqual(_searches[2]['body']['search_after'], [3])
+        self.assertEqual(
+            _mock_parquet_util.append_table_to_parquet.call_count, 3)
+        self.assertEqual(records_to_table.call_args_list[2][0][0],
+                         [{'field1': 'e'}])
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.utils.arrow_util.records_to_table')
+    @patch('bqsqoop.utils.parquet_util.ParquetUtil')
+    @patch('elasticsearch.Elasticsearch')
+    def test_sliced_point_in_time(self, elasticsearch, parquet_util,
+                                  records_to_table, uuid):
+        _mock_es = MagicMock()
+        elasticsearch.return_value = _mock_es
+        _searches = []
+        _pages = [_page(['a'], 0, pit_id='pit2'), _page([], pit_id='pit3')]
+
+        def _search(**kwargs):
+            _searches.append(dict(kwargs, body=dict(
+                kwargs['body'], pit=dict(kwargs['body']['pit']))))
+            return _pages[len(_searches) - 1]
+        _mock_es.search.side_effect = _search
+        parquet_util.return_value.close.return_value = []
+
+        search_after.search_after_and_extract_data(
+            worker_id=1, total_worker_count=2, es_hosts=['url'],
+            es_timeout='60s', search_args={
+                'index': 'some_es_index', 'scroll': '60s', 'size': 1,
+                'body': {'query': {'match_all': {}}}},
+            fields={'field1': 'text'}, output_folder='_output_folder',
+            pit_id='pit1')
+        parquet_util.assert_called_with(
+            '_output_folder/some_es_index_F43C2651.parq', output_queue=None,
+            max_file_bytes=None, max_file_rows=None, writer_options=None,
+            storage_write_table=None)
+        self.assertEqual(len(_searches), 2)
+        self.assertEqual(_searches[0], {'size': 1, 'body': {
+            'query': {'match_all': {}},
+            'sort': [{'_doc': 'asc'}],
+            'pit': {'id': 'pit1', 'keep_alive': '60s'},
+            'slice': {'id': 1, 'max': 2}}})
+        self.assertEqual(_searches[1]['body']['pit']['id'], 'pit2')
+        self.assertEqual(_searches[1]['body']['search_after'], [0])
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_open_and_close_point_in_time(self, elasticsearch):
+        _transport = elasticsearch.return_value.transport
+        _transport.perform_request.return_value = {'id': 'pit1'}
+
+        self.assertEqual(search_after.open_point_in_time(
+            ['url'], 'some_es_index', '60s'), 'pit1')
+        _transport.perform_request.assert_called_with(
+            'POST', '/some_es_index/_pit', params={'keep_alive': '60s'})
+        search_after.close_point_in_time(['url'], 'pit1')
+        _transport.perform_request.assert_called_with(
+            'DELETE', '/_pit', body={'id': 'pit1'})
+
+
+@unittest.skipUnless(os.environ.get('ES_TEST_URL'),
+                     'needs a single node ES 7.10+ at ES_TEST_URL')
+class TestSearchAfterIntegration(unittest.TestCase):
+    _index = 'bqsqoop_search_after_test'
+
+    def setUp(self):
+        import elasticsearch
+        self.es_url = os.environ['ES_TEST_URL']
+        self.es = elasticsearch.Elasticsearch([self.es_url])
+        self.es.indices.delete(index=self._index, ignore=[404])
+        self.es.indices.create(index=self._index, body={
+            'settings': {'number_of_shards': 2},
+            'mappings': {'properties': {
+                'id': {'type': 'long'}, 'name': {'type': 'keyword'}}}})
+        for i in range(25):
+            self.es.index(index=self._index, id=i,
+                          body={'id': i, 'name': 'name{}'.format(i)})
+        self.es.indices.refresh(index=self._index)
+        self.output_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.es.indices.delete(index=self._index, ignore=[404])
+        shutil.rmtree(self.output_folder)
+
+    def _extract(self, **config):
+        from bqsqoop.extractor.elasticsearch import ElasticSearchExtractor
+        config = dict(config, url=self.es_url, index=self._index,
+                      scroll_size=4, engine='search_after',
+                      output_folder=self.output_folder)
+        _extractor = ElasticSearchExtractor(config)
+        _extractor.validate_config()
+        _files = _extractor.extract_to_parquet()
+        return sorted(pd.concat(
+            [pd.read_parquet(_file) for _file in _files])['id'].tolist())
+
+    def test_sort_field(self):
+        self.assertEqual(self._extract(sort_field='id'), list(range(25)))
+
+    def test_sliced_point_in_time(self):
+        self.assertEqual(
+            self._extract(point_in_time=True, no_of_workers=2,
+                          splits_per_worker=2),
+            list(range(25)))
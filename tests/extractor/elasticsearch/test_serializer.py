@@ -0,0 +1,45 @@
+import gc
+import pytest
+import unittest
+
+from unittest.mock import patch
+from elasticsearch.exceptions import SerializationError
+from bqsqoop.extractor.elasticsearch import serializer
+
+
+class TestSerializer(unittest.TestCase):
+    def test_decodes_responses(self):
+        for name in ['auto', 'json', 'orjson']:
+            _serializer = serializer.get_serializer(name)
+            self.assertEqual(
+                _serializer.loads('{"hits": {"hits": [{"_source": {}}]}}'),
+                {"hits": {"hits": [{"_source": {}}]}})
+            self.assertEqual(_serializer.mimetype, "application/json")
+
+    def test_encodes_requests_like_the_client(self):
+        self.assertEqual(
+            serializer.get_serializer('orjson').dumps({"size": 1}),
+            '{"size":1}')
+
+    def test_invalid_response(self):
+        with pytest.raises(SerializationError):
+            serializer.get_serializer().loads('{"hits":')
+        self.assertTrue(gc.isenabled())
+
+    def test_garbage_collection_paused_while_decoding(self):
+        _gc_enabled = []
+        _serializer = serializer.FastJSONSerializer(
+            lambda s: _gc_enabled.append(gc.isenabled()))
+        _serializer.loads('{}')
+        self.assertEqual(_gc_enabled, [False])
+        self.assertTrue(gc.isenabled())
+
+    @patch.dict('bqsqoop.extractor.elasticsearch.serializer._DECODERS',
+                {'orjson': None, 'ujson': None})
+    def test_auto_falls_back_to_json(self):
+        self.assertTrue(serializer.is_available('auto'))
+        self.assertFalse(serializer.is_available('orjson'))
+        self.assertEqual(serializer.get_serializer('auto')._loads,
+                         serializer.json.loads)
+        with pytest.raises(ValueError, match='orjson is not installed'):
+            serializer.get_serializer('orjson')
@@ -0,0 +1,127 @@
+import pytest
+import tempfile
+import unittest
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from unittest.mock import patch, MagicMock
+from bqsqoop.extractor.sql.pg_copy import export_to_parquet
+
+
+_COPY_OUTPUT = (
+    b'id,created_at,active,name,attributes\n'
+    b'1,2018-01-01 01:00:00+00,t,"",{"a": 2}\n'
+    b'2,2018-01-01 02:00:00-07,f,,\n'
+    b'3,,t,"multi\nline",{}\n'
+)
+
+
+def _mock_connection(copy_side_effect):
+    mock_connection = MagicMock()
+    mock_describe_cursor = MagicMock()
+    mock_describe_cursor.description = [
+        ('id', 23), ('created_at', 1184), ('active', 16),
+        ('name', 1043), ('attributes', 3802)]
+    mock_copy_cursor = MagicMock()
+    mock_copy_cursor.copy_expert.side_effect = copy_side_effect
+    mock_connection.cursor.side_effect = [
+        mock_describe_cursor, mock_copy_cursor]
+    return mock_connection, mock_describe_cursor, mock_copy_cursor
+
+
+def _write_copy_output(sql, file):
+    file.write(_COPY_OUTPUT)
+
+
+class TestPGCopy(unittest.TestCase):
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_export_to_parquet(self, create_engine, uuid):
+        mock_engine = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_connection, mock_describe_cursor, mock_copy_cursor = \
+            _mock_connection(_write_copy_output)
+        mock_engine.raw_connection.return_value = mock_connection
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query %s",
+                filter_field="id", start_pos=1, end_pos=3,
+                output_folder=output_folder, progress_bar=False)
+            self.assertEqual(output_file, output_folder + "/F43C2651.parq")
+            table = pq.read_table(output_file)
+        mock_describe_cursor.execute.assert_called_with(
+            "select * from (query id >= 1 AND id <= 3) as t limit 0")
+        args, _ = mock_copy_cursor.copy_expert.call_args
+        self.assertEqual(
+            args[0], "COPY (query id >= 1 AND id <= 3) " +
+            "TO STDOUT WITH (FORMAT csv, HEADER)")
+        mock_connection.close.assert_called_with()
+        self.assertEqual(table.schema.field('created_at').type,
+                         pa.timestamp('ns'))
+        self.assertEqual(table.to_pydict(), {
+            'id': [1, 2, 3],
+            'created_at': [pd.Timestamp('2018-01-01 01:00:00'),
+                           pd.Timestamp('2018-01-01 09:00:00'), None],
+            'active': [True, False, True],
+            'name': ['', None, 'multi\nline'],
+            'attributes': ['{"a": 2}', None, '{}']})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_export_with_table_schema(self, create_engine, uuid):
+        mock_engine = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_connection, _, _ = _mock_connection(_write_copy_output)
+        mock_engine.raw_connection.return_value = mock_connection
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None, end_pos=None,
+                output_folder=output_folder, progress_bar=False,
+                table_schema={"id": float, "name": str, "missing": int})
+            table = pq.read_table(output_file)
+        self.assertEqual(table.to_pydict(), {
+            'id': [1.0, 2.0, 3.0],
+            'name': ['', None, 'multi\nline'],
+            'missing': [None, None, None]})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_null_like_text(self, create_engine, uuid):
+        def _write_null_like_output(sql, file):
+            file.write(
+                b'id,created_at,active,name,attributes\n'
+                b'1,,t,NA,null\n2,,t,null,N/A\n3,,t,nan,NULL\n4,,t,,\n')
+        mock_connection, _, _ = _mock_connection(_write_null_like_output)
+        create_engine.return_value.raw_connection.return_value = \
+            mock_connection
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None, end_pos=None,
+                output_folder=output_folder, progress_bar=False)
+            table = pq.read_table(output_file)
+        self.assertEqual(table.to_pydict()['name'],
+                         ['NA', 'null', 'nan', None])
+        self.assertEqual(table.to_pydict()['attributes'],
+                         ['null', 'N/A', 'NULL', None])
+
+    @patch('sqlalchemy.create_engine')
+    def test_copy_errors(self, create_engine):
+        mock_engine = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_connection, _, _ = _mock_connection(
+            Exception("relation does not exist"))
+        mock_engine.raw_connection.return_value = mock_connection
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            with pytest.raises(Exception, match=r"relation does not exist"):
+                export_to_parquet(
+                    worker_id=1, sql_bind="sql_bind", query="query",
+                    filter_field=None, start_pos=None, end_pos=None,
+                    output_folder=output_folder, progress_bar=False)
+        mock_connection.close.assert_called_with()
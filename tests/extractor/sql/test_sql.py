@@ -1,8 +1,9 @@
 import pytest
 import unittest
 
+from datetime import datetime
 from unittest.mock import patch, MagicMock
-from bqsqoop.utils.errors import MissingConfigError
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
 from bqsqoop.extractor.sql import SQLExtractor
 
 
@@ -44,11 +45,124 @@ class TestConfig(unittest.TestCase):
                 MissingConfigError, match=r'.* filter_field .* SQL'):
             e.validate_config()
 
+    def test_unknown_split_strategy(self):
+        _config = _valid_config.copy()
+        _config['split_strategy'] = 'unknown'
+        e = SQLExtractor(_config)
+        with pytest.raises(
+                InvalidConfigError, match=r'.* split_strategy .* SQL'):
+            e.validate_config()
+
+    def test_unknown_engine(self):
+        _config = _valid_config.copy()
+        _config['engine'] = 'unknown'
+        e = SQLExtractor(_config)
+        with pytest.raises(
+                InvalidConfigError, match=r'.* engine .* SQL'):
+            e.validate_config()
+
+    def test_copy_engine_only_for_postgres(self):
+        _config = _valid_config.copy()
+        _config['engine'] = 'copy'
+        e = SQLExtractor(_config)
+        with pytest.raises(
+                InvalidConfigError, match=r'copy only supports postgres'):
+            e.validate_config()
+        _config['sql_bind'] = 'postgresql+psycopg2://user@localhost/db'
+        e = SQLExtractor(_config)
+        e.validate_config()
+
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
     def test_default_confgs(self, mock_uuid):
         e = SQLExtractor(_valid_config)
         self.assertEqual(e._no_of_workers, 2)
         self.assertEqual(e._output_folder, './F43C2651')
+        self.assertEqual(e._fetch_size, 'auto')
+        self.assertEqual(e._row_group_size_mb, 64)
+        self.assertEqual(e._max_memory_mb, 512)
+
+    def test_incremental_needs_state_and_filter_slot(self):
+        config = dict(_valid_config, watermark_field='updated_at')
+        with pytest.raises(MissingConfigError, match=r'.* watermark_state'):
+            SQLExtractor(config).validate_config()
+        config = dict(config, watermark_state='state.json',
+                      query='select * from orders')
+        with pytest.raises(InvalidConfigError, match=r'.* query .*'):
+            SQLExtractor(config).validate_config()
+
+
+class TestIncrementalExtract(unittest.TestCase):
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.watermark.WatermarkState.read',
+           return_value=None)
+    def test_first_run(self, read_state, get_results_cursor):
+        e = SQLExtractor(dict(
+            _valid_config, no_of_workers=1, watermark_field='id',
+            watermark_state='state.json'))
+        get_results_cursor.return_value.fetchone.return_value = (10,)
+
+        self.assertTrue(e.prepare_increment())
+        _, query = get_results_cursor.call_args[0]
+        self.assertIn("select max(t.id) from (query 1=1) as t", query)
+        self.assertEqual(e._query(), 'query id <= 10 AND %s')
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.extractor.sql.helper.export_to_parquet')
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.watermark.WatermarkState.save')
+    @patch('bqsqoop.utils.watermark.WatermarkState.read',
+           return_value=datetime(2018, 9, 10))
+    def test_rows_after_watermark(self, read_state, save_state,
+                                  get_results_cursor, export_to_parquet,
+                                  mock_uuid):
+        e = SQLExtractor(dict(
+            _valid_config, no_of_workers=1, watermark_field='updated_at',
+            watermark_state='state.json'))
+        get_results_cursor.return_value.fetchone.return_value = (
+            datetime(2018, 9, 11),)
+        export_to_parquet.return_value = ["file1.parq"]
+
+        self.assertTrue(e.prepare_increment())
+        _, query = get_results_cursor.call_args[0]
+        self.assertIn("from (query updated_at > '2018-09-10 00:00:00')",
+                      query)
+        self.assertEqual(e.extract_to_parquet(), ["file1.parq"])
+        _, kwargs = export_to_parquet.call_args
+        self.assertEqual(
+            kwargs['query'],
+            "query updated_at > '2018-09-10 00:00:00' AND "
+            "updated_at <= '2018-09-11 00:00:00' AND 1=1")
+        e.save_watermark()
+        save_state.assert_called_once_with(datetime(2018, 9, 11))
+
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    @patch('bqsqoop.utils.watermark.WatermarkState.read', return_value=5)
+    def test_splits_of_the_increment(self, read_state, async_worker,
+                                     get_results_cursor):
+        e = SQLExtractor(dict(
+            _valid_config, no_of_workers=2, watermark_field='id',
+            watermark_state='state.json'))
+        get_results_cursor.return_value.fetchone.side_effect = [(9,), (6, 9)]
+        async_worker.return_value.get_job_results.return_value = []
+
+        e.prepare_increment()
+        e.extract_to_parquet()
+        _, min_max_query = get_results_cursor.call_args[0]
+        self.assertIn("from (query id > 5 AND id <= 9 AND 1=1) as t",
+                      min_max_query)
+        _, kwargs = async_worker.return_value.send_data_to_worker.call_args
+        self.assertEqual(kwargs['query'], 'query id > 5 AND id <= 9 AND %s')
+
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.watermark.WatermarkState.read', return_value=10)
+    def test_no_new_rows(self, read_state, get_results_cursor):
+        e = SQLExtractor(dict(
+            _valid_config, no_of_workers=1, watermark_field='id',
+            watermark_state='state.json'))
+        get_results_cursor.return_value.fetchone.return_value = (None,)
+
+        self.assertFalse(e.prepare_increment())
 
 
 class TestExtractToParquet(unittest.TestCase):
@@ -65,7 +179,7 @@ class TestExtractToParquet(unittest.TestCase):
         mock_worker = MagicMock()
         async_worker.return_value = mock_worker
         mock_worker.send_data_to_worker = MagicMock()
-        mock_job_results = MagicMock(return_value=["file1.parq"])
+        mock_job_results = MagicMock(return_value=[["file1.parq"]])
         mock_worker.get_job_results = mock_job_results
 
         self.assertEqual(e.extract_to_parquet(), ["file1.parq"])
@@ -82,6 +196,7 @@ class TestExtractToParquet(unittest.TestCase):
         self.assertEqual(kwargs1['output_folder'], './F43C2651')
         self.assertEqual(kwargs1['start_pos'], 3)
         self.assertEqual(kwargs1['end_pos'], 4)
+        self.assertEqual(kwargs1['fetch_size'], 'auto')
         _, kwargs2 = _call_args[1]
         self.assertEqual(kwargs2['worker_id'], 1)
         self.assertEqual(
@@ -100,11 +215,141 @@ class TestExtractToParquet(unittest.TestCase):
                                                  mock_uuid):
         _valid_config['no_of_workers'] = 1
         e = SQLExtractor(_valid_config)
-        export_to_parquet.return_value = "file1.parq"
+        export_to_parquet.return_value = ["file1.parq"]
 
         self.assertEqual(e.extract_to_parquet(), ["file1.parq"])
         export_to_parquet.assert_called_with(
             worker_id=0, filter_field='filter_field',
             output_folder='./F43C2651', query='query %s', sql_bind='sql_bind',
-            start_pos=None, end_pos=None, table_schema=None
+            start_pos=None, end_pos=None, table_schema=None,
+            fetch_size='auto', row_group_bytes=64 * 1024 * 1024,
+            max_memory_bytes=512 * 1024 * 1024
         )
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.extractor.sql.helper.export_to_parquet')
+    def test_columnar_fetch_mode(self, export_to_parquet, mock_uuid):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 1
+        config['columnar'] = True
+        e = SQLExtractor(config)
+        export_to_parquet.return_value = ["file1.parq"]
+
+        self.assertEqual(e.extract_to_parquet(), ["file1.parq"])
+        export_to_parquet.assert_called_with(
+            worker_id=0, filter_field='filter_field',
+            output_folder='./F43C2651', query='query %s', sql_bind='sql_bind',
+            start_pos=None, end_pos=None, table_schema=None,
+            fetch_size='auto', row_group_bytes=64 * 1024 * 1024,
+            max_memory_bytes=512 * 1024 * 1024, columnar=True
+        )
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.extractor.sql.helper.export_to_parquet')
+    def test_file_rolling(self, export_to_parquet, mock_uuid):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 1
+        config['max_file_size_mb'] = 256
+        config['max_file_rows'] = 1000000
+        e = SQLExtractor(config)
+        export_to_parquet.return_value = ["file1_00000.parq",
+                                          "file1_00001.parq"]
+
+        self.assertEqual(e.extract_to_parquet(), [
+            "file1_00000.parq", "file1_00001.parq"])
+        export_to_parquet.assert_called_with(
+            worker_id=0, filter_field='filter_field',
+            output_folder='./F43C2651', query='query %s', sql_bind='sql_bind',
+            start_pos=None, end_pos=None, table_schema=None,
+            fetch_size='auto', row_group_bytes=64 * 1024 * 1024,
+            max_memory_bytes=512 * 1024 * 1024,
+            max_file_bytes=256 * 1024 * 1024, max_file_rows=1000000
+        )
+
+    @patch('bqsqoop.extractor.sql.helper.export_to_parquet')
+    def test_parquet_writer_options(self, export_to_parquet):
+        _parquet_config = {'compression': 'zstd', 'compression_level': 3}
+        e = SQLExtractor(dict(_valid_config, no_of_workers=1),
+                         parquet_config=_parquet_config)
+        e.validate_config()
+        export_to_parquet.return_value = []
+
+        e.extract_to_parquet()
+        _, kwargs = export_to_parquet.call_args
+        self.assertEqual(kwargs['writer_options'], _parquet_config)
+
+    def test_invalid_parquet_config(self):
+        e = SQLExtractor(_valid_config, parquet_config={'compression': 'lzo'})
+        with pytest.raises(
+                InvalidConfigError,
+                match=r'.* compression under Parquet.*'):
+            e.validate_config()
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.extractor.sql.pg_copy.export_to_parquet')
+    def test_copy_engine(self, export_to_parquet, mock_uuid):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 1
+        config['engine'] = 'copy'
+        e = SQLExtractor(config)
+        export_to_parquet.return_value = ["file1.parq"]
+
+        self.assertEqual(e.extract_to_parquet(), ["file1.parq"])
+        export_to_parquet.assert_called_with(
+            worker_id=0, filter_field='filter_field',
+            output_folder='./F43C2651', query='query %s', sql_bind='sql_bind',
+            start_pos=None, end_pos=None, table_schema=None,
+            row_group_bytes=64 * 1024 * 1024
+        )
+
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    def test_quantile_splits(self, async_worker, get_results_cursor):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 2
+        config['no_of_splits'] = 3
+        config['split_strategy'] = 'quantile'
+        config['split_sample_percent'] = 10
+        e = SQLExtractor(config)
+        mock_results = MagicMock()
+        get_results_cursor.return_value = mock_results
+        mock_results.fetchone.return_value = [1, 1000]
+        mock_results.fetchall.return_value = [
+            (2, 5, 10), (5, 6, 10), (7, 990, 10)]
+        mock_worker = MagicMock()
+        async_worker.return_value = mock_worker
+
+        e.extract_to_parquet()
+        async_worker.assert_called_with(2)
+        args, _ = get_results_cursor.call_args
+        self.assertIn("ntile(3) over (order by t.filter_field)", args[1])
+        self.assertIn("AND random() < 0.1", args[1])
+        _call_args = mock_worker.send_data_to_worker.call_args_list
+        self.assertEqual(
+            [(kwargs['worker_id'], kwargs['start_pos'], kwargs['end_pos'])
+             for _, kwargs in _call_args],
+            [(0, 1, 5), (1, 6, 6), (2, 7, 1000)])
+
+    @patch('bqsqoop.extractor.sql.helper.get_results_cursor')
+    @patch('bqsqoop.utils.async_worker.AsyncWorker')
+    def test_splits_per_worker(self, async_worker, get_results_cursor):
+        config = _valid_config.copy()
+        config['no_of_workers'] = 2
+        config['splits_per_worker'] = 2
+        e = SQLExtractor(config)
+        mock_results = MagicMock()
+        get_results_cursor.return_value = mock_results
+        mock_results.fetchone.return_value = [1, 8]
+        mock_worker = MagicMock()
+        async_worker.return_value = mock_worker
+        mock_worker.get_job_results.return_value = [
+            ["file1.parq"], ["file2.parq"], ["file3.parq", "file4.parq"], []]
+
+        self.assertEqual(e.extract_to_parquet(), [
+            "file1.parq", "file2.parq", "file3.parq", "file4.parq"])
+        async_worker.assert_called_with(2)
+        _call_args = mock_worker.send_data_to_worker.call_args_list
+        self.assertEqual(
+            [(kwargs['worker_id'], kwargs['start_pos'], kwargs['end_pos'])
+             for _, kwargs in _call_args],
+            [(0, 1, 2), (1, 3, 4), (2, 5, 6), (3, 7, 8)])
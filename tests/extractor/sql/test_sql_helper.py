@@ -1,12 +1,17 @@
 import pytz
 import pytest
+import tempfile
 import unittest
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from unittest.mock import patch, MagicMock, call
+from decimal import Decimal
 from datetime import datetime, timedelta
 from bqsqoop.extractor.sql.helper import (
-    get_results_cursor, export_to_parquet
+    get_results_cursor, export_to_parquet, _tune_fetch_size, add_split_filter,
+    MIN_FETCH_SIZE, MAX_FETCH_SIZE
 )
 
 
@@ -47,16 +52,16 @@ class TestSQLHelper(unittest.TestCase):
         ]
         mock_parquet_util = MagicMock()
         parquet_util.return_value = mock_parquet_util
-        parquet_util.fix_dataframe_for_schema = self.mock_fix_dataframe_for_schema  # noqa
+        mock_parquet_util.close.return_value = ["output_folder/F43C2651.parq"]
 
-        output_file = export_to_parquet(
+        output_files = export_to_parquet(
             worker_id=1, sql_bind="sql_bind", query="query %s",
             filter_field="filter_field", start_pos=34,
             end_pos=402, output_folder="output_folder/",
             progress_bar=False, fetch_size=200
         )
-        self.assertEqual(output_file,
-                         "output_folder/F43C2651.parq")
+        self.assertEqual(output_files,
+                         ["output_folder/F43C2651.parq"])
         create_engine.assert_called_with("sql_bind", pool_timeout=300)
         mock_engine.connect.assert_called_with()
         mock_connection.execution_options.assert_called_with(
@@ -65,13 +70,13 @@ class TestSQLHelper(unittest.TestCase):
             "query filter_field >= 34 AND filter_field <= 402")
         mock_proxy.fetchmany.assert_has_calls(
             [call(200), call(200), call(200)])
-        call_list = mock_parquet_util.append_df_to_parquet.call_args_list
+        call_list = mock_parquet_util.append_table_to_parquet.call_args_list
         args, _ = call_list[0]
-        df = args[0]
+        df = args[0].to_pandas()
         self.assertEqual(
             df.to_json(), '{"col1":{"0":1,"1":2},"col2":{"0":3,"1":4}}')
         args, _ = call_list[1]
-        df = args[0]
+        df = args[0].to_pandas()
         self.assertEqual(
             df.to_json(), '{"col1":{"0":5,"1":6},"col2":{"0":7,"1":8}}')
 
@@ -98,16 +103,16 @@ class TestSQLHelper(unittest.TestCase):
         ]
         mock_parquet_util = MagicMock()
         parquet_util.return_value = mock_parquet_util
-        parquet_util.fix_dataframe_for_schema = self.mock_fix_dataframe_for_schema  # noqa
+        mock_parquet_util.close.return_value = ["output_folder/F43C2651.parq"]
 
-        output_file = export_to_parquet(
+        output_files = export_to_parquet(
             worker_id=1, sql_bind="sql_bind", query="query",
             filter_field=None, start_pos=None,
             end_pos=None, output_folder="output_folder/",
             progress_bar=False
         )
-        self.assertEqual(output_file,
-                         "output_folder/F43C2651.parq")
+        self.assertEqual(output_files,
+                         ["output_folder/F43C2651.parq"])
         create_engine.assert_called_with("sql_bind", pool_timeout=300)
         mock_engine.connect.assert_called_with()
         mock_connection.execution_options.assert_called_with(
@@ -115,13 +120,13 @@ class TestSQLHelper(unittest.TestCase):
         mock_connection.execute.assert_called_with("query")
         mock_proxy.fetchmany.assert_has_calls(
             [call(100), call(100), call(100)])
-        call_list = mock_parquet_util.append_df_to_parquet.call_args_list
+        call_list = mock_parquet_util.append_table_to_parquet.call_args_list
         args, _ = call_list[0]
-        df = args[0]
+        df = args[0].to_pandas()
         self.assertEqual(
             df.to_json(), '{"col1":{"0":1,"1":2},"col2":{"0":3,"1":4}}')
         args, _ = call_list[1]
-        df = args[0]
+        df = args[0].to_pandas()
         self.assertEqual(
             df.to_json(), '{"col1":{"0":5,"1":6},"col2":{"0":7,"1":8}}')
 
@@ -139,7 +144,7 @@ class TestSQLHelper(unittest.TestCase):
 
         mock_parquet_util = MagicMock()
         parquet_util.return_value = mock_parquet_util
-        parquet_util.fix_dataframe_for_schema = self.mock_fix_dataframe_for_schema  # noqa
+        mock_parquet_util.close.return_value = ["output_folder/F43C2651.parq"]
 
         with pytest.raises(Exception, match=r"Test error"):
             export_to_parquet(
@@ -180,7 +185,7 @@ class TestSQLHelper(unittest.TestCase):
         ]
         mock_parquet_util = MagicMock()
         parquet_util.return_value = mock_parquet_util
-        parquet_util.fix_dataframe_for_schema = self.mock_fix_dataframe_for_schema  # noqa
+        mock_parquet_util.close.return_value = ["output_folder/F43C2651.parq"]
 
         export_to_parquet(
             worker_id=1, sql_bind="sql_bind", query="query",
@@ -188,9 +193,9 @@ class TestSQLHelper(unittest.TestCase):
             end_pos=None, output_folder="output_folder/",
             progress_bar=False
         )
-        call_list = mock_parquet_util.append_df_to_parquet.call_args_list
+        call_list = mock_parquet_util.append_table_to_parquet.call_args_list
         args, _ = call_list[0]
-        df = args[0]
+        df = args[0].to_pandas()
         # Both datetime fields should be in UTC
         self.assertEqual(
             df["pst_dt"].tolist(), [
@@ -207,6 +212,216 @@ class TestSQLHelper(unittest.TestCase):
         self.assertEqual(
             df["tuple_type"].tolist(), ['["sfe", 7]', '["sfe", 7]'])
 
-    def mock_fix_dataframe_for_schema(self, df, arrow_schema,
-                                      datetime_format=None):
-        return df
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('bqsqoop.utils.parquet_util.ParquetUtil')
+    @patch('sqlalchemy.create_engine')
+    def test_columnar_export_to_parquet(self, create_engine, parquet_util,
+                                        uuid):
+        mock_engine = MagicMock()
+        mock_connection = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_engine.connect.return_value = mock_connection
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = MagicMock()
+        mock_connection.execute.return_value = mock_proxy
+        utc_dt = pytz.utc.localize(datetime(2018, 1, 1, 1, 0, 0))
+        pst_dt = utc_dt.astimezone(pytz.timezone("America/Los_Angeles"))
+        mock_proxy.fetchmany.side_effect = [
+            [[1, pst_dt, {"a": 2}], [2, None, ("sfe", 7)]],
+            [[3, utc_dt, None]],
+            None
+        ]
+        mock_proxy.cursor.description = [
+            ('id', "info"),
+            ('dt', "info"),
+            ('compound', "info")
+        ]
+        mock_parquet_util = MagicMock()
+        parquet_util.return_value = mock_parquet_util
+
+        export_to_parquet(
+            worker_id=1, sql_bind="sql_bind", query="query",
+            filter_field=None, start_pos=None,
+            end_pos=None, output_folder="output_folder/",
+            progress_bar=False, columnar=True
+        )
+        mock_parquet_util.append_df_to_parquet.assert_not_called()
+        call_list = \
+            mock_parquet_util.append_record_batch_to_parquet.call_args_list
+        self.assertEqual(len(call_list), 2)
+        args, _ = call_list[0]
+        self.assertEqual(args[0].to_pydict(), {
+            'id': [1, 2],
+            'dt': [pd.Timestamp('2018-01-01 01:00:00'), None],
+            'compound': ['{"a": 2}', '["sfe", 7]']})
+        args, _ = call_list[1]
+        # The first batch's schema is kept for the rest of the batches
+        self.assertEqual(args[0].schema.field('compound').type, pa.string())
+        self.assertEqual(args[0].to_pydict(), {
+            'id': [3],
+            'dt': [pd.Timestamp('2018-01-01 01:00:00')],
+            'compound': [None]})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_columnar_export_all_null_first_batch(self, create_engine, uuid):
+        mock_connection = create_engine.return_value.connect.return_value
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = mock_connection.execute.return_value
+        mock_proxy.fetchmany.side_effect = [
+            [[1, None], [2, None]],
+            [[3, "val3"]],
+            None
+        ]
+        mock_proxy.cursor.description = [('id', "info"), ('name', "info")]
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None,
+                end_pos=None, output_folder=output_folder,
+                progress_bar=False, columnar=True
+            )
+            table = pq.read_table(output_file)
+        self.assertEqual(table.schema.field('name').type, pa.string())
+        self.assertEqual(table.to_pydict(), {
+            'id': [1, 2, 3], 'name': [None, None, 'val3']})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_columnar_export_wider_decimals_later(self, create_engine, uuid):
+        mock_connection = create_engine.return_value.connect.return_value
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = mock_connection.execute.return_value
+        mock_proxy.fetchmany.side_effect = [
+            [[1, Decimal("1.5")]],
+            [[2, Decimal("123.45")]],
+            None
+        ]
+        mock_proxy.cursor.description = [('id', "info"), ('amount', "info")]
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None,
+                end_pos=None, output_folder=output_folder,
+                progress_bar=False, columnar=True
+            )
+            table = pq.read_table(output_file)
+        # Same as Decimal in a table schema
+        self.assertEqual(table.schema.field('amount').type, pa.float64())
+        self.assertEqual(table.to_pydict()['amount'], [1.5, 123.45])
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_buffered_export_schema_of_first_batch(self, create_engine, uuid):
+        mock_connection = create_engine.return_value.connect.return_value
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = mock_connection.execute.return_value
+        mock_proxy.fetchmany.side_effect = [
+            [[1, Decimal("1.5"), None]],
+            [[2, Decimal("123.45"), "a"]],
+            None
+        ]
+        mock_proxy.cursor.description = [
+            ('id', "info"), ('amount', "info"), ('name', "info")]
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None,
+                end_pos=None, output_folder=output_folder,
+                progress_bar=False, row_group_bytes=16 * 100000
+            )
+            table = pq.read_table(output_file)
+        self.assertEqual(table.schema.field('amount').type, pa.float64())
+        self.assertEqual(table.schema.field('name').type, pa.string())
+        self.assertEqual(table.to_pydict(), {
+            'id': [1, 2], 'amount': [1.5, 123.45], 'name': [None, 'a']})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_columnar_export_with_table_schema(self, create_engine, uuid):
+        mock_engine = MagicMock()
+        mock_connection = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_engine.connect.return_value = mock_connection
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = MagicMock()
+        mock_connection.execute.return_value = mock_proxy
+        mock_proxy.fetchmany.side_effect = [
+            [[1, Decimal("1.5")], [2, None]],
+            None
+        ]
+        mock_proxy.cursor.description = [
+            ('id', "info"),
+            ('amount', "info")
+        ]
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None,
+                end_pos=None, output_folder=output_folder,
+                progress_bar=False, columnar=True,
+                table_schema={"id": str, "amount": Decimal, "missing": int}
+            )
+            table = pq.read_table(output_file)
+        self.assertEqual(table.schema.names, ['id', 'amount', 'missing'])
+        self.assertEqual(table.to_pydict(), {
+            'id': ['1', '2'], 'amount': [1.5, None], 'missing': [None, None]})
+
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    @patch('sqlalchemy.create_engine')
+    def test_auto_fetch_size(self, create_engine, uuid):
+        mock_engine = MagicMock()
+        mock_connection = MagicMock()
+        create_engine.return_value = mock_engine
+        mock_engine.connect.return_value = mock_connection
+        mock_connection.execution_options.return_value = mock_connection
+        mock_proxy = MagicMock()
+        mock_connection.execute.return_value = mock_proxy
+        mock_proxy.fetchmany.side_effect = [
+            [[1, 3], [2, 4]],
+            [[5, 7]],
+            None
+        ]
+        mock_proxy.cursor.description = [
+            ('col1', "info"),
+            ('col2', "info")
+        ]
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_file, = export_to_parquet(
+                worker_id=1, sql_bind="sql_bind", query="query",
+                filter_field=None, start_pos=None,
+                end_pos=None, output_folder=output_folder,
+                progress_bar=False, fetch_size="auto", columnar=True,
+                row_group_bytes=16 * 100000, max_memory_bytes=64 * 100000
+            )
+            pfile = pq.ParquetFile(output_file)
+            self.assertEqual(pfile.num_row_groups, 1)
+            self.assertEqual(pfile.read().num_rows, 3)
+        # Rows are 16 bytes wide, 4 fetches per row group
+        mock_proxy.fetchmany.assert_has_calls(
+            [call(MIN_FETCH_SIZE), call(25000), call(25000)])
+
+    def test_add_split_filter(self):
+        self.assertEqual(
+            add_split_filter("query %s", "id", 3, 10),
+            "query id >= 3 AND id <= 10")
+        self.assertEqual(
+            add_split_filter(
+                "query %s", "ts", datetime(2018, 1, 1),
+                datetime(2018, 1, 2, 0, 0, 0, 1)),
+            "query ts >= '2018-01-01 00:00:00' AND " +
+            "ts <= '2018-01-02 00:00:00.000001'")
+        self.assertEqual(add_split_filter("query", None, None, None), "query")
+
+    def test_tune_fetch_size(self):
+        # Bounded by the row group buffer
+        self.assertEqual(_tune_fetch_size(100, 4000000, 100000000), 10000)
+        # Bounded by the memory left next to the buffer
+        self.assertEqual(_tune_fetch_size(100, 4000000, 6000000), 5000)
+        self.assertEqual(_tune_fetch_size(10 ** 9, 4000000), MIN_FETCH_SIZE)
+        self.assertEqual(_tune_fetch_size(0), MAX_FETCH_SIZE)
@@ -1,6 +1,12 @@
+import os
+import json
 import pytest
+import tempfile
 import unittest
+
+from unittest.mock import patch, call
 from bqsqoop.extractor import Extractor
+from bqsqoop.utils.errors import MissingConfigError, InvalidConfigError
 
 
 class ValidExtractorClass(Extractor):
@@ -31,3 +37,108 @@ class TestIExtractor(unittest.TestCase):
         _class = ValidExtractorClass({})
         self.assertEqual(True, _class.validate_config())
         self.assertEqual([], _class.extract_to_parquet())
+
+
+_calls = []
+
+
+def extract_split(worker_id, output_folder, fail=False, pit_id=None):
+    _calls.append(worker_id)
+    if fail:
+        raise Exception("split failed")
+    _file = os.path.join(output_folder, "{}.parq".format(worker_id))
+    open(_file, "w").close()
+    return [_file]
+
+
+class TestExecuteJobs(unittest.TestCase):
+    def setUp(self):
+        del _calls[:]
+        self.folder = tempfile.TemporaryDirectory()
+        self.config = {'output_folder': self.folder.name,
+                       'checkpoint_file': os.path.join(
+                           self.folder.name, 'manifest.json')}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _jobs(self, failing=(), **params):
+        return [dict(worker_callback=extract_split,
+                     output_folder=self.folder.name, fail=i in failing,
+                     **params)
+                for i in range(3)]
+
+    def test_checkpointed_rerun(self):
+        _extractor = ValidExtractorClass(self.config)
+        with pytest.raises(Exception, match='split failed'):
+            _extractor._execute_jobs(1, self._jobs(failing=[1]))
+        self.assertEqual(_calls, [0, 1])
+
+        # Split 1 is fixed, 0 is done and 2 never ran
+        del _calls[:]
+        _results = ValidExtractorClass(self.config)._execute_jobs(
+            1, self._jobs())
+        self.assertEqual(_calls, [1, 2])
+        self.assertEqual(_results, [
+            [os.path.join(self.folder.name, "{}.parq".format(i))]
+            for i in range(3)])
+
+        # Done splits with missing files are extracted again
+        os.remove(_results[2][0])
+        del _calls[:]
+        ValidExtractorClass(self.config)._execute_jobs(1, self._jobs())
+        self.assertEqual(_calls, [2])
+
+    def test_point_in_time_rerun(self):
+        with pytest.raises(Exception, match='split failed'):
+            ValidExtractorClass(self.config)._execute_jobs(
+                1, self._jobs(failing=[1], pit_id='pit1'))
+        # A rerun opens a new point-in-time
+        del _calls[:]
+        ValidExtractorClass(self.config)._execute_jobs(
+            1, self._jobs(pit_id='pit2'))
+        self.assertEqual(_calls, [1, 2])
+
+    def test_config_change_discards_checkpoints(self):
+        ValidExtractorClass(self.config)._execute_jobs(1, self._jobs())
+        del _calls[:]
+        ValidExtractorClass(dict(self.config, max_file_rows=10)) \
+            ._execute_jobs(1, self._jobs())
+        self.assertEqual(_calls, [0, 1, 2])
+
+    def test_clear_checkpoint(self):
+        _extractor = ValidExtractorClass(self.config)
+        _extractor._execute_jobs(1, self._jobs())
+        _extractor.clear_checkpoint()
+        self.assertFalse(os.path.exists(self.config['checkpoint_file']))
+
+    def test_checkpointed_async_jobs(self):
+        _extractor = ValidExtractorClass(self.config)
+        with pytest.raises(RuntimeError):
+            _extractor._execute_jobs(2, self._jobs(failing=[0]))
+        _results = ValidExtractorClass(self.config)._execute_jobs(
+            2, self._jobs())
+        self.assertEqual(len(_results), 3)
+        with open(self.config['checkpoint_file']) as f:
+            self.assertEqual(
+                [_split['status']
+                 for _, _split in sorted(json.load(f)['splits'].items())],
+                ['done', 'done', 'done'])
+
+    @patch('time.sleep')
+    def test_retries(self, sleep):
+        _extractor = ValidExtractorClass(
+            {'max_retries': 2, 'retry_backoff_secs': 5})
+        with pytest.raises(Exception, match='split failed'):
+            _extractor._execute_jobs(1, self._jobs(failing=[0]))
+        self.assertEqual(_calls, [0, 0, 0])
+        self.assertEqual(sleep.call_args_list, [call(5), call(10)])
+
+    def test_validate_retry_config(self):
+        with pytest.raises(InvalidConfigError, match=r'.* max_retries .*'):
+            ValidExtractorClass(
+                {'max_retries': -1})._validate_retry_config('SQL')
+        with pytest.raises(MissingConfigError, match=r'.* output_folder .*'):
+            ValidExtractorClass(
+                {'checkpoint_file': 'manifest.json'}
+            )._validate_retry_config('SQL')
@@ -33,3 +33,9 @@ class TestGetExtractorFor(unittest.TestCase):
         _config = {'extractor': {'sql': {}}}
         _class = get_extractor_for(_config)
         self.assertEquals(type(_class), SQLExtractor)
+
+    def test_parquet_config(self):
+        _config = {'extractor': {'sql': {}},
+                   'parquet': {'compression': 'zstd'}}
+        _class = get_extractor_for(_config)
+        self.assertEqual(_class._parquet_config, {'compression': 'zstd'})
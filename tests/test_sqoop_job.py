@@ -0,0 +1,70 @@
+import pytest
+import unittest
+
+from unittest.mock import patch, call
+from bqsqoop.job import Job
+
+
+def _configs(extractor={}, bigquery={}):
+    return {
+        'extractor': {'sql': dict(
+            {'sql_bind': 'postgresql://', 'query': 'select 1'},
+            **extractor)},
+        'bigquery': dict(
+            {'project_id': 'gcp_project_1', 'dataset_name': 'dataset_1',
+             'table_name': 'table_1', 'gcs_tmp_path': 'gs://tmp/'},
+            **bigquery),
+    }
+
+
+@patch('bqsqoop.utils.gcloud.auth.setup_credentials', return_value=None)
+class TestJob(unittest.TestCase):
+    def test_valid_configs(self, setup_credentials):
+        Job(_configs(extractor={'max_retries': 2}))
+        Job(_configs(bigquery={'pipeline_upload': True}))
+
+    def test_pipeline_upload_with_retries(self, setup_credentials):
+        with pytest.raises(Exception, match=r"max_retries can't be used"):
+            Job(_configs(extractor={'max_retries': 2},
+                         bigquery={'pipeline_upload': True}))
+
+    def test_pipeline_upload_with_checkpoint(self, setup_credentials):
+        with pytest.raises(Exception, match=r"checkpoint_file can't be used"):
+            Job(_configs(
+                extractor={'checkpoint_file': './splits.json',
+                           'output_folder': './output'},
+                bigquery={'pipeline_upload': True}))
+
+    def test_incremental_with_write_truncate(self, setup_credentials):
+        _incremental = {'query': 'select * from t where %s',
+                        'watermark_field': 'updated_at',
+                        'watermark_state': './state.json'}
+        for _bigquery in ({'write_truncate': True},
+                          {'write_truncate': True, 'partition': '20180910'}):
+            with pytest.raises(Exception, match=r"write_truncate can't be"):
+                Job(_configs(extractor=_incremental, bigquery=_bigquery))
+
+    @patch('bqsqoop.utils.gcloud.storage.delete_files_in')
+    @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files')
+    @patch('bqsqoop.utils.gcloud.storage.parallel_copy_files_to_gcs',
+           return_value='gs://tmp/1/')
+    @patch('bqsqoop.extractor.sql.sql.SQLExtractor.save_watermark')
+    @patch('bqsqoop.extractor.sql.sql.SQLExtractor.extract_to_parquet',
+           return_value=['./1.parq'])
+    @patch('bqsqoop.extractor.sql.sql.SQLExtractor.prepare_increment',
+           return_value=True)
+    def test_incremental_runs_append_to_partition(
+            self, prepare_increment, extract_to_parquet, save_watermark,
+            copy_files_to_gcs, load_parquet_files, delete_files_in,
+            setup_credentials):
+        _configs_with_partition = _configs(
+            extractor={'query': 'select * from t where %s',
+                       'watermark_field': 'updated_at',
+                       'watermark_state': './state.json'},
+            bigquery={'partition': '20180910'})
+        for _ in range(2):
+            Job(_configs_with_partition).execute()
+        # The second run's rows are added to the first run's
+        _load = call('gs://tmp/1/*.parq', 'gcp_project_1', 'dataset_1',
+                     'table_1', write_truncate=False, partition='20180910')
+        self.assertEqual(load_parquet_files.call_args_list, [_load, _load])
@@ -0,0 +1,221 @@
+"""A minimal in-process fake of the GCS JSON API for tests
+
+Only implements the calls bqsqoop makes. google-cloud-storage clients
+are pointed to it with the STORAGE_EMULATOR_HOST env variable.
+"""
+import os
+import json
+import base64
+import hashlib
+import threading
+import google_crc32c
+
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+class FakeGCSServer(object):
+    def __init__(self, buckets=("gcs_bucket",)):
+        self.buckets = set(buckets)
+        self.objects = {}
+        self.uploads = {}
+        self.batches = []
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._env = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        self._env = os.environ.get("STORAGE_EMULATOR_HOST")
+        os.environ["STORAGE_EMULATOR_HOST"] = self.url
+        return self
+
+    def __exit__(self, *args):
+        if self._env is None:
+            os.environ.pop("STORAGE_EMULATOR_HOST", None)
+        else:
+            os.environ["STORAGE_EMULATOR_HOST"] = self._env
+        self._server.shutdown()
+        self._server.server_close()
+
+    def object_resource(self, bucket, name):
+        data = self.objects[(bucket, name)]
+        crc32c = google_crc32c.value(data).to_bytes(4, 'big')
+        return dict(kind="storage#object", bucket=bucket, name=name,
+                    size=str(len(data)),
+                    crc32c=base64.b64encode(crc32c).decode(),
+                    md5Hash=base64.b64encode(
+                        hashlib.md5(data).digest()).decode())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _send_json(self, status, body=None):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _path_parts(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        return parts, parse_qs(url.query)
+
+    def do_GET(self):
+        parts, query = self._path_parts()
+        # /storage/v1/b/<bucket>
+        if parts[:3] == ["storage", "v1", "b"] and len(parts) == 4:
+            if parts[3] not in self.fake.buckets:
+                return self._send_json(404, {"error": {"code": 404}})
+            return self._send_json(200, {"kind": "storage#bucket",
+                                         "name": parts[3]})
+        # /storage/v1/b/<bucket>/o?prefix=<prefix>
+        if parts[:3] == ["storage", "v1", "b"] and len(parts) == 5:
+            prefix = query.get("prefix", [""])[0]
+            with self.fake.lock:
+                items = [self.fake.object_resource(bucket, name)
+                         for bucket, name in sorted(self.fake.objects)
+                         if bucket == parts[3] and name.startswith(prefix)]
+            return self._send_json(200, {"items": items})
+        return self._send_json(404, {"error": {"code": 404}})
+
+    def do_POST(self):
+        parts, query = self._path_parts()
+        # /upload/storage/v1/b/<bucket>/o?uploadType=multipart
+        if parts[:4] == ["upload", "storage", "v1", "b"] and \
+                query.get("uploadType") == ["multipart"]:
+            bucket = parts[4]
+            metadata, data = self._parse_multipart(self._read_body())
+            with self.fake.lock:
+                self.fake.objects[(bucket, metadata["name"])] = data
+            return self._send_json(
+                200, self.fake.object_resource(bucket, metadata["name"]))
+        # /upload/storage/v1/b/<bucket>/o?uploadType=resumable
+        if parts[:4] == ["upload", "storage", "v1", "b"] and \
+                query.get("uploadType") == ["resumable"]:
+            bucket = parts[4]
+            metadata = json.loads(self._read_body() or b"{}")
+            name = metadata.get("name") or query["name"][0]
+            with self.fake.lock:
+                upload_id = str(len(self.fake.uploads))
+                self.fake.uploads[upload_id] = dict(
+                    bucket=bucket, name=name, data=b"", chunks=0)
+            self.send_response(200)
+            self.send_header("Location", "{0}/upload/storage/v1/b/{1}/o"
+                             "?uploadType=resumable&upload_id={2}".format(
+                                 self.fake.url, bucket, upload_id))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        # /batch/storage/v1, only for deletes
+        if parts == ["batch", "storage", "v1"]:
+            return self._batch(self._read_body())
+        # /storage/v1/b/<bucket>/o/<name>/compose
+        if parts[:3] == ["storage", "v1", "b"] and len(parts) == 7 and \
+                parts[6] == "compose":
+            bucket, name = parts[3], parts[5]
+            body = json.loads(self._read_body())
+            with self.fake.lock:
+                self.fake.objects[(bucket, name)] = b"".join(
+                    self.fake.objects[(bucket, source["name"])]
+                    for source in body["sourceObjects"])
+            return self._send_json(
+                200, self.fake.object_resource(bucket, name))
+        return self._send_json(404, {"error": {"code": 404}})
+
+    def do_PUT(self):
+        _, query = self._path_parts()
+        upload = self.fake.uploads[query["upload_id"][0]]
+        data = self._read_body()
+        # eg., bytes 0-262143/* or bytes 262144-300000/300001
+        _range, total = self.headers["Content-Range"].split(" ")[1].split("/")
+        with self.fake.lock:
+            upload["data"] += data
+            upload["chunks"] += 1
+            if total != "*" and len(upload["data"]) == int(total):
+                self.fake.objects[(upload["bucket"], upload["name"])] = \
+                    upload["data"]
+                return self._send_json(200, self.fake.object_resource(
+                    upload["bucket"], upload["name"]))
+        self.send_response(308)
+        self.send_header("Range", "bytes=0-{}".format(
+            len(upload["data"]) - 1))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_DELETE(self):
+        status = self._delete(self.path)
+        if status == 204:
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        return self._send_json(404, {"error": {"code": 404}})
+
+    def _delete(self, path):
+        self.path = path
+        parts, _ = self._path_parts()
+        # /storage/v1/b/<bucket>/o/<name>
+        if parts[:3] == ["storage", "v1", "b"] and len(parts) == 6:
+            with self.fake.lock:
+                if self.fake.objects.pop((parts[3], parts[5]), None) \
+                        is not None:
+                    return 204
+        return 404
+
+    def _batch(self, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode() +
+            b"\r\n\r\n" + body)
+        responses = []
+        for part in message.iter_parts():
+            request_line = part.get_payload().lstrip().split("\n", 1)[0]
+            method, url, _ = request_line.split(" ", 2)
+            status = self._delete(urlparse(url).path) \
+                if method == "DELETE" else 404
+            responses.append(
+                "Content-Type: application/http\r\n"
+                "Content-ID: <response-{0}>\r\n\r\n"
+                "HTTP/1.1 {1} Status\r\n"
+                "Content-Length: 0\r\n\r\n".format(
+                    part["Content-ID"], status))
+        with self.fake.lock:
+            self.fake.batches.append(len(responses))
+        boundary = "fake_batch_boundary"
+        data = "".join("--{0}\r\n{1}\r\n".format(boundary, response)
+                       for response in responses)
+        data = (data + "--{}--\r\n".format(boundary)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "multipart/mixed; boundary=" + boundary)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _parse_multipart(self, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode() +
+            b"\r\n\r\n" + body)
+        metadata_part, data_part = list(message.iter_parts())
+        return (json.loads(metadata_part.get_payload(decode=True)),
+                data_part.get_payload(decode=True))
@@ -2,7 +2,10 @@ import pytest
 import unittest
 
 from unittest.mock import patch, MagicMock
-from bqsqoop.utils.gcloud.bigquery import load_parquet_files
+from bqsqoop.utils.gcloud.bigquery import (
+    load_parquet_files, load_parquet_files_staged, copy_staging_table,
+    delete_table
+)
 
 
 class TestloadParquetFilesFromGCS(unittest.TestCase):
@@ -43,6 +46,8 @@ class TestloadParquetFilesFromGCS(unittest.TestCase):
         bigquery_client.assert_called_with(project=_gcs_project)
         load_job_config.assert_called()
         self.assertEqual(_mock_job_config.source_format, "PARQUET")
+        self.assertTrue(
+            _mock_job_config.parquet_options.enable_list_inference)
         # Default should be WRITE_TRUNCATE
         self.assertEqual(_mock_job_config.write_disposition, "WRITE_TRUNCATE")
         _mock_bigquery.dataset.assert_called_with(_dataset_name)
@@ -62,3 +67,183 @@ class TestloadParquetFilesFromGCS(unittest.TestCase):
         load_job_config.assert_called()
         self.assertEqual(_mock_job_config.source_format, "PARQUET")
         self.assertEqual(_mock_job_config.write_disposition, "WRITE_APPEND")
+
+    @patch('google.cloud.bigquery.LoadJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_partitioned_and_clustered_table(self, bigquery_client,
+                                             load_job_config):
+        _mock_job_config = load_job_config.return_value
+        _dataset = bigquery_client.return_value.dataset.return_value
+
+        load_parquet_files(
+            "gs://gcs_bucket/tmp_folder/*.parq", "", "dataset_name",
+            "table_name", time_partitioning={
+                'field': 'created_at', 'type': 'MONTH',
+                'expiration_days': 2},
+            clustering_fields=['country', 'city'], partition='201809')
+        self.assertEqual(
+            _mock_job_config.time_partitioning.to_api_repr(),
+            {'type': 'MONTH', 'field': 'created_at',
+             'expirationMs': str(2 * 24 * 3600 * 1000)})
+        self.assertEqual(_mock_job_config.clustering_fields,
+                         ['country', 'city'])
+        _dataset.table.assert_called_with("table_name$201809")
+
+    @patch('google.cloud.bigquery.LoadJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_ingestion_time_partitioning(self, bigquery_client,
+                                         load_job_config):
+        load_parquet_files(
+            "gs://gcs_bucket/tmp_folder/*.parq", "", "", "",
+            time_partitioning={})
+        _partitioning = load_job_config.return_value.time_partitioning
+        self.assertEqual(_partitioning.to_api_repr(), {'type': 'DAY'})
+
+
+def _files(n, size=10):
+    return [("gs://gcs_bucket/tmp/f{}.parq".format(i), size)
+            for i in range(n)]
+
+
+class TestLoadParquetFilesStaged(unittest.TestCase):
+    @patch('uuid.uuid4')
+    @patch('google.cloud.bigquery.CopyJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_concurrent_loads_and_copy(self, bigquery_client,
+                                       copy_job_config, mock_uuid):
+        mock_uuid.return_value.hex = "f43c2651abcd"
+        _client = bigquery_client.return_value
+        _dataset = _client.dataset.return_value
+        _dataset.table.side_effect = lambda name: "table:" + name
+
+        load_parquet_files_staged(
+            _files(5), "gcs_project", "dataset_name", "table_name",
+            max_files_per_job=2)
+
+        _loads = sorted(
+            (args[1], args[0], kwargs['job_config'].write_disposition)
+            for args, kwargs in
+            _client.load_table_from_uri.call_args_list)
+        _staging = ["table:table_name_staging_f43c2651_{}".format(i)
+                    for i in range(3)]
+        self.assertEqual(_loads, [
+            (_staging[0], [uri for uri, _ in _files(2)], 'WRITE_TRUNCATE'),
+            (_staging[1], [uri for uri, _ in _files(4)[2:]],
+             'WRITE_TRUNCATE'),
+            (_staging[2], [uri for uri, _ in _files(5)[4:]],
+             'WRITE_TRUNCATE')])
+        _client.copy_table.assert_called_once_with(
+            _staging, "table:table_name",
+            job_config=copy_job_config.return_value)
+        _client.copy_table.return_value.result.assert_called_with()
+        self.assertEqual(copy_job_config.return_value.write_disposition,
+                         'WRITE_TRUNCATE')
+        self.assertEqual(
+            [args[0] for args, _ in _client.delete_table.call_args_list],
+            _staging)
+
+    @patch('google.cloud.bigquery.CopyJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_batches_by_bytes(self, bigquery_client, copy_job_config):
+        _client = bigquery_client.return_value
+
+        load_parquet_files_staged(
+            _files(4, size=10), "", "", "", write_truncate=False,
+            max_bytes_per_job=25)
+        self.assertEqual(_client.load_table_from_uri.call_count, 2)
+        self.assertEqual(copy_job_config.return_value.write_disposition,
+                         'WRITE_APPEND')
+
+    @patch('google.cloud.bigquery.Client')
+    def test_failed_load_drops_staging_tables(self, bigquery_client):
+        _client = bigquery_client.return_value
+        _client.load_table_from_uri.return_value.result.side_effect = \
+            Exception("load failed")
+
+        with pytest.raises(Exception, match='load failed'):
+            load_parquet_files_staged(
+                _files(2), "", "", "", max_files_per_job=1)
+        _client.copy_table.assert_not_called()
+        self.assertEqual(_client.delete_table.call_count, 2)
+
+    @patch('google.cloud.bigquery.LoadJobConfig')
+    @patch('google.cloud.bigquery.CopyJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_staged_load_into_partition(self, bigquery_client,
+                                        copy_job_config, load_job_config):
+        _client = bigquery_client.return_value
+        _client.dataset.return_value.table.side_effect = \
+            lambda name: "table:" + name
+
+        load_parquet_files_staged(
+            _files(2), "", "", "table_name", max_files_per_job=1,
+            time_partitioning={'field': 'created_at'},
+            clustering_fields=['country'], partition='20180910')
+        # Staging tables are partitioned like the table
+        self.assertEqual(
+            load_job_config.return_value.clustering_fields, ['country'])
+        self.assertEqual(
+            load_job_config.return_value.time_partitioning.field,
+            'created_at')
+        _args, _ = _client.copy_table.call_args
+        self.assertEqual(_args[1], "table:table_name$20180910")
+
+    @patch('google.cloud.bigquery.Client')
+    def test_single_batch_loads_directly(self, bigquery_client):
+        _client = bigquery_client.return_value
+
+        load_parquet_files_staged(_files(2), "", "", "table_name")
+        _args, _ = _client.load_table_from_uri.call_args
+        self.assertEqual(_args[0], [uri for uri, _ in _files(2)])
+        _client.copy_table.assert_not_called()
+
+
+class TestCopyStagingTable(unittest.TestCase):
+    @patch('google.cloud.bigquery.CopyJobConfig')
+    @patch('google.cloud.bigquery.Client')
+    def test_copy_and_drop(self, bigquery_client, copy_job_config):
+        _client = bigquery_client.return_value
+        _client.dataset.return_value.table.side_effect = \
+            lambda name: "table:" + name
+
+        copy_staging_table("staging", "", "", "table_name",
+                           write_truncate=False, partition="20180910")
+        _client.copy_table.assert_called_once_with(
+            "table:staging", "table:table_name$20180910",
+            job_config=copy_job_config.return_value)
+        self.assertEqual(copy_job_config.return_value.write_disposition,
+                         'WRITE_APPEND')
+        _client.create_table.assert_not_called()
+        _client.delete_table.assert_called_once_with(
+            "table:staging", not_found_ok=True)
+
+    @patch('google.cloud.bigquery.Table')
+    @patch('google.cloud.bigquery.Client')
+    def test_creates_partitioned_table(self, bigquery_client, table):
+        _client = bigquery_client.return_value
+        _client.copy_table.return_value.result.side_effect = \
+            Exception("copy failed")
+
+        with pytest.raises(Exception, match='copy failed'):
+            copy_staging_table(
+                "staging", "", "", "table_name",
+                time_partitioning={'field': 'created_at', 'type': 'DAY'},
+                clustering_fields=['country'])
+        self.assertEqual(
+            table.return_value.time_partitioning.field, 'created_at')
+        self.assertEqual(
+            table.return_value.clustering_fields, ['country'])
+        _client.create_table.assert_called_once_with(
+            table.return_value, exists_ok=True)
+        _client.delete_table.assert_called_once()
+
+    @patch('google.cloud.bigquery.Client')
+    def test_delete_table(self, bigquery_client):
+        _client = bigquery_client.return_value
+        _client.dataset.return_value.table.side_effect = \
+            lambda name: "table:" + name
+
+        delete_table("gcs_project", "dataset_name", "staging")
+        bigquery_client.assert_called_with(project="gcs_project")
+        _client.delete_table.assert_called_once_with(
+            "table:staging", not_found_ok=True)
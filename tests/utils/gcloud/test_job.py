@@ -1,5 +1,6 @@
+import threading
 import unittest
-from mock import patch
+from mock import patch, MagicMock
 from bqsqoop.utils.gcloud.job import BigqueryParquetLoadJob
 
 
@@ -23,6 +24,18 @@ class TestBigqueryParquetLoadJob(unittest.TestCase):
         self.assertTrue(_job.is_config_valid)
         self.assertDictEqual(_job.errors, {})
 
+    def test_invalid_upload_mode(self):
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            gcs_tmp_path="gcs_tmp_path",
+            upload_mode="parallel"
+        )
+        _job = BigqueryParquetLoadJob(_configs)
+        self.assertFalse(_job.is_config_valid)
+        self.assertEqual(list(_job.errors.keys()), ["upload_mode"])
+
     @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
     @patch('bqsqoop.utils.gcloud.storage.parallel_copy_files_to_gcs')
     @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files')
@@ -45,7 +58,8 @@ class TestBigqueryParquetLoadJob(unittest.TestCase):
         setup_credentials.assert_called_with(_configs["service_account_key"])
         parallel_copy_files_to_gcs.assert_called_with(
             _files, _configs["gcs_tmp_path"], "gcp_project_1",
-            use_new_tmp_folder=True)
+            use_new_tmp_folder=True, max_concurrency=4, upload_mode='simple',
+            chunk_size=64 * 1024 * 1024)
         load_parquet_files.assert_called_with(
             parallel_copy_files_to_gcs.return_value + "*.parq",
             _configs["project_id"],
@@ -54,4 +68,242 @@ class TestBigqueryParquetLoadJob(unittest.TestCase):
             write_truncate=False
         )
         delete_files_in.assert_called_with(
-            parallel_copy_files_to_gcs.return_value, "gcp_project_1")
+            parallel_copy_files_to_gcs.return_value, "gcp_project_1",
+            max_concurrency=4)
+
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.file_queue.shared_file_queue')
+    @patch('bqsqoop.utils.gcloud.storage.QueueUploader')
+    @patch('bqsqoop.utils.gcloud.storage.new_tmp_folder_path')
+    @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files')
+    @patch('bqsqoop.utils.gcloud.storage.delete_files_in')
+    def test_execute_pipelined(self, delete_files_in, load_parquet_files,
+                               new_tmp_folder_path, queue_uploader,
+                               shared_file_queue, setup_credentials):
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            gcs_tmp_path="gs://gcs_tmp_path/",
+            pipeline_upload=True,
+            max_local_disk_mb=10,
+            upload_concurrency=8,
+            upload_mode="composite",
+            upload_chunk_size_mb=32
+        )
+        new_tmp_folder_path.return_value = "gs://gcs_tmp_path/sacdf/"
+        _queue = MagicMock()
+        shared_file_queue.return_value.__enter__.return_value = _queue
+        _uploader = MagicMock()
+        queue_uploader.return_value = _uploader
+        _extract_fn = MagicMock()
+
+        _job = BigqueryParquetLoadJob(_configs)
+        self.assertTrue(_job.pipeline_upload)
+        _job.execute_pipelined(_extract_fn)
+        shared_file_queue.assert_called_with(10 * 1024 * 1024)
+        queue_uploader.assert_called_with(
+            _queue, "gs://gcs_tmp_path/sacdf/", "gcp_project_1",
+            no_of_threads=8, upload_mode="composite",
+            chunk_size=32 * 1024 * 1024)
+        _uploader.start.assert_called_with()
+        _extract_fn.assert_called_with(output_queue=_queue)
+        _queue.close.assert_called_with()
+        _uploader.join.assert_called_with()
+        load_parquet_files.assert_called_with(
+            "gs://gcs_tmp_path/sacdf/*.parq", "gcp_project_1", "dataset_1",
+            "table_1", write_truncate=True)
+        delete_files_in.assert_called_with(
+            "gs://gcs_tmp_path/sacdf/", "gcp_project_1", max_concurrency=8)
+
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.gcloud.storage.parallel_copy_files_to_gcs')
+    @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files')
+    @patch('bqsqoop.utils.gcloud.storage.delete_files_in')
+    def test_async_cleanup(self, delete_files_in, load_parquet_files,
+                           parallel_copy_files_to_gcs, setup_credentials):
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            gcs_tmp_path="gs://gcs_tmp_path/",
+            async_cleanup=True
+        )
+        parallel_copy_files_to_gcs.return_value = "gs://gcs_tmp_path/sacdf/"
+        _cleanup_started = threading.Event()
+        _finish_cleanup = threading.Event()
+
+        def _delete_files_in(*args, **kwargs):
+            _cleanup_started.set()
+            _finish_cleanup.wait(timeout=5)
+            raise Exception("Cleanup error")
+
+        delete_files_in.side_effect = _delete_files_in
+
+        _job = BigqueryParquetLoadJob(_configs)
+        # Returns once the table is loaded, while cleanup is running
+        _job.execute(["file1"])
+        load_parquet_files.assert_called_once()
+        self.assertTrue(_cleanup_started.wait(timeout=5))
+        self.assertTrue(_job._cleanup_thread.is_alive())
+        _finish_cleanup.set()
+        # Cleanup errors are only logged
+        _job.wait_for_cleanup()
+        delete_files_in.assert_called_once_with(
+            "gs://gcs_tmp_path/sacdf/", "gcp_project_1", max_concurrency=4)
+
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.gcloud.storage.parallel_copy_files_to_gcs')
+    @patch('bqsqoop.utils.gcloud.storage.list_files_in')
+    @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files_staged')
+    @patch('bqsqoop.utils.gcloud.storage.delete_files_in')
+    def test_staged_load(self, delete_files_in, load_parquet_files_staged,
+                         list_files_in, parallel_copy_files_to_gcs,
+                         setup_credentials):
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            gcs_tmp_path="gs://gcs_tmp_path/",
+            max_files_per_load_job=100,
+            max_load_job_size_gb=2,
+            load_concurrency=8
+        )
+        parallel_copy_files_to_gcs.return_value = "gs://gcs_tmp_path/sacdf/"
+        list_files_in.return_value = [("gs://gcs_tmp_path/sacdf/f1.parq", 1)]
+
+        _job = BigqueryParquetLoadJob(_configs)
+        _job.execute(["f1.parq"])
+        list_files_in.assert_called_with(
+            "gs://gcs_tmp_path/sacdf/", "gcp_project_1", suffix=".parq")
+        load_parquet_files_staged.assert_called_with(
+            list_files_in.return_value, "gcp_project_1", "dataset_1",
+            "table_1", write_truncate=True, max_files_per_job=100,
+            max_bytes_per_job=2 * 1024 * 1024 * 1024, max_concurrency=8)
+        delete_files_in.assert_called_once()
+
+    def test_invalid_max_files_per_load_job(self):
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", gcs_tmp_path="gcs_tmp_path",
+            max_files_per_load_job=0))
+        self.assertEqual(
+            list(_job.errors.keys()), ["max_files_per_load_job"])
+
+    def test_invalid_table_options(self):
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", gcs_tmp_path="gcs_tmp_path",
+            time_partitioning={'type': 'WEEK'},
+            clustering_fields=['a', 'b', 'c', 'd', 'e'],
+            partition='2018-09-10'))
+        self.assertEqual(
+            sorted(_job.errors.keys()),
+            ["clustering_fields", "partition", "time_partitioning"])
+
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.gcloud.storage.parallel_copy_files_to_gcs')
+    @patch('bqsqoop.utils.gcloud.bigquery.load_parquet_files')
+    @patch('bqsqoop.utils.gcloud.storage.delete_files_in')
+    def test_table_options(self, delete_files_in, load_parquet_files,
+                           parallel_copy_files_to_gcs, setup_credentials):
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            gcs_tmp_path="gs://gcs_tmp_path/",
+            time_partitioning={'field': 'created_at', 'type': 'DAY'},
+            clustering_fields=['country'],
+            partition=20180910
+        )
+        parallel_copy_files_to_gcs.return_value = "gs://gcs_tmp_path/sacdf/"
+
+        _job = BigqueryParquetLoadJob(_configs)
+        self.assertNotIn("partition", _job.errors)
+        _job.execute(["file1"])
+        load_parquet_files.assert_called_with(
+            "gs://gcs_tmp_path/sacdf/*.parq", "gcp_project_1", "dataset_1",
+            "table_1", write_truncate=True,
+            time_partitioning={'field': 'created_at', 'type': 'DAY'},
+            clustering_fields=['country'], partition=20180910)
+
+    @patch('bqsqoop.utils.gcloud.storage_write.is_available',
+           return_value=True)
+    def test_invalid_sink(self, is_available):
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", gcs_tmp_path="gcs_tmp_path",
+            sink="s3"))
+        self.assertEqual(list(_job.errors.keys()), ["sink"])
+        # No GCS path needed to stream
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", sink="storage_write",
+            pipeline_upload=True))
+        self.assertEqual(list(_job.errors.keys()), ["pipeline_upload"])
+        is_available.return_value = False
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", sink="storage_write"))
+        self.assertEqual(list(_job.errors.keys()), ["sink"])
+
+    @patch('uuid.uuid4')
+    @patch('bqsqoop.utils.gcloud.storage_write.is_available',
+           return_value=True)
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.gcloud.storage_write.commit_streams')
+    @patch('bqsqoop.utils.gcloud.bigquery.copy_staging_table')
+    def test_execute_streamed(self, copy_staging_table, commit_streams,
+                              setup_credentials, is_available, mock_uuid):
+        mock_uuid.return_value.hex = "f43c2651abcd"
+        _configs = dict(
+            project_id="gcp_project_1",
+            dataset_name="dataset_1",
+            table_name="table_1",
+            sink="storage_write",
+            write_truncate=False,
+            partition="20180910"
+        )
+        _extract_fn = MagicMock(return_value=["stream1", "stream2"])
+
+        _job = BigqueryParquetLoadJob(_configs)
+        self.assertEqual(_job.sink, "storage_write")
+        _job.execute_streamed(_extract_fn)
+        _staging = "projects/gcp_project_1/datasets/dataset_1/tables/" \
+            "table_1_staging_f43c2651"
+        _extract_fn.assert_called_once_with(storage_write_table=_staging)
+        commit_streams.assert_called_once_with(
+            _staging, ["stream1", "stream2"])
+        copy_staging_table.assert_called_once_with(
+            "table_1_staging_f43c2651", "gcp_project_1", "dataset_1",
+            "table_1", write_truncate=False, partition="20180910")
+
+        # Nothing extracted, nothing to commit
+        commit_streams.reset_mock()
+        _extract_fn.return_value = []
+        _job.execute_streamed(_extract_fn)
+        commit_streams.assert_not_called()
+
+    @patch('uuid.uuid4')
+    @patch('bqsqoop.utils.gcloud.storage_write.is_available',
+           return_value=True)
+    @patch('bqsqoop.utils.gcloud.auth.setup_credentials')
+    @patch('bqsqoop.utils.gcloud.storage_write.commit_streams')
+    @patch('bqsqoop.utils.gcloud.bigquery.delete_table')
+    @patch('bqsqoop.utils.gcloud.bigquery.copy_staging_table')
+    def test_failed_stream_drops_staging_table(
+            self, copy_staging_table, delete_table, commit_streams,
+            setup_credentials, is_available, mock_uuid):
+        mock_uuid.return_value.hex = "f43c2651abcd"
+        _job = BigqueryParquetLoadJob(dict(
+            project_id="gcp_project_1", dataset_name="dataset_1",
+            table_name="table_1", sink="storage_write"))
+        for _extract_fn in [MagicMock(side_effect=RuntimeError("failed")),
+                            MagicMock(return_value=["stream1"])]:
+            commit_streams.side_effect = Exception("stream_errors")
+            delete_table.reset_mock()
+            with self.assertRaises(Exception):
+                _job.execute_streamed(_extract_fn)
+            delete_table.assert_called_once_with(
+                "gcp_project_1", "dataset_1", "table_1_staging_f43c2651")
+        copy_staging_table.assert_not_called()
@@ -1,11 +1,19 @@
+import os
 import pytest
+import tempfile
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock, call
+from google.cloud.storage import _helpers as gcs_helpers
 from bqsqoop.utils.gcloud.storage import (
     copy_files_to_gcs, _get_details_from_gcs_path, delete_files_in,
-    download_file_as_string, parallel_copy_files_to_gcs
+    download_file_as_string, upload_string_to_file, list_files_in,
+    parallel_copy_files_to_gcs, new_tmp_folder_path,
+    QueueUploader, FileUploader
 )
+from bqsqoop.utils.file_queue import FileQueue
+from fake_gcs import FakeGCSServer
 
 
 class TestCommonHelpers(unittest.TestCase):
@@ -38,13 +46,24 @@ class TestCommonHelpers(unittest.TestCase):
             folder_path, "tmp_space/F43C2651-18C8-4EB0-82D2-10E3C7226015/")
 
 
+def _write_files(folder, names, nbytes=10):
+    files = []
+    for name in names:
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.write(b'0' * nbytes)
+        files.append(path)
+    return files
+
+
 class TestCopyFiles(unittest.TestCase):
     @patch('google.cloud.storage.Client')
     def test_valid_gcs_path(self, storage_client):
-        files = ["file1", "file2"]
         gcs_project = "gcs_project_1"
         valid_path = "gs://gcs_bucket"
-        copy_files_to_gcs(files, valid_path, gcs_project)
+        with tempfile.TemporaryDirectory() as folder:
+            files = _write_files(folder, ["file1", "file2"])
+            copy_files_to_gcs(files, valid_path, gcs_project)
 
     @patch('google.cloud.storage.Client')
     def test_invalid_gcs_path(self, storage_client):
@@ -63,7 +82,6 @@ class TestCopyFiles(unittest.TestCase):
     @patch('google.cloud.storage.Client')
     def test_file_uploads(self, storage_client, mock_uuid):
         gcs_bucket_path = "gs://gcs_bucket/tmp_path/"
-        files = ["file1", "file2"]
         mock_storage = MagicMock()
         storage_client.return_value = mock_storage
         mock_blob = MagicMock()
@@ -72,7 +90,9 @@ class TestCopyFiles(unittest.TestCase):
         mock_storage.get_bucket = MagicMock(return_value=mock_bucket)
         mock_blob.upload_from_filename = MagicMock()
 
-        copy_files_to_gcs(files, gcs_bucket_path, "gcs_project_1", True)
+        with tempfile.TemporaryDirectory() as folder:
+            files = _write_files(folder, ["file1", "file2"])
+            copy_files_to_gcs(files, gcs_bucket_path, "gcs_project_1", True)
         storage_client.assert_called_with(project="gcs_project_1")
         mock_storage.get_bucket.assert_called_with("gcs_bucket")
         call_args = mock_bucket.blob.call_args_list
@@ -82,19 +102,20 @@ class TestCopyFiles(unittest.TestCase):
              call("tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/file2")])
         call_args = mock_blob.upload_from_filename.call_args_list
         self.assertEqual(
-            call_args, [call(filename='file1'), call(filename='file2')])
+            call_args, [call(filename=files[0]), call(filename=files[1])])
 
 
 class TestParallelCopyFiles(unittest.TestCase):
-    @patch('bqsqoop.utils.async_worker.AsyncWorker')
-    def test_valid_gcs_path(self, async_worker):
-        files = ["file1", "file2"]
+    @patch('google.cloud.storage.Client')
+    def test_valid_gcs_path(self, storage_client):
         gcs_project = "gcs_project_1"
         valid_path = "gs://gcs_bucket"
-        parallel_copy_files_to_gcs(files, valid_path, gcs_project)
+        with tempfile.TemporaryDirectory() as folder:
+            files = _write_files(folder, ["file1", "file2"])
+            parallel_copy_files_to_gcs(files, valid_path, gcs_project)
 
-    @patch('bqsqoop.utils.async_worker.AsyncWorker')
-    def test_invalid_gcs_path(self, async_worker):
+    @patch('google.cloud.storage.Client')
+    def test_invalid_gcs_path(self, storage_client):
         files = ["file1", "file2"]
         gcs_project = "gcs_project_1"
         invalid_path = "gcs_bucket"
@@ -107,39 +128,194 @@ class TestParallelCopyFiles(unittest.TestCase):
             parallel_copy_files_to_gcs(files, invalid_path, gcs_project)
 
     @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
-    @patch('bqsqoop.utils.async_worker.AsyncWorker')
-    def test_file_uploads(self, async_worker, mock_uuid):
+    @patch('bqsqoop.utils.gcloud.storage.ThreadPoolExecutor',
+           wraps=ThreadPoolExecutor)
+    @patch('google.cloud.storage.Client')
+    def test_file_uploads(self, storage_client, thread_pool, mock_uuid):
         gcs_bucket_path = "gs://gcs_bucket/tmp_path/"
-        files = ["file1", "file2"]
-        mock_worker = MagicMock()
-        async_worker.return_value = mock_worker
-        mock_worker.send_data_to_worker = MagicMock()
+        mock_storage = MagicMock()
+        storage_client.return_value = mock_storage
+        mock_bucket = MagicMock()
+        mock_storage.get_bucket.return_value = mock_bucket
 
-        gcs_path = parallel_copy_files_to_gcs(
-            files, gcs_bucket_path, "gcs_project_1", True)
-        async_worker.assert_called_with(2)
+        with tempfile.TemporaryDirectory() as folder:
+            files = _write_files(folder, ["file%d" % i for i in range(5)])
+            gcs_path = parallel_copy_files_to_gcs(
+                files, gcs_bucket_path, "gcs_project_1", True,
+                max_concurrency=3)
         self.assertEqual(
             gcs_path,
             "gs://gcs_bucket/tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/")
-        call_args = mock_worker.send_data_to_worker.call_args_list
-        _, kwargs = call_args[0]
-        self.assertEqual(kwargs['files'], ['file1'])
+        # One client and bucket handle shared by all uploads
+        storage_client.assert_called_once_with(project="gcs_project_1")
+        mock_storage.get_bucket.assert_called_once_with("gcs_bucket")
+        thread_pool.assert_called_once_with(max_workers=3)
         self.assertEqual(
-            kwargs['gcs_bucket_path'],
+            sorted(mock_bucket.blob.call_args_list),
+            [call("tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/file%d" % i)
+             for i in range(5)])
+
+    @patch('google.cloud.storage.Client')
+    def test_upload_errors(self, storage_client):
+        mock_bucket = storage_client.return_value.get_bucket.return_value
+        mock_bucket.blob.return_value.upload_from_filename.side_effect = \
+            Exception("Upload error")
+        with tempfile.TemporaryDirectory() as folder:
+            files = _write_files(folder, ["file1", "file2"])
+            with pytest.raises(Exception, match=r'Upload error'):
+                parallel_copy_files_to_gcs(
+                    files, "gs://gcs_bucket/", "gcs_project_1")
+
+    @pytest.mark.skipif(not hasattr(gcs_helpers, 'STORAGE_EMULATOR_ENV_VAR'),
+                        reason="google-cloud-storage without emulator support")
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    def test_fake_gcs_server(self, mock_uuid):
+        with FakeGCSServer() as fake_gcs, \
+                tempfile.TemporaryDirectory() as folder:
+            files = _write_files(
+                folder, ["file%d.parq" % i for i in range(4)], nbytes=1024)
+            gcs_path = parallel_copy_files_to_gcs(
+                files, "gs://gcs_bucket/tmp_path", "gcs_project_1", True,
+                max_concurrency=2)
+        self.assertEqual(
+            gcs_path,
             "gs://gcs_bucket/tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/")
-        self.assertEqual(kwargs['project_id'], 'gcs_project_1')
-        self.assertEqual(kwargs['use_new_tmp_folder'], False)
+        self.assertEqual(fake_gcs.objects, {
+            ("gcs_bucket", "tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/"
+             "file%d.parq" % i): b'0' * 1024 for i in range(4)})
+
+
+@pytest.mark.skipif(not hasattr(gcs_helpers, 'STORAGE_EMULATOR_ENV_VAR'),
+                    reason="google-cloud-storage without emulator support")
+class TestFileUploader(unittest.TestCase):
+    def _upload(self, upload_mode, chunk_size, nbytes):
+        with FakeGCSServer() as fake_gcs, \
+                tempfile.TemporaryDirectory() as folder:
+            _file = os.path.join(folder, "file.parq")
+            with open(_file, 'wb') as f:
+                f.write(os.urandom(nbytes))
+            parallel_copy_files_to_gcs(
+                [_file], "gs://gcs_bucket/tmp/", "gcs_project_1",
+                upload_mode=upload_mode, chunk_size=chunk_size)
+            with open(_file, 'rb') as f:
+                _data = f.read()
+        return fake_gcs, _data
+
+    def test_composite_upload(self):
+        fake_gcs, _data = self._upload('composite', 1000, 4500)
+        # Chunk objects are removed once composed
+        self.assertEqual(fake_gcs.objects,
+                         {("gcs_bucket", "tmp/file.parq"): _data})
+
+    def test_composite_upload_chunks_fit_a_compose(self):
+        fake_gcs, _data = self._upload('composite', 10, 4500)
+        self.assertEqual(fake_gcs.objects,
+                         {("gcs_bucket", "tmp/file.parq"): _data})
+
+    def test_resumable_upload(self):
+        # Files up to 8MB are sent in a single request anyway
+        fake_gcs, _data = self._upload(
+            'resumable', 4 * 1024 * 1024 + 1000, 9 * 1024 * 1024)
+        self.assertEqual(fake_gcs.objects,
+                         {("gcs_bucket", "tmp/file.parq"): _data})
+        # Chunk size is rounded down to a multiple of 256KB
+        self.assertEqual(fake_gcs.uploads["0"]["chunks"], 3)
+
+    @patch('time.sleep')
+    def test_composite_chunk_retries(self, sleep):
+        mock_bucket = MagicMock()
+        _chunk_blob = MagicMock()
+        _chunk_blob.upload_from_file.side_effect = [
+            Exception("Chunk error"), None, None]
+        _final_blob = MagicMock()
+        mock_bucket.blob.side_effect = lambda name: \
+            _final_blob if name == "tmp/file.parq" else _chunk_blob
+        uploader = FileUploader(mock_bucket, "tmp/", 'composite',
+                                chunk_size=6, max_concurrency=1)
+        with tempfile.TemporaryDirectory() as folder:
+            _file = _write_files(folder, ["file.parq"])[0]
+            self.assertEqual(uploader.upload(_file), 10)
+        uploader.close()
+        self.assertEqual(mock_bucket.blob.call_args_list, [
+            call("tmp/_composite/file.parq.00000"),
+            call("tmp/_composite/file.parq.00000"),
+            call("tmp/_composite/file.parq.00001"),
+            call("tmp/file.parq")])
+        sleep.assert_called_once_with(1)
+        _final_blob.compose.assert_called_once_with(
+            [_chunk_blob, _chunk_blob])
+        self.assertEqual(_chunk_blob.delete.call_count, 2)
+
+    def test_invalid_upload_mode(self):
+        with pytest.raises(ValueError, match=r'Unknown upload_mode'):
+            FileUploader(MagicMock(), "tmp/", 'parallel')
+
+
+class TestNewTmpFolderPath(unittest.TestCase):
+    @patch('uuid.uuid4', return_value="F43C2651-18C8-4EB0-82D2-10E3C7226015")
+    def test_new_tmp_folder_path(self, mock_uuid):
         self.assertEqual(
-            kwargs['worker_callback'].__name__, "copy_files_to_gcs")
-        _, kwargs = call_args[1]
-        self.assertEqual(kwargs['files'], ['file2'])
+            new_tmp_folder_path("gs://gcs_bucket/tmp_path"),
+            "gs://gcs_bucket/tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/")
         self.assertEqual(
-            kwargs['gcs_bucket_path'],
+            new_tmp_folder_path("gs://gcs_bucket/tmp_path/"),
             "gs://gcs_bucket/tmp_path/F43C2651-18C8-4EB0-82D2-10E3C7226015/")
-        self.assertEqual(kwargs['project_id'], 'gcs_project_1')
-        self.assertEqual(kwargs['use_new_tmp_folder'], False)
+
+
+class TestQueueUploader(unittest.TestCase):
+    @patch('google.cloud.storage.Client')
+    def test_uploads_and_removes_files(self, storage_client):
+        mock_bucket = storage_client.return_value.get_bucket.return_value
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue(max_bytes=100)
+            _uploader = QueueUploader(
+                _queue, "gs://gcs_bucket/tmp/", "gcs_project_1",
+                no_of_threads=2)
+            _uploader.start()
+            _files = _write_files(
+                folder, ["file%d.parq" % i for i in range(3)])
+            for _file in _files:
+                _queue.put(_file)
+            _queue.close()
+            self.assertEqual(sorted(_uploader.join()), _files)
+            self.assertEqual(os.listdir(folder), [])
+            self.assertEqual(_queue.pending_bytes(), 0)
+        storage_client.assert_called_once_with(project="gcs_project_1")
         self.assertEqual(
-            kwargs['worker_callback'].__name__, "copy_files_to_gcs")
+            sorted(mock_bucket.blob.call_args_list),
+            [call("tmp/file%d.parq" % i) for i in range(3)])
+
+    @patch('google.cloud.storage.Client')
+    def test_upload_errors(self, storage_client):
+        mock_bucket = storage_client.return_value.get_bucket.return_value
+        mock_bucket.blob.return_value.upload_from_filename.side_effect = \
+            Exception("Upload error")
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue(max_bytes=5)
+            _uploader = QueueUploader(
+                _queue, "gs://gcs_bucket/tmp/", "gcs_project_1",
+                no_of_threads=1)
+            _uploader.start()
+            _queue.put(_write_files(folder, ["file.parq"])[0])
+            with pytest.raises(RuntimeError, match=r'Upload error'):
+                _uploader.join()
+            # Producers aren't left waiting on a failed upload
+            _queue.wait_for_space()
+
+    @patch('google.cloud.storage.Client')
+    def test_missing_file(self, storage_client):
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue(max_bytes=5)
+            _file = _write_files(folder, ["file.parq"])[0]
+            _queue.put(_file)
+            os.remove(_file)
+            _uploader = QueueUploader(
+                _queue, "gs://gcs_bucket/tmp/", "gcs_project_1",
+                no_of_threads=1)
+            _uploader.start()
+            with pytest.raises(RuntimeError, match=r'No such file'):
+                _uploader.join()
+            _queue.wait_for_space()
 
 
 class TestDeleteFilesIn(unittest.TestCase):
@@ -160,11 +336,13 @@ class TestDeleteFilesIn(unittest.TestCase):
             delete_files_in(invalid_path, "gcs_project_1")
 
     @patch('google.cloud.storage.Client')
-    def test_file_uploads(self, storage_client):
+    def test_file_deletes(self, storage_client):
         gcs_bucket_path = "gs://gcs_bucket/tmp_path/tmp2/"
         mock_storage = MagicMock()
         storage_client.return_value = mock_storage
         mock_blobs = [MagicMock(), MagicMock()]
+        mock_blobs[0].name = "tmp_path/tmp2/file1"
+        mock_blobs[1].name = "tmp_path/tmp2/file2"
         mock_bucket = MagicMock()
         mock_bucket.list_blobs = MagicMock(return_value=mock_blobs)
         mock_storage.get_bucket = MagicMock(return_value=mock_bucket)
@@ -174,8 +352,22 @@ class TestDeleteFilesIn(unittest.TestCase):
         mock_storage.get_bucket.assert_called_with("gcs_bucket")
         mock_bucket.list_blobs.assert_called_with(prefix="tmp_path/tmp2/",
                                                   delimiter="*.log")
-        mock_blobs[0].delete.assert_called_once_with()
-        mock_blobs[1].delete.assert_called_once_with()
+        mock_storage.batch.assert_called_once_with()
+        mock_storage.bucket.return_value.delete_blob.assert_has_calls(
+            [call("tmp_path/tmp2/file1"), call("tmp_path/tmp2/file2")])
+
+    @pytest.mark.skipif(not hasattr(gcs_helpers, 'STORAGE_EMULATOR_ENV_VAR'),
+                        reason="google-cloud-storage without emulator support")
+    def test_batched_deletes(self):
+        with FakeGCSServer() as fake_gcs:
+            for i in range(250):
+                fake_gcs.objects[("gcs_bucket", "tmp/%03d.parq" % i)] = b"0"
+            fake_gcs.objects[("gcs_bucket", "other/file.parq")] = b"0"
+            delete_files_in("gs://gcs_bucket/tmp/", "gcs_project_1",
+                            max_concurrency=2)
+        self.assertEqual(list(fake_gcs.objects),
+                         [("gcs_bucket", "other/file.parq")])
+        self.assertEqual(sorted(fake_gcs.batches), [50, 100, 100])
 
 
 class TestDownloadFileAsString(unittest.TestCase):
@@ -194,3 +386,43 @@ class TestDownloadFileAsString(unittest.TestCase):
         storage_client.assert_called_with()
         mock_bucket.get_blob.assert_called_with("some_folder_path/file.toml")
         mock_blob.download_as_string.assert_called_with()
+
+    @patch('google.cloud.storage.Client')
+    def test_download_missing_file(self, storage_client):
+        storage_client.return_value.get_bucket.return_value.get_blob \
+            .return_value = None
+
+        self.assertIsNone(
+            download_file_as_string("gs://gcs_bucket/missing.json"))
+
+
+class TestListFilesIn(unittest.TestCase):
+    @patch('google.cloud.storage.Client')
+    def test_list_files(self, storage_client):
+        _bucket = storage_client.return_value.get_bucket.return_value
+        _blobs = []
+        for name, size in [("tmp/b.parq", 2), ("tmp/a.parq", 1),
+                           ("tmp/_SUCCESS", 0)]:
+            _blob = MagicMock(size=size)
+            _blob.name = name
+            _blobs.append(_blob)
+        _bucket.list_blobs.return_value = _blobs
+
+        self.assertEqual(
+            list_files_in("gs://gcs_bucket/tmp/", "project", suffix=".parq"),
+            [("gs://gcs_bucket/tmp/a.parq", 1),
+             ("gs://gcs_bucket/tmp/b.parq", 2)])
+        _bucket.list_blobs.assert_called_with(prefix="tmp/")
+
+
+class TestUploadStringToFile(unittest.TestCase):
+    @patch('google.cloud.storage.Client')
+    def test_upload(self, storage_client):
+        mock_bucket = storage_client.return_value.get_bucket.return_value
+
+        upload_string_to_file("contents", "gs://gcs_bucket/state/file.json")
+        storage_client.return_value.get_bucket.assert_called_with(
+            "gcs_bucket")
+        mock_bucket.blob.assert_called_with("state/file.json")
+        mock_bucket.blob.return_value.upload_from_string.assert_called_with(
+            "contents")
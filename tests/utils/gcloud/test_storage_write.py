@@ -0,0 +1,151 @@
+import unittest
+import pyarrow as pa
+
+from unittest.mock import patch, MagicMock
+from bqsqoop.utils.gcloud import storage_write
+
+
+_TABLE = "projects/p/datasets/d/tables/t"
+
+
+def _table(rows):
+    return pa.table({'id': list(range(rows)),
+                     'name': ['name{}'.format(i) for i in range(rows)]})
+
+
+def _mock_storage_v1():
+    # Request messages keep their fields as attributes
+    _module = MagicMock()
+    _types = _module.types
+    _types.AppendRowsRequest.side_effect = \
+        lambda **kwargs: MagicMock(write_stream=None, **kwargs)
+    _types.AppendRowsRequest.ArrowData.side_effect = \
+        lambda **kwargs: MagicMock(writer_schema=None, **kwargs)
+    _types.ArrowRecordBatch.side_effect = lambda **kwargs: kwargs
+    _types.ArrowSchema.side_effect = lambda **kwargs: kwargs
+    return _module
+
+
+@patch('bqsqoop.utils.gcloud.storage_write._create_table_if_needed')
+class TestPendingStreamWriter(unittest.TestCase):
+    def setUp(self):
+        self.storage_v1 = _mock_storage_v1()
+        _patcher = patch(
+            'bqsqoop.utils.gcloud.storage_write.bigquery_storage_v1',
+            self.storage_v1)
+        _patcher.start()
+        self.addCleanup(_patcher.stop)
+        self.client = self.storage_v1.BigQueryWriteClient.return_value
+        self.client.create_write_stream.return_value.name = _TABLE + \
+            "/streams/s1"
+        self.requests = []
+
+        def _append_rows(requests):
+            self.requests.extend(requests)
+            return [MagicMock(**{'error.code': 0})]
+        self.client.append_rows.side_effect = _append_rows
+
+    def test_appends_with_offsets(self, create_table):
+        _writer = storage_write.PendingStreamWriter(_TABLE)
+        with patch.object(storage_write, 'MAX_REQUEST_BYTES', 100):
+            _writer.write(_table(10))
+        _writer.write(_table(3))
+
+        create_table.assert_called_once_with(_TABLE, _table(1).schema)
+        self.client.create_write_stream.assert_called_once()
+        self.assertEqual(_writer.rows_written, 13)
+        _rows = [pa.ipc.read_record_batch(
+            _request.arrow_rows.rows['serialized_record_batch'],
+            _table(1).schema).num_rows for _request in self.requests]
+        self.assertGreater(len(_rows), 2)
+        self.assertEqual(sum(_rows), 13)
+        _offsets = [_request.offset for _request in self.requests]
+        self.assertEqual(_offsets, [sum(_rows[:i])
+                                    for i in range(len(_rows))])
+        # Each connection's first request names the stream and schema
+        _firsts = [i for i, _request in enumerate(self.requests)
+                   if _request.write_stream]
+        self.assertEqual(_firsts, [0, len(_rows) - 1])
+        self.assertEqual(
+            [i for i, _request in enumerate(self.requests)
+             if _request.arrow_rows.writer_schema], _firsts)
+
+        self.assertEqual(_writer.close(), [_TABLE + "/streams/s1"])
+        self.client.finalize_write_stream.assert_called_once_with(
+            name=_TABLE + "/streams/s1")
+
+    def test_nothing_written(self, create_table):
+        self.assertEqual(
+            storage_write.PendingStreamWriter(_TABLE).close(), [])
+        create_table.assert_not_called()
+        self.client.finalize_write_stream.assert_not_called()
+
+    def test_append_error(self, create_table):
+        self.client.append_rows.side_effect = lambda requests: [
+            MagicMock(**{'error.code': 3, 'error.message': 'bad row'})]
+        with self.assertRaisesRegex(Exception, 'bad row'):
+            storage_write.PendingStreamWriter(_TABLE).write(_table(1))
+
+    def test_nanosecond_timestamps(self, create_table):
+        _writer = storage_write.PendingStreamWriter(_TABLE)
+        _writer.write(pa.table({'at': pa.array(
+            [1], type=pa.timestamp('ns', 'UTC'))}))
+        create_table.assert_called_once_with(
+            _TABLE, pa.schema([('at', pa.timestamp('us', 'UTC'))]))
+
+    def test_nested_nanosecond_timestamps(self, create_table):
+        _writer = storage_write.PendingStreamWriter(_TABLE)
+        _type = pa.list_(pa.struct([('at', pa.timestamp('ns'))]))
+        _writer.write(pa.table({'events': pa.array(
+            [[{'at': 1000}], None], type=_type)}))
+        create_table.assert_called_once_with(_TABLE, pa.schema([
+            ('events', pa.list_(pa.struct([('at', pa.timestamp('us'))])))]))
+
+    def test_commit_streams(self, create_table):
+        self.client.batch_commit_write_streams.return_value.stream_errors = []
+        storage_write.commit_streams(_TABLE, ["s1", "s2"])
+        self.storage_v1.types.BatchCommitWriteStreamsRequest \
+            .assert_called_once_with(parent=_TABLE, write_streams=["s1", "s2"])
+
+        self.client.batch_commit_write_streams.return_value.stream_errors = [
+            'stream s2 not finalized']
+        with self.assertRaisesRegex(Exception, 's2 not finalized'):
+            storage_write.commit_streams(_TABLE, ["s1", "s2"])
+
+
+class TestStorageWrite(unittest.TestCase):
+    def test_table_path(self):
+        self.assertEqual(storage_write.table_path("p", "d", "t"), _TABLE)
+
+    @patch('bqsqoop.utils.gcloud.storage_write.bigquery_storage_v1', None)
+    def test_not_available(self):
+        self.assertFalse(storage_write.is_available())
+
+    def test_bq_schema(self):
+        _schema = storage_write.bq_schema(pa.schema([
+            ('id', pa.int64()), ('score', pa.float64()),
+            ('ok', pa.bool_()), ('name', pa.string()),
+            ('raw', pa.binary()), ('at', pa.timestamp('us')),
+            ('tags', pa.list_(pa.string())),
+            ('owner', pa.struct([('name', pa.string())])),
+            ('other', pa.null())]))
+        self.assertEqual(
+            [(f.name, f.field_type, f.mode) for f in _schema], [
+                ('id', 'INTEGER', 'NULLABLE'), ('score', 'FLOAT', 'NULLABLE'),
+                ('ok', 'BOOLEAN', 'NULLABLE'), ('name', 'STRING', 'NULLABLE'),
+                ('raw', 'BYTES', 'NULLABLE'),
+                ('at', 'TIMESTAMP', 'NULLABLE'),
+                ('tags', 'STRING', 'REPEATED'),
+                ('owner', 'RECORD', 'NULLABLE'),
+                ('other', 'STRING', 'NULLABLE')])
+        self.assertEqual(_schema[7].fields[0].name, 'name')
+
+    @patch('google.cloud.bigquery.Client')
+    def test_create_table_if_needed(self, bigquery_client):
+        storage_write._create_table_if_needed(
+            _TABLE, pa.schema([('id', pa.int64())]))
+        bigquery_client.assert_called_with(project="p")
+        _args, _kwargs = bigquery_client.return_value.create_table.call_args
+        self.assertEqual(_args[0].table_id, "t")
+        self.assertEqual(_args[0].schema[0].field_type, 'INTEGER')
+        self.assertEqual(_kwargs, {'exists_ok': True})
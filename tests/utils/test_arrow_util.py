@@ -0,0 +1,269 @@
+import unittest
+import pandas as pd
+import pyarrow as pa
+
+from unittest.mock import patch
+from decimal import Decimal
+from datetime import datetime
+from bqsqoop.utils.arrow_util import (
+    values_to_array, null_array, arrays_to_record_batch, table_from_pandas,
+    records_to_table, stable_schema, _schema_converters, _raw_type_overrides
+)
+
+
+class TestValuesToArray(unittest.TestCase):
+    def test_inferred_type(self):
+        _array = values_to_array([1, None, 3])
+        self.assertEqual(_array.type, pa.int64())
+        self.assertEqual(_array.to_pylist(), [1, None, 3])
+
+    def test_typed_conversion(self):
+        _array = values_to_array([1, None], pa.float64())
+        self.assertEqual(_array.type, pa.float64())
+        self.assertEqual(_array.to_pylist(), [1.0, None])
+
+    def test_cast_fallback(self):
+        _array = values_to_array([Decimal("1.5"), None], pa.float64())
+        self.assertEqual(_array.to_pylist(), [1.5, None])
+        _array = values_to_array([1, 2], pa.string())
+        self.assertEqual(_array.to_pylist(), ['1', '2'])
+
+    def test_null_array(self):
+        _array = null_array(pa.string(), 2)
+        self.assertEqual(_array.type, pa.string())
+        self.assertEqual(_array.to_pylist(), [None, None])
+
+
+class TestArraysToRecordBatch(unittest.TestCase):
+    def test_without_schema(self):
+        _batch = arrays_to_record_batch(
+            [pa.array([1, 2]), pa.array(['a', 'b'])], ['colA', 'colB'])
+        self.assertEqual(_batch.schema.names, ['colA', 'colB'])
+        self.assertEqual(_batch.num_rows, 2)
+
+    def test_with_schema(self):
+        _schema = pa.schema([
+            pa.field('colB', pa.string()),
+            pa.field('colC', pa.int64()),
+            pa.field('colA', pa.float64()),
+        ])
+        _batch = arrays_to_record_batch(
+            [pa.array([1, 2]), pa.array(['a', 'b']), pa.array([True, False])],
+            ['colA', 'colB', 'ignored'], schema=_schema)
+        self.assertEqual(_batch.schema.names, ['colB', 'colC', 'colA'])
+        self.assertEqual(_batch.column(2).type, pa.float64())
+        self.assertEqual(_batch.to_pydict(), {
+            'colB': ['a', 'b'], 'colC': [None, None], 'colA': [1.0, 2.0]})
+
+
+class TestTableFromPandas(unittest.TestCase):
+    def test_conforms_to_schema(self):
+        df = pd.DataFrame.from_dict([
+            dict(colA=None, colB="1.5", colC=True, colD=1.0,
+                 colE="2018-09-10T00:00:00", colF={"a": 1}, extra=1),
+            dict(colA="val", colB=None, colC=False, colD=None,
+                 colE="invalid", colF="str", extra=2),
+        ])
+        schema = pa.schema([
+            pa.field("colA", pa.string()),
+            pa.field("colB", pa.float64()),
+            pa.field("colC", pa.binary()),
+            pa.field("colD", pa.int64()),
+            pa.field("colE", pa.timestamp('ns')),
+            pa.field("colF", pa.string()),
+            pa.field("missing", pa.int64()),
+        ])
+        table = table_from_pandas(df, schema)
+        self.assertEqual(table.schema, schema)
+        self.assertEqual(table.to_pydict(), {
+            "colA": [None, "val"],
+            "colB": [1.5, None],
+            "colC": [b'\x01', b''],
+            "colD": [1, None],
+            "colE": [pd.Timestamp(2018, 9, 10), None],
+            "colF": ["{'a': 1}", "str"],
+            "missing": [None, None],
+        })
+
+    def test_float_values_to_string(self):
+        df = pd.DataFrame({"colA": [0.5, None]})
+        table = table_from_pandas(df, pa.schema([("colA", pa.string())]))
+        self.assertEqual(table.to_pydict(), {"colA": ["0.5", None]})
+
+    def test_datetime_format(self):
+        df = pd.DataFrame({"colE": ["10/09/2018", "2018-09-10"]})
+        schema = pa.schema([pa.field("colE", pa.timestamp('ns'))])
+        table = table_from_pandas(df, schema, datetime_format="%d/%m/%Y")
+        self.assertEqual(table.column("colE").to_pylist(),
+                         [pd.Timestamp(2018, 9, 10), None])
+
+    def test_matching_dtypes_are_not_copied(self):
+        df = pd.DataFrame({
+            "colA": [1, 2], "colB": [1.5, 2.5],
+            "colC": [datetime(2018, 9, 10), datetime(2018, 9, 11)]})
+        schema = pa.schema([
+            pa.field("colA", pa.int64()),
+            pa.field("colB", pa.float64()),
+            pa.field("colC", pa.timestamp('ns')),
+        ])
+        table = table_from_pandas(df, schema)
+        for name in ["colA", "colB", "colC"]:
+            # Arrow data is the frame's numpy buffer
+            self.assertEqual(
+                table.column(name).chunk(0).buffers()[1].address,
+                df[name].values.ctypes.data)
+        self.assertEqual(table.column("colA").to_pylist(), [1, 2])
+
+    def test_converters_are_cached_per_schema(self):
+        schema = pa.schema([pa.field("colA", pa.int64())])
+        _schema_converters.cache_clear()
+        table_from_pandas(pd.DataFrame({"colA": [1]}), schema)
+        table_from_pandas(pd.DataFrame({"colA": [2]}), schema)
+        self.assertEqual(_schema_converters.cache_info().misses, 1)
+        self.assertEqual(_schema_converters.cache_info().hits, 1)
+
+    def test_without_schema(self):
+        table = table_from_pandas(pd.DataFrame({"colA": [1, 2]}))
+        self.assertEqual(table.schema, pa.schema([("colA", pa.int64())]))
+
+
+class TestStableSchema(unittest.TestCase):
+    def test_sample_dependent_types(self):
+        self.assertEqual(stable_schema(pa.schema([
+            ("colA", pa.null()), ("colB", pa.decimal128(2, 1)),
+            ("colC", pa.int64()), ("colD", pa.timestamp('ns'))])),
+            pa.schema([
+                ("colA", pa.string()), ("colB", pa.float64()),
+                ("colC", pa.int64()), ("colD", pa.timestamp('ns'))]))
+
+
+class TestRecordsToTable(unittest.TestCase):
+    schema = pa.schema([
+        pa.field("colA", pa.string()),
+        pa.field("colB", pa.float64()),
+        pa.field("colC", pa.binary()),
+        pa.field("colD", pa.int64()),
+        pa.field("colE", pa.timestamp('ns')),
+        pa.field("missing", pa.int64()),
+    ])
+
+    def test_conforms_to_schema(self):
+        records = [
+            dict(colA=None, colB=1.5, colC=True, colD=1,
+                 colE="2018-09-10T00:00:00", extra=1),
+            dict(colA="val", colC=False, colE="invalid"),
+        ]
+        table = records_to_table(
+            records, self.schema, datetime_format="%Y-%m-%dT%H:%M:%S")
+        self.assertEqual(table.schema, self.schema)
+        self.assertEqual(table.to_pydict(), {
+            "colA": [None, "val"],
+            "colB": [1.5, None],
+            "colC": [b'\x01', b''],
+            "colD": [1, None],
+            "colE": [pd.Timestamp(2018, 9, 10), None],
+            "missing": [None, None],
+        })
+
+    @patch('bqsqoop.utils.arrow_util._STRPTIME_OPTIONS', {})
+    def test_strptime_without_error_is_null(self):
+        # pyarrow < 8.0, invalid values fall back to pandas
+        records = [dict(colE="2018-09-10T00:00:00"), dict(colE="invalid")]
+        table = records_to_table(
+            records, self.schema, datetime_format="%Y-%m-%dT%H:%M:%S")
+        self.assertEqual(table.to_pydict()["colE"],
+                         [pd.Timestamp(2018, 9, 10), None])
+
+    def test_columns_with_unexpected_types(self):
+        records = [
+            dict(colA={"a": 1}, colB="1.5", colC="true", colD=1.0,
+                 colE="2018-09-10T00:00:00Z"),
+            dict(colA=2, colB=None, colC=None, colD=2.0, colE=None),
+        ]
+        table = records_to_table(records, self.schema)
+        self.assertEqual(table.schema, self.schema)
+        self.assertEqual(table.to_pydict(), {
+            "colA": ["{'a': 1}", "2"],
+            "colB": [1.5, None],
+            "colC": [b'\x01', None],
+            "colD": [1, 2],
+            "colE": [pd.Timestamp(2018, 9, 10), None],
+            "missing": [None, None],
+        })
+
+    def test_remembers_raw_types_of_mismatched_fields(self):
+        schema = pa.schema([("colA", pa.string()), ("colB", pa.int64())])
+        _raw_type_overrides.pop((schema, None), None)
+        for _ in range(2):
+            table = records_to_table(
+                [dict(colA=0.5, colB=1), dict(colA=None, colB=2)], schema)
+            self.assertEqual(table.to_pydict(), {
+                "colA": ["0.5", None], "colB": [1, 2]})
+            self.assertEqual(_raw_type_overrides[(schema, None)],
+                             {"colA": pa.float64()})
+
+    def test_nested_fields(self):
+        schema = pa.schema([
+            ("address", pa.struct([
+                ("city", pa.string()), ("since", pa.timestamp('ns')),
+                ("verified", pa.binary())])),
+            ("comments", pa.list_(pa.struct([
+                ("author", pa.string()), ("likes", pa.int64())]))),
+            ("tags", pa.list_(pa.string())),
+        ])
+        records = [
+            dict(address=dict(city="x", since="2018-09-10T00:00:00",
+                              verified=True),
+                 comments=[dict(author="a", likes=1), dict(author="b")],
+                 tags=["t1", "t2"]),
+            # ES fields can hold a single value instead of an array
+            dict(address=dict(city=5), comments=dict(author="c"),
+                 tags="t3"),
+            dict(),
+        ]
+        table = records_to_table(
+            records, schema, datetime_format="%Y-%m-%dT%H:%M:%S")
+        self.assertEqual(table.schema, schema)
+        self.assertEqual(table.to_pylist(), [
+            dict(address=dict(city="x", since=pd.Timestamp(2018, 9, 10),
+                              verified=b'\x01'),
+                 comments=[dict(author="a", likes=1),
+                           dict(author="b", likes=None)],
+                 tags=["t1", "t2"]),
+            dict(address=dict(city="5", since=None, verified=None),
+                 comments=[dict(author="c", likes=None)], tags=["t3"]),
+            dict(address=None, comments=None, tags=None),
+        ])
+
+    def test_nested_fields_of_other_types(self):
+        schema = pa.schema([
+            ("o", pa.struct([("x", pa.int64()), ("y", pa.float64())])),
+            ("tags", pa.list_(pa.int64())),
+        ])
+        records = [
+            dict(o=dict(x="3", y="1"), tags=["1", "2"]),
+            dict(o=dict(x="4", y="0.5"), tags="3"),
+        ]
+        table = records_to_table(records, schema)
+        self.assertEqual(table.to_pylist(), [
+            dict(o=dict(x=3, y=1.0), tags=[1, 2]),
+            dict(o=dict(x=4, y=0.5), tags=[3]),
+        ])
+
+    def test_array_of_objects(self):
+        # Object fields' schema, see ESHelper._get_property_types
+        schema = pa.schema([
+            ("o", pa.list_(pa.struct([("x", pa.int64())]))),
+        ])
+        records = [dict(o=[dict(x=1), dict(x=2)]), dict(o=dict(x=3)),
+                   dict(o=None)]
+        table = records_to_table(records, schema)
+        self.assertEqual(table.to_pydict(), {
+            "o": [[dict(x=1), dict(x=2)], [dict(x=3)], None]})
+
+    def test_same_as_table_from_pandas(self):
+        records = [dict(colA="a%d" % i, colB=i * 0.5, colC=i % 2 == 0,
+                        colD=i, colE="2018-09-10T00:00:%02d" % i)
+                   for i in range(10)]
+        self.assertTrue(records_to_table(records, self.schema).equals(
+            table_from_pandas(pd.DataFrame.from_dict(records), self.schema)))
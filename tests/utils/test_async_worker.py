@@ -1,6 +1,9 @@
-from time import sleep
+import os
+import tempfile
 import unittest
 
+from time import sleep, time
+from bqsqoop.utils.retry import RetryPolicy
 from bqsqoop.utils.async_worker import AsyncWorker
 
 
@@ -13,6 +16,17 @@ def raise_exception():
     raise Exception("Test")
 
 
+def flaky_task(counter_file, failures, result):
+    # Fails the first few attempts, counted in a file across processes
+    with open(counter_file, "a+") as f:
+        f.seek(0)
+        attempt = len(f.read()) + 1
+        f.write("x")
+    if attempt <= failures:
+        raise IOError("attempt {}".format(attempt))
+    return result
+
+
 class TestAsyncWorker(unittest.TestCase):
     def test_happy_path(self):
         _worker = AsyncWorker(2)
@@ -22,9 +36,68 @@ class TestAsyncWorker(unittest.TestCase):
         self.assertTrue(1 in _results)
         self.assertTrue(5 in _results)
 
+    def test_results_in_submission_order(self):
+        _worker = AsyncWorker(2)
+        for ms in [30, 1, 10, 1, 5]:
+            _worker.send_data_to_worker(sleep_task, ms=ms)
+        self.assertEqual(_worker.get_job_results(), [30, 1, 10, 1, 5])
+
     def test_exception_path(self):
         _worker = AsyncWorker(2)
         _worker.send_data_to_worker(sleep_task, ms=5)
         _worker.send_data_to_worker(raise_exception)
         with self.assertRaises(Exception):
             _worker.get_job_results()
+
+    def test_results_reported_as_jobs_finish(self):
+        _worker = AsyncWorker(2)
+        _worker.send_data_to_worker(sleep_task, ms=100)
+        _worker.send_data_to_worker(raise_exception)
+        _worker.send_data_to_worker(sleep_task, ms=1)
+        _reported = {}
+
+        def _on_result(i, result):
+            _reported[i] = result
+        with self.assertRaises(RuntimeError):
+            _worker.get_job_results(on_result=_on_result)
+        # The running job's result isn't lost
+        self.assertEqual(_reported[0], 100)
+        self.assertIsInstance(_reported[1], Exception)
+
+    def test_failed_jobs_are_retried(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _worker = AsyncWorker(2, retry_policy=RetryPolicy(
+                max_attempts=3, backoff_secs=0.2))
+            _worker.send_data_to_worker(
+                flaky_task, counter_file=os.path.join(folder, "0"),
+                failures=2, result="a")
+            _worker.send_data_to_worker(sleep_task, ms=1)
+            _worker.send_data_to_worker(
+                flaky_task, counter_file=os.path.join(folder, "2"),
+                failures=1, result="c")
+            _start = time()
+            self.assertEqual(_worker.get_job_results(), ["a", 1, "c"])
+            # Waited 0.2 then 0.4 secs before the retries of job 0
+            self.assertGreaterEqual(time() - _start, 0.6)
+
+    def test_out_of_retries(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _worker = AsyncWorker(2, retry_policy=RetryPolicy(
+                max_attempts=2, backoff_secs=0))
+            _worker.send_data_to_worker(
+                flaky_task, counter_file=os.path.join(folder, "0"),
+                failures=2, result="a")
+            with self.assertRaises(RuntimeError):
+                _worker.get_job_results()
+            with open(os.path.join(folder, "0")) as f:
+                self.assertEqual(f.read(), "xx")
+
+    def test_not_retryable_errors(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _worker = AsyncWorker(1, retry_policy=RetryPolicy(
+                max_attempts=3, retry_on=(ValueError,)))
+            _worker.send_data_to_worker(
+                flaky_task, counter_file=os.path.join(folder, "0"),
+                failures=1, result="a")
+            with self.assertRaises(RuntimeError):
+                _worker.get_job_results()
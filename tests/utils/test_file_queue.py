@@ -0,0 +1,69 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from bqsqoop.utils.file_queue import FileQueue, shared_file_queue
+
+
+def _write_file(folder, name, nbytes):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(b'0' * nbytes)
+    return path
+
+
+class TestFileQueue(unittest.TestCase):
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue()
+            _queue.put(_write_file(folder, 'a.parq', 10))
+            _queue.put(_write_file(folder, 'b.parq', 20))
+            self.assertEqual(_queue.pending_bytes(), 30)
+            self.assertEqual(_queue.get(), os.path.join(folder, 'a.parq'))
+            _queue.done(10)
+            self.assertEqual(_queue.pending_bytes(), 20)
+            _queue.close()
+            # Queued files are still handed out after close
+            self.assertEqual(_queue.get(), os.path.join(folder, 'b.parq'))
+            self.assertIsNone(_queue.get())
+
+    def test_wait_for_space(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue(max_bytes=15)
+            _queue.put(_write_file(folder, 'a.parq', 20))
+            _waited = threading.Event()
+
+            def _producer():
+                _queue.wait_for_space()
+                _waited.set()
+
+            _thread = threading.Thread(target=_producer)
+            _thread.start()
+            time.sleep(0.05)
+            self.assertFalse(_waited.is_set())
+            _queue.get()
+            _queue.done(20)
+            _thread.join(timeout=1)
+            self.assertTrue(_waited.is_set())
+
+    def test_close_unblocks_producers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            _queue = FileQueue(max_bytes=15)
+            _queue.put(_write_file(folder, 'a.parq', 20))
+            _queue.close()
+            # Doesn't block
+            _queue.wait_for_space()
+
+
+class TestSharedFileQueue(unittest.TestCase):
+    def test_proxy(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with shared_file_queue(max_bytes=100) as _queue:
+                _queue.put(_write_file(folder, 'a.parq', 10))
+                self.assertEqual(_queue.pending_bytes(), 10)
+                self.assertEqual(_queue.get(), os.path.join(folder, 'a.parq'))
+                _queue.done(10)
+                _queue.close()
+                self.assertIsNone(_queue.get())
@@ -2,7 +2,9 @@ import pytest
 import unittest
 
 from datetime import datetime
-from bqsqoop.utils.math_util import calculate_splits
+from bqsqoop.utils.math_util import (
+    calculate_splits, calculate_splits_from_buckets
+)
 
 
 class TestCalculateSplits(unittest.TestCase):
@@ -81,3 +83,37 @@ class TestCalculateSplits(unittest.TestCase):
                 Exception,
                 match=r'Type of the split-by column is not supported.'):
             calculate_splits(3.4, 267.5, 10)
+
+
+class TestCalculateSplitsFromBuckets(unittest.TestCase):
+    def test_int_buckets(self):
+        splits = calculate_splits_from_buckets(1, 1000, [
+            (1, 3, 100), (3, 3, 100), (3, 40, 100), (41, 1000, 100)])
+        self.assertEqual(splits, [
+            {'start': 1, 'end': 3, 'rows': 200},
+            {'start': 4, 'end': 40, 'rows': 100},
+            {'start': 41, 'end': 1000, 'rows': 100}])
+
+    def test_sampled_buckets_are_stretched(self):
+        splits = calculate_splits_from_buckets(1, 1000, [
+            (5, 10, 100), (20, 900, 100)])
+        self.assertEqual(splits, [
+            {'start': 1, 'end': 10, 'rows': 100},
+            {'start': 11, 'end': 1000, 'rows': 100}])
+
+    def test_datetime_buckets(self):
+        splits = calculate_splits_from_buckets(
+            datetime(2017, 1, 1), datetime(2018, 1, 1), [
+                (datetime(2017, 1, 1), datetime(2017, 2, 1), 10),
+                (datetime(2017, 2, 1), datetime(2018, 1, 1), 10)])
+        self.assertEqual(splits, [
+            {'start': datetime(2017, 1, 1), 'end': datetime(2017, 2, 1),
+             'rows': 10},
+            {'start': datetime(2017, 2, 1, 0, 0, 0, 1),
+             'end': datetime(2018, 1, 1), 'rows': 10}])
+
+    def test_unknown_type(self):
+        with pytest.raises(
+                Exception,
+                match=r'Type of the split-by column is not supported.'):
+            calculate_splits_from_buckets(3.4, 267.5, [(3.4, 267.5, 10)])
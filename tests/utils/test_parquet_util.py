@@ -1,11 +1,12 @@
 import os
 import unittest
+from unittest.mock import MagicMock, call, patch
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 
 from datetime import datetime
-from bqsqoop.utils.parquet_util import ParquetUtil
+from bqsqoop.utils.parquet_util import ParquetUtil, validate_writer_options
 
 
 def sample_df():
@@ -48,6 +49,152 @@ class TestParquetUtil(unittest.TestCase):
         self.assertEqual(_table_dict['colA'], ['val1', 'val2', 'val1', 'val2'])
         self.assertEqual(_table_dict['colB'], [1, 2, 1, 2])
 
+    def test_append_record_batch_to_parquet(self):
+        _filename = "/tmp/test_append_record_batch_to_parquet.parq"
+        _batch = pa.RecordBatch.from_arrays(
+            [pa.array(['val1', 'val2']), pa.array([1, 2])], ['colA', 'colB'])
+        _pu = ParquetUtil(_filename)
+        _pu.append_record_batch_to_parquet(_batch)
+        _pu.append_record_batch_to_parquet(_batch)
+        _pu.close()
+
+        _ptable = pq.read_table(_filename)
+        os.remove(_filename)
+        _table_dict = _ptable.to_pydict()
+        self.assertEqual(_table_dict['colA'], ['val1', 'val2', 'val1', 'val2'])
+        self.assertEqual(_table_dict['colB'], [1, 2, 1, 2])
+
+    def test_buffered_row_groups(self):
+        _filename = "/tmp/test_buffered_row_groups.parq"
+        _table = pa.Table.from_pandas(sample_df(), preserve_index=False)
+        _pu = ParquetUtil(_filename, row_group_bytes=_table.nbytes * 3)
+        for _ in range(7):
+            _pu.append_table_to_parquet(_table)
+        self.assertEqual(_pu.rows_appended, 14)
+        self.assertEqual(_pu.bytes_appended, _table.nbytes * 7)
+        _pu.close()
+
+        _pfile = pq.ParquetFile(_filename)
+        _ptable = _pfile.read()
+        os.remove(_filename)
+        # Two full row groups of 3 appends and the rest flushed on close
+        self.assertEqual(_pfile.num_row_groups, 3)
+        self.assertEqual(_ptable.num_rows, 14)
+
+    def test_unbuffered_row_groups(self):
+        _filename = "/tmp/test_unbuffered_row_groups.parq"
+        _pu = ParquetUtil(_filename)
+        _pu.append_df_to_parquet(sample_df())
+        _pu.append_df_to_parquet(sample_df())
+        _pu.close()
+
+        _pfile = pq.ParquetFile(_filename)
+        os.remove(_filename)
+        self.assertEqual(_pfile.num_row_groups, 2)
+
+    def test_output_queue(self):
+        _filename = "/tmp/test_output_queue.parq"
+        _queue = MagicMock()
+        _pu = ParquetUtil(_filename, output_queue=_queue)
+        _pu.close()
+        # Nothing written, nothing to queue
+        _queue.wait_for_space.assert_not_called()
+        _queue.put.assert_not_called()
+
+        _pu.append_df_to_parquet(sample_df())
+        _queue.wait_for_space.assert_called_once_with()
+        _queue.put.assert_not_called()
+        _pu.close()
+        os.remove(_filename)
+        _queue.put.assert_called_once_with(_filename)
+
+    def test_roll_files_by_rows(self):
+        _filename = "/tmp/test_roll_files_by_rows.parq"
+        _queue = MagicMock()
+        _pu = ParquetUtil(_filename, max_file_rows=3, output_queue=_queue)
+        for _ in range(4):
+            _pu.append_df_to_parquet(sample_df())
+        _files = _pu.close()
+
+        self.assertEqual(_files, [
+            "/tmp/test_roll_files_by_rows_00000.parq",
+            "/tmp/test_roll_files_by_rows_00001.parq",
+            "/tmp/test_roll_files_by_rows_00002.parq"])
+        self.assertEqual(_pu.output_files, _files)
+        _rows = []
+        for _file in _files:
+            _rows.append(pq.read_table(_file).to_pydict()['colB'])
+            os.remove(_file)
+        # Appends crossing the limit are split between files
+        self.assertEqual(_rows, [[1, 2, 1], [2, 1, 2], [1, 2]])
+        self.assertEqual(_queue.put.call_args_list,
+                         [call(_file) for _file in _files])
+
+    def test_roll_files_by_bytes(self):
+        _filename = "/tmp/test_roll_files_by_bytes.parq"
+        _pu = ParquetUtil(_filename, max_file_bytes=1)
+        _pu.append_df_to_parquet(sample_df())
+        _pu.append_df_to_parquet(sample_df())
+        _files = _pu.close()
+
+        self.assertEqual(_files, [
+            "/tmp/test_roll_files_by_bytes_00000.parq",
+            "/tmp/test_roll_files_by_bytes_00001.parq"])
+        for _file in _files:
+            self.assertEqual(pq.read_table(_file).num_rows, 2)
+            os.remove(_file)
+
+    def test_close_returns_output_files(self):
+        _filename = "/tmp/test_close_returns_output_files.parq"
+        _pu = ParquetUtil(_filename)
+        self.assertEqual(_pu.close(), [])
+        _pu.append_df_to_parquet(sample_df())
+        self.assertEqual(_pu.close(), [_filename])
+        os.remove(_filename)
+
+    def test_writer_options(self):
+        _filename = "/tmp/test_writer_options.parq"
+        _pu = ParquetUtil(_filename, writer_options=dict(
+            compression='zstd', compression_level=5,
+            use_dictionary=['colA'], data_page_size=1024))
+        _pu.append_df_to_parquet(sample_df())
+        _pu.close()
+
+        _columns = pq.ParquetFile(_filename).metadata.row_group(0)
+        self.assertEqual(_columns.column(0).compression, 'ZSTD')
+        self.assertIn('RLE_DICTIONARY', _columns.column(0).encodings)
+        self.assertNotIn('RLE_DICTIONARY', _columns.column(1).encodings)
+        os.remove(_filename)
+
+    @patch('bqsqoop.utils.gcloud.storage_write.PendingStreamWriter')
+    def test_storage_write_table(self, stream_writer):
+        _filename = "/tmp/test_storage_write_table.parq"
+        stream_writer.return_value.close.return_value = ["stream1"]
+        _pu = ParquetUtil(_filename, storage_write_table="projects/p")
+        _pu.append_df_to_parquet(sample_df())
+
+        self.assertEqual(_pu.close(), ["stream1"])
+        stream_writer.assert_called_once_with("projects/p")
+        _table = stream_writer.return_value.write.call_args[0][0]
+        self.assertEqual(_table.to_pydict()['colB'], [1, 2])
+        self.assertFalse(os.path.exists(_filename))
+
+    def test_validate_writer_options(self):
+        self.assertEqual(validate_writer_options(
+            {'compression': 'zstd', 'compression_level': 3}), {})
+        self.assertEqual(
+            set(validate_writer_options(
+                {'compression': 'lzo', 'block_size': 1})),
+            {'compression', 'block_size'})
+        # snappy is the default codec
+        self.assertEqual(
+            list(validate_writer_options({'compression_level': 3})),
+            ['compression_level'])
+        self.assertEqual(
+            list(validate_writer_options(
+                {'compression': 'none', 'compression_level': 3})),
+            ['compression_level'])
+
     def test_build_pyarrow_schema(self):
         _pu = ParquetUtil("tmp")
         column_schema = {
@@ -81,6 +228,22 @@ class TestParquetUtil(unittest.TestCase):
         self.assertEqual(pa_schema.field_by_name(
             "datetime_field").type, pa.timestamp('ns'))
 
+    def test_build_nested_pyarrow_schema(self):
+        _pu = ParquetUtil("tmp")
+        pa_schema = _pu.build_pyarrow_schema({
+            "address": {"city": "text", "since": "date"},
+            "comments": [{"author": "text", "likes": "long"}],
+            "tags": ["text"],
+        })
+        self.assertEqual(pa_schema.field_by_name("address").type, pa.struct([
+            ("city", pa.string()), ("since", pa.timestamp('ns'))]))
+        self.assertEqual(
+            pa_schema.field_by_name("comments").type,
+            pa.list_(pa.struct([("author", pa.string()),
+                                ("likes", pa.int64())])))
+        self.assertEqual(pa_schema.field_by_name("tags").type,
+                         pa.list_(pa.string()))
+
     def test_fix_dataframe_for_schema(self):
         data = [
             dict(colA=None, colB=None, colD=1,
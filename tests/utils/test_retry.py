@@ -0,0 +1,35 @@
+import pytest
+import unittest
+
+from unittest.mock import patch, MagicMock
+from bqsqoop.utils.retry import RetryPolicy, call_with_retries
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_backoff(self):
+        _policy = RetryPolicy(
+            max_attempts=10, backoff_secs=2, max_backoff_secs=10)
+        self.assertEqual([_policy.backoff(i) for i in range(1, 6)],
+                         [2, 4, 8, 10, 10])
+
+    def test_should_retry(self):
+        _policy = RetryPolicy(max_attempts=2, retry_on=(IOError,))
+        self.assertTrue(_policy.should_retry(1, IOError()))
+        self.assertFalse(_policy.should_retry(2, IOError()))
+        self.assertFalse(_policy.should_retry(1, ValueError()))
+
+    @patch('time.sleep')
+    def test_call_with_retries(self, sleep):
+        fn = MagicMock(__name__='fn', side_effect=[IOError(), 'result'])
+        self.assertEqual(
+            call_with_retries(RetryPolicy(max_attempts=3), fn, arg=1),
+            'result')
+        self.assertEqual(fn.call_count, 2)
+        fn.assert_called_with(arg=1)
+        sleep.assert_called_once_with(1)
+
+        fn = MagicMock(__name__='fn', side_effect=ValueError('bad'))
+        with pytest.raises(ValueError):
+            call_with_retries(
+                RetryPolicy(max_attempts=3, retry_on=(IOError,)), fn)
+        self.assertEqual(fn.call_count, 1)
@@ -0,0 +1,51 @@
+import os
+import decimal
+import tempfile
+import unittest
+
+from datetime import date, datetime, timezone
+from unittest.mock import patch
+from bqsqoop.utils.watermark import WatermarkState
+
+
+class TestWatermarkState(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "state.json")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_no_state(self):
+        self.assertIsNone(WatermarkState(self.path, 'updated_at').read())
+
+    def test_values_keep_their_type(self):
+        _state = WatermarkState(self.path, 'updated_at')
+        for value in [datetime(2018, 9, 10, 1, 2, 3, 4),
+                      datetime(2018, 9, 10, tzinfo=timezone.utc),
+                      date(2018, 9, 10),
+                      decimal.Decimal('10.25'), 10, 10.5,
+                      '2018-09-10T00:00:00.000Z']:
+            _state.save(value)
+            self.assertEqual(_state.read(), value)
+            self.assertEqual(type(_state.read()), type(value))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_state_of_another_field_is_ignored(self):
+        WatermarkState(self.path, 'id').save(10)
+        self.assertIsNone(WatermarkState(self.path, 'updated_at').read())
+
+    @patch('bqsqoop.utils.gcloud.storage.upload_string_to_file')
+    @patch('bqsqoop.utils.gcloud.storage.download_file_as_string')
+    def test_gcs_state(self, download_file_as_string, upload_string_to_file):
+        gcs_uri = "gs://gcs_bucket/state/orders.json"
+        _state = WatermarkState(gcs_uri, 'id')
+        _state.save(10)
+        _content, _uri = upload_string_to_file.call_args[0]
+        self.assertEqual(_uri, gcs_uri)
+
+        download_file_as_string.return_value = _content
+        self.assertEqual(_state.read(), 10)
+        download_file_as_string.assert_called_with(gcs_uri)
+        download_file_as_string.return_value = None
+        self.assertIsNone(_state.read())